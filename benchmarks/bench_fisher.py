@@ -0,0 +1,81 @@
+################################################
+#   Libraries
+################################################
+
+import click
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dockerfiles", "cohort_higlass", "scripts"))
+from fisher import fisher_calculation, fisher_exact_greater_batch
+
+
+################################################
+#   Functions
+################################################
+
+def random_tables(num_tables, num_cases, seed):
+    '''
+    Generates 2x2 tables as they are created in create_variant_result_file.py:
+    mostly rare variants in the cases, compared against gnomAD sized and
+    cohort sized control groups
+    '''
+    rng = random.Random(seed)
+    case_AN = 2 * num_cases
+    tables = []
+    for _ in range(num_tables):
+        # Allele counts are capped at the allele numbers of small cohorts
+        case_AC = min(rng.choice([0, 0, 0, 1, 1, 2, 3, 5, rng.randint(0, case_AN)]), case_AN)
+        control_AN = rng.choice([152312, 251496, 2 * rng.randint(num_cases, 4 * num_cases)])
+        control_AC = min(rng.choice([0, 0, 1, 2, 5, 30, 400, rng.randint(0, control_AN)]), control_AN)
+        tables.append([case_AC, case_AN - case_AC, control_AC, control_AN - control_AC])
+    return tables
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("-n", "--num-tables", default=300000, type=int, help="Number of 2x2 tables (3 per variant)")
+@click.option("-c", "--num-cases", default=500, type=int, help="Number of cases in the cohort")
+@click.option("--seed", default=1, type=int, help="Random seed")
+def main(num_tables, num_cases, seed):
+    """Compares the scalar scipy Fisher exact test with the batched engine
+    used in create_variant_result_file.py and checks that the rounded results are identical.
+
+    Example usage:
+
+    python benchmarks/bench_fisher.py -n 300000 -c 500
+
+    """
+    tables = random_tables(num_tables, num_cases, seed)
+
+    start = time.perf_counter()
+    scalar_results = [fisher_calculation(*table) for table in tables]
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_results = fisher_exact_greater_batch(tables)
+    batch_time = time.perf_counter() - start
+
+    mismatches = sum(
+        1 for s, b in zip(scalar_results, batch_results)
+        if (str(s[1]), str(s[2])) != (str(b[1]), str(b[2]))
+    )
+
+    print(json.dumps({
+        "num_tables": num_tables,
+        "num_cases": num_cases,
+        "scalar_seconds": round(scalar_time, 3),
+        "batch_seconds": round(batch_time, 3),
+        "speedup": round(scalar_time / batch_time, 1),
+        "mismatches": mismatches,
+    }, indent=2))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
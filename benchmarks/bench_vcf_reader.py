@@ -0,0 +1,116 @@
+################################################
+#   Libraries
+################################################
+
+import click
+import io
+import json
+import os
+import sys
+import time
+from granite.lib import vcf_parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dockerfiles", "cohort_filtering", "scripts"))
+from vcf_reader import VcfReader
+
+from generate_cohort import cohort_file_names, generate_cohort
+
+
+################################################
+#   Top level variables
+################################################
+
+GATK_TAGS = ["FS", "InbreedingCoeff", "MQRankSum", "QD", "ReadPosRankSum", "SOR"]
+
+
+################################################
+#   Functions
+################################################
+
+def read_only(vcf_obj):
+    ''' iterates the records, as split_vcf.py does before writing them '''
+    return [record.POS for record in vcf_obj.parse_variants()]
+
+
+def gatk_filter(vcf_obj):
+    ''' reads the GATK tags and changes ID, as apply_gatk_filter.py does, and writes every record '''
+    out = io.StringIO()
+    for record in vcf_obj.parse_variants():
+        for tag in GATK_TAGS:
+            float(record.get_tag_value(tag))
+        record.ID = record.ID.replace("*", "-")
+        vcf_obj.write_variant(out, record)
+    return out.getvalue()
+
+
+def genotypes(vcf_obj):
+    ''' reads the GT of every sample '''
+    return [
+        [sample_col.partition(":")[0] for sample_col in record.GENOTYPES.values()]
+        for record in vcf_obj.parse_variants()
+    ]
+
+
+WORKLOADS = {
+    "read_only": read_only,
+    "gatk_filter": gatk_filter,
+    "genotypes": genotypes,
+}
+
+
+def timed(workload, vcf_obj, repeat):
+    ''' returns the fastest time of repeat runs and the result of the last one '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = workload(vcf_obj)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("-n", "--num-samples", default=1000, type=int, help="Number of samples of the generated cohort")
+@click.option("-v", "--num-variants", default=20000, type=int, help="Number of variants of the generated cohort")
+@click.option("-d", "--work-dir", default="benchmark_data", type=str, help="Directory for the generated cohort, reused between runs")
+@click.option("-r", "--repeat", default=3, type=int, help="Number of runs per workload. The fastest one is reported")
+@click.option("--seed", default=1, type=int, help="Random seed")
+def main(num_samples, num_variants, work_dir, repeat, seed):
+    """Compares granite's Vcf parser with the lazy VcfReader used in apply_gatk_filter.py,
+    filter_hwe.py and split_vcf.py on a generated cohort, and checks that the results are identical.
+
+    Example usage:
+
+    python benchmarks/bench_vcf_reader.py -n 1000 -v 20000
+
+    """
+    cohort_dir = os.path.join(work_dir, f"cohort_{num_samples}x{num_variants}_seed{seed}")
+    vcf = cohort_file_names(cohort_dir)["annotated_vcf"]
+    if not os.path.exists(vcf):
+        generate_cohort(cohort_dir, num_samples, num_variants, seed=seed)
+
+    results = {}
+    mismatches = 0
+    for name, workload in WORKLOADS.items():
+        granite_time, granite_result = timed(workload, vcf_parser.Vcf(vcf), repeat)
+        lazy_time, lazy_result = timed(workload, VcfReader(vcf), repeat)
+        mismatches += granite_result != lazy_result
+        results[name] = {
+            "granite_seconds": round(granite_time, 3),
+            "lazy_seconds": round(lazy_time, 3),
+            "speedup": round(granite_time / lazy_time, 1),
+        }
+
+    print(json.dumps({
+        "num_samples": num_samples,
+        "num_variants": num_variants,
+        "workloads": results,
+        "mismatches": mismatches,
+    }, indent=2))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
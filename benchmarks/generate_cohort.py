@@ -0,0 +1,362 @@
+################################################
+#   Libraries
+################################################
+
+import click
+import gzip
+import json
+import os
+import random
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dockerfiles", "cohort_higlass", "scripts"))
+from bgzf import BgzfWriter, TabixIndex
+
+
+################################################
+#   Top level variables
+################################################
+
+CSQ_FIELDS = [
+    "Allele", "Consequence", "IMPACT", "SYMBOL", "Gene", "Feature_type", "Feature", "CANONICAL",
+    "SpliceAI_pred_DS_AG", "SpliceAI_pred_DS_AL", "SpliceAI_pred_DS_DG", "SpliceAI_pred_DS_DL",
+    "CADD_PHRED", "CADD_RAW", "CADD_raw_rankscore", "Ensembl_transcriptid", "GERP++_RS", "GERP++_RS_rankscore",
+    "Polyphen2_HVAR_pred", "Polyphen2_HVAR_rankscore", "Polyphen2_HVAR_score",
+    "SIFT_converted_rankscore", "SIFT_pred", "SIFT_score",
+    "gnomADg", "gnomADg_AC", "gnomADg_AF", "gnomADg_AN",
+    "gnomADe2", "gnomADe2_AC", "gnomADe2_AF", "gnomADe2_AN",
+]
+
+# Consequences are drawn with these weights, roughly as they appear in exome cohorts
+CONSEQUENCES = [
+    ("missense_variant", 20), ("synonymous_variant", 12), ("intron_variant", 20),
+    ("splice_region_variant&intron_variant", 4), ("missense_variant&splice_region_variant", 2),
+    ("3_prime_UTR_variant", 6), ("5_prime_UTR_variant", 3), ("upstream_gene_variant", 6),
+    ("downstream_gene_variant", 6), ("non_coding_transcript_exon_variant", 5),
+    ("stop_gained", 2), ("frameshift_variant", 2), ("splice_donor_variant", 1),
+    ("splice_acceptor_variant", 1), ("inframe_deletion", 1), ("stop_lost", 0.5), ("start_lost", 0.5),
+]
+
+IMPACTS = ["HIGH", "MODERATE", "LOW", "MODIFIER"]
+
+CHROMOSOMES = [("chr1", 248956422), ("chr2", 242193529), ("chr17", 83257441), ("chrX", 156040895)]
+
+# Alternate allele frequencies of the cohort variants and their weights. Most variants are rare
+COHORT_AFS = [0.0005, 0.002, 0.01, 0.05, 0.3]
+COHORT_AF_WEIGHTS = [0.45, 0.25, 0.15, 0.1, 0.05]
+
+MISSING_RATE = 0.03
+PHASED_RATE = 0.1
+
+# Number of pre-rendered sample columns per genotype
+SAMPLE_COLUMN_POOL = 64
+
+# Number of variants whose genotypes are drawn at once
+GENOTYPE_BLOCK = 1000
+
+MASKS = ["mask_missense", "mask_cadd", "mask_missense_cadd", "mask_nonsense_splice"]
+AAF_BINS = ["0.01", "0.05", "all"]
+
+
+################################################
+#   Functions
+################################################
+
+def vcf_header(samples):
+    header = [
+        "##fileformat=VCFv4.2",
+        '##FILTER=<ID=PASS,Description="All filters passed">',
+        '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency">',
+        '##INFO=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+        '##INFO=<ID=FS,Number=1,Type=Float,Description="Phred-scaled p-value using Fisher\'s exact test to detect strand bias">',
+        '##INFO=<ID=InbreedingCoeff,Number=1,Type=Float,Description="Inbreeding coefficient">',
+        '##INFO=<ID=MQRankSum,Number=1,Type=Float,Description="Z-score From Wilcoxon rank sum test of Alt vs. Ref read mapping qualities">',
+        '##INFO=<ID=QD,Number=1,Type=Float,Description="Variant Confidence/Quality by Depth">',
+        '##INFO=<ID=ReadPosRankSum,Number=1,Type=Float,Description="Z-score from Wilcoxon rank sum test of Alt vs. Ref read position bias">',
+        '##INFO=<ID=SOR,Number=1,Type=Float,Description="Symmetric Odds Ratio of 2x2 contingency table to detect strand bias">',
+        '##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: ' + "|".join(CSQ_FIELDS) + '">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+        '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">',
+        '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">',
+        '##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">',
+    ]
+    for chrom, length in CHROMOSOMES:
+        header.append(f"##contig=<ID={chrom},length={length}>")
+    header.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t" + "\t".join(samples))
+    return "\n".join(header) + "\n"
+
+
+def sample_column_pool(rng):
+    '''
+    Returns a list of rendered GT:AD:DP:GQ sample columns. The columns of genotype code
+    c (0: missing, 1: hom ref, 2: het, 3: hom alt) are at c*SAMPLE_COLUMN_POOL .. (c+1)*SAMPLE_COLUMN_POOL-1
+    '''
+    genotypes = [("./.", "./."), ("0/0", "0|0"), ("0/1", "0|1"), ("1/1", "1|1")]
+    pool = []
+    for code, (unphased, phased) in enumerate(genotypes):
+        for _ in range(SAMPLE_COLUMN_POOL):
+            gt = phased if rng.random() < PHASED_RATE else unphased
+            if code == 2 and rng.random() < 0.1:
+                gt = "1/0"
+            if code == 0:
+                pool.append(f"{gt}:.:.:.")
+                continue
+            dp = rng.randint(5, 60)
+            alt = {1: 0, 2: dp // 2, 3: dp}[code]
+            pool.append(f"{gt}:{dp - alt},{alt}:{dp}:{rng.randint(1, 99)}")
+    return pool
+
+
+def genotype_codes(np_rng, num_variants, num_samples):
+    ''' returns the cohort AF and a (num_variants, num_samples) array of genotype codes per variant '''
+    afs = np_rng.choice(COHORT_AFS, size=num_variants, p=COHORT_AF_WEIGHTS)
+    codes = np_rng.binomial(2, afs[:, None], size=(num_variants, num_samples)).astype(np.int8) + 1
+    codes[np_rng.random((num_variants, num_samples)) < MISSING_RATE] = 0
+    return afs, codes
+
+
+def gnomad_values(rng, multi_gnomad):
+    '''
+    Returns AC, AN and AF of a gnomAD population. A fraction multi_gnomad of the values are
+    '&'-separated lists, as VEP reports them for overlapping gnomAD records
+    '''
+    r = rng.random()
+    if r < 0.15:
+        return "", "", ""
+    if rng.random() < multi_gnomad:
+        k = rng.choice([2, 3])
+        acs = [str(rng.choice([0, 1, 2, 7, 100])) for _ in range(k)]
+        ans = [str(rng.choice([150000, 251000])) for _ in range(k)]
+        return "&".join(acs), "&".join(ans), "&".join(["0.001"] * k)
+    an = rng.choice([152312, 152000, 251000, 150000])
+    ac = rng.choice([0, 1, 2, 3, 5, 10, 50, 1000, 20000])
+    return str(ac), str(an), f"{ac / an:.3g}"
+
+
+def csq_value(rng, alt, gene, max_transcripts, multi_gnomad, consequences, weights):
+    ''' returns the CSQ value of a variant with 1 to max_transcripts transcripts '''
+    num_transcripts = rng.randint(1, max_transcripts)
+    transcripts = [f"ENST{rng.randint(1, 10**6):011d}" for _ in range(num_transcripts)]
+    gnomADg = gnomad_values(rng, 0)
+    gnomADe2 = gnomad_values(rng, multi_gnomad)
+    canonical = rng.randrange(num_transcripts) if rng.random() < 0.8 else -1
+    spliceai = rng.random() < 0.6
+    cadd = rng.random() < 0.8
+    dbnsfp = rng.random() < 0.5
+
+    annotations = []
+    for t, transcript in enumerate(transcripts):
+        f = dict.fromkeys(CSQ_FIELDS, "")
+        f["Allele"] = alt
+        f["Consequence"] = rng.choices(consequences, weights)[0]
+        f["IMPACT"] = rng.choice(IMPACTS)
+        f["Gene"] = gene
+        f["SYMBOL"] = f"SYM{gene[-5:]}" if gene else ""
+        f["Feature_type"] = "Transcript"
+        f["Feature"] = transcript
+        f["CANONICAL"] = "YES" if t == canonical else ""
+        if spliceai:
+            for key in ("DS_AG", "DS_AL", "DS_DG", "DS_DL"):
+                f["SpliceAI_pred_" + key] = f"{rng.random():.2f}"
+        if cadd:
+            f["CADD_PHRED"] = f"{rng.uniform(0, 40):.3f}"
+            f["CADD_RAW"] = f"{rng.uniform(-2, 10):.5f}"
+            f["CADD_raw_rankscore"] = f"{rng.random():.5f}"
+        if dbnsfp:
+            ids = rng.sample(transcripts, rng.randint(1, num_transcripts))
+            f["Ensembl_transcriptid"] = "&".join(ids)
+            for key in ("Polyphen2_HVAR_pred", "SIFT_pred"):
+                f[key] = "&".join(rng.choice(["D", "B", "T", "."]) for _ in ids)
+            for key in ("Polyphen2_HVAR_score", "SIFT_score"):
+                f[key] = "&".join(rng.choice([f"{rng.random():.3f}", "."]) for _ in ids)
+            f["Polyphen2_HVAR_rankscore"] = f"{rng.random():.4f}"
+            f["SIFT_converted_rankscore"] = f"{rng.random():.4f}"
+            f["GERP++_RS"] = f"{rng.uniform(-5, 6):.2f}"
+            f["GERP++_RS_rankscore"] = f"{rng.random():.4f}"
+        f["gnomADg_AC"], f["gnomADg_AN"], f["gnomADg_AF"] = gnomADg
+        f["gnomADe2_AC"], f["gnomADe2_AN"], f["gnomADe2_AF"] = gnomADe2
+        annotations.append("|".join([f[key] for key in CSQ_FIELDS]))
+    return ",".join(annotations)
+
+
+def cohort_file_names(out_dir):
+    return {
+        "annotated_vcf": os.path.join(out_dir, "annotated.vcf.gz"),
+        "sample_info": os.path.join(out_dir, "sample_info.json"),
+        "regenie_variants": os.path.join(out_dir, "regenie_variants.txt.gz"),
+        "regenie_genes": os.path.join(out_dir, "regenie_genes.txt.gz"),
+        "snplist": os.path.join(out_dir, "regenie_genes.snplist.gz"),
+        "gene_info": os.path.join(out_dir, "gene_info.tsv"),
+    }
+
+
+def generate_cohort(
+    out_dir,
+    num_samples,
+    num_variants,
+    max_transcripts=4,
+    multi_gnomad=0.1,
+    case_fraction=0.25,
+    num_genes=500,
+    seed=1,
+):
+    '''
+    Writes a synthetic cohort to out_dir and returns a dict with the paths of the files:
+        annotated_vcf: VEP annotated, bgzipped and tabix indexed VCF
+        sample_info: JSON with the sample information, as passed to the scripts
+        regenie_variants: Regenie variant level results (gzipped)
+        regenie_genes: Regenie gene level results (gzipped)
+        snplist: mask SNP list (gzipped)
+        gene_info: gene annotation TSV as exported from the portal
+    '''
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    files = cohort_file_names(out_dir)
+
+    samples = [f"SAMPLE{i:06d}" for i in range(num_samples)]
+    num_cases = max(1, round(num_samples * case_fraction))
+    sample_info = [
+        {
+            "sample_id": sample,
+            "linkto_id": f"GAPIN{i:06d}",
+            "is_affected": i < num_cases,
+            "tissue_type": rng.choice(["Peripheral Blood", None]),
+            "contact": rng.choice(["contact@example.org", None]),
+            "ancestry": rng.choice(["EUR", "AFR", "EAS", "AMR", "SAS"]),
+        }
+        for i, sample in enumerate(samples)
+    ]
+    with open(files["sample_info"], "w") as f:
+        json.dump(sample_info, f)
+
+    genes = [f"ENSG{i:011d}" for i in range(num_genes)]
+    consequences = [consequence for consequence, _ in CONSEQUENCES]
+    weights = [weight for _, weight in CONSEQUENCES]
+    pool = np.array(sample_column_pool(rng), dtype=object)
+    pool_offsets = np.arange(SAMPLE_COLUMN_POOL)
+
+    # Variants are spread over the chromosomes proportionally to their length
+    total_length = sum(length for _, length in CHROMOSOMES)
+    per_chrom = [num_variants * length // total_length for _, length in CHROMOSOMES]
+    per_chrom[0] += num_variants - sum(per_chrom)
+
+    gene_variants = {}
+    gene_positions = {}
+    with BgzfWriter(files["annotated_vcf"], TabixIndex()) as f_vcf, \
+         gzip.open(files["regenie_variants"], "wt") as f_regenie:
+        f_vcf.write(vcf_header(samples))
+        f_regenie.write("CHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ INFO N TEST BETA SE CHISQ LOG10P EXTRA\n")
+
+        for (chrom, length), chrom_variants in zip(CHROMOSOMES, per_chrom):
+            step = max(2, 2 * (length - 20000) // max(chrom_variants, 1))
+            pos = 10000
+            # Alleles of the records at pos, records of a site have different alleles
+            site_pos, site_alleles = None, set()
+            # Genes are consecutive stretches of variants
+            gene, gene_left = "", 0
+            for block_start in range(0, chrom_variants, GENOTYPE_BLOCK):
+                block_size = min(GENOTYPE_BLOCK, chrom_variants - block_start)
+                afs, codes = genotype_codes(np_rng, block_size, num_samples)
+                columns = codes.astype(np.int64) * SAMPLE_COLUMN_POOL + np_rng.choice(pool_offsets, size=codes.shape)
+                for i in range(block_size):
+                    # A few variants are multiallelic sites split into several records
+                    if rng.random() > 0.03:
+                        pos = min(pos + rng.randint(1, step), length)
+                    if pos != site_pos:
+                        site_pos, site_alleles = pos, set()
+                    while True:
+                        ref = rng.choice("ACGT")
+                        alt = rng.choice([base for base in "ACGT" if base != ref])
+                        if rng.random() < 0.12:
+                            alt += "".join(rng.choices("ACGT", k=rng.randint(1, 5)))
+                        elif rng.random() < 0.1:
+                            ref += "".join(rng.choices("ACGT", k=rng.randint(1, 5)))
+                        if (ref, alt) not in site_alleles:
+                            break
+                    site_alleles.add((ref, alt))
+                    variant_id = f"{chrom}_{pos}_{ref}_{alt}"
+
+                    if gene_left == 0:
+                        gene = rng.choice(genes) if rng.random() < 0.85 else ""
+                        gene_left = rng.randint(5, 200)
+                    gene_left -= 1
+
+                    info = (
+                        f"AF={afs[i]:.3g};DP={rng.randint(100, 9000)};FS={rng.uniform(0, 80):.3f};"
+                        f"InbreedingCoeff={rng.uniform(-1, 1):.4f};MQRankSum={rng.uniform(-15, 5):.3f};"
+                        f"QD={rng.uniform(0, 30):.2f};ReadPosRankSum={rng.uniform(-25, 5):.3f};"
+                        f"SOR={rng.uniform(0, 12):.3f};"
+                        f"CSQ={csq_value(rng, alt, gene, max_transcripts, multi_gnomad, consequences, weights)}"
+                    )
+                    f_vcf.write_record(
+                        f"{chrom}\t{pos}\t{variant_id}\t{ref}\t{alt}\t{rng.uniform(10, 5000):.2f}\tPASS\t{info}\tGT:AD:DP:GQ\t"
+                        + "\t".join(pool[columns[i]].tolist()) + "\n"
+                    )
+
+                    # Regenie does not report every variant (e.g. monomorphic ones)
+                    if rng.random() < 0.9:
+                        f_regenie.write(
+                            f"{chrom[3:]} {pos} {variant_id} {ref} {alt} {afs[i]:.6g} 1 {num_samples} ADD "
+                            f"{rng.uniform(-2, 2):.6g} {rng.random():.6g} {rng.random() * 10:.6g} {rng.expovariate(1.5):.6g} NA\n"
+                        )
+                    if gene:
+                        gene_variants.setdefault(gene, []).append(variant_id)
+                        gene_positions.setdefault(gene, (chrom, pos))
+
+    with open(files["gene_info"], "w") as f:
+        f.write("ens_id\tchr\tstart\tend\tstrand\tgene\n")
+        for gene in genes:
+            chrom, start = gene_positions.get(gene, (rng.choice(CHROMOSOMES)[0], rng.randint(1, 10**8)))
+            f.write(f"{gene}\t{chrom[3:]}\t{start}\t{start + rng.randint(1000, 10**5)}\t{rng.choice('+-')}\tSYM{gene[-5:]}\n")
+
+    with gzip.open(files["regenie_genes"], "wt") as f_genes, gzip.open(files["snplist"], "wt") as f_snplist:
+        f_genes.write("##source=regenie\nCHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ N TEST BETA SE CHISQ LOG10P EXTRA\n")
+        for gene in sorted(gene_variants):
+            chrom, pos = gene_positions[gene]
+            variants = gene_variants[gene]
+            for mask in MASKS:
+                for aaf_bin in AAF_BINS:
+                    tests = ["ADD"] + (["ADD-SKAT", "ADD-ACATO", "ADD-ACATV"] if aaf_bin == "all" else [])
+                    for test in tests:
+                        f_genes.write(
+                            f"{chrom[3:]} {pos} {gene}.{mask}.{aaf_bin} ref {mask}.{aaf_bin} NA {num_samples} {test} "
+                            f"NA NA {rng.random() * 5:.5g} {rng.expovariate(1.0):.5g} NA\n"
+                        )
+                    if aaf_bin != "all":
+                        snps = rng.sample(variants, min(len(variants), rng.randint(1, 10)))
+                        f_snplist.write(f"{gene}.{mask}.{aaf_bin}\t{','.join(snps)}\n")
+
+    return files
+
+
+################################################
+#   Main
+################################################
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("-o", "--out-dir", required=True, type=str, help="Output directory")
+@click.option("-n", "--num-samples", default=100, type=int, show_default=True, help="Number of samples")
+@click.option("-v", "--num-variants", default=100000, type=int, show_default=True, help="Number of variants")
+@click.option("-t", "--max-transcripts", default=4, type=int, show_default=True, help="Maximum number of transcripts per CSQ")
+@click.option("-m", "--multi-gnomad", default=0.1, type=float, show_default=True, help="Fraction of variants with '&'-separated gnomAD exome values")
+@click.option("-c", "--case-fraction", default=0.25, type=float, show_default=True, help="Fraction of samples that are cases")
+@click.option("-g", "--num-genes", default=500, type=int, show_default=True, help="Number of genes")
+@click.option("--seed", default=1, type=int, show_default=True, help="Random seed")
+def main(out_dir, num_samples, num_variants, max_transcripts, multi_gnomad, case_fraction, num_genes, seed):
+    """Generates a synthetic VEP annotated cohort VCF with matching sample information,
+    Regenie variant and gene level results, mask SNP list and gene annotation file.
+
+    Example usage:
+
+    python benchmarks/generate_cohort.py -o cohort_100x100k -n 100 -v 100000
+
+    """
+    files = generate_cohort(out_dir, num_samples, num_variants, max_transcripts, multi_gnomad, case_fraction, num_genes, seed)
+    print(json.dumps(files, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+################################################
+#   Libraries
+################################################
+
+import click
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from generate_cohort import cohort_file_names, generate_cohort
+
+
+################################################
+#   Top level variables
+################################################
+
+DOCKERFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dockerfiles")
+
+DEFAULT_SCALES = ("100x100000", "1000x100000")
+
+AF_THRESHOLD_HIGLASS = "0.03"
+AAF_BIN = "0.01"
+
+
+################################################
+#   Functions
+################################################
+
+def script_path(image, script):
+    return os.path.abspath(os.path.join(DOCKERFILES, image, "scripts", script))
+
+
+def variant_result_command(files, workers):
+    return [
+        "python", script_path("cohort_higlass", "create_variant_result_file.py"),
+        "-r", files["regenie_variants"],
+        "-a", files["annotated_vcf"],
+        "-s", files["sample_info"],
+        "-o", "variant_level_results.txt.gz",
+        "-f", AF_THRESHOLD_HIGLASS,
+        "-e", "higlass_variant_tests.vcf.gz",
+        "-m", "higlass_variant_tests.multires.vcf.gz",
+        "-w", str(workers),
+    ]
+
+
+def variant_details_command(files, workers):
+    return [
+        "python", script_path("cohort_higlass", "create_variant_details_file.py"),
+        "-a", files["annotated_vcf"],
+        "-s", files["sample_info"],
+        "-o", "variant_details.vcf.gz",
+    ]
+
+
+def mask_files_command(files, workers):
+    return [
+        "python", script_path("cohort_regenie", "create_mask_files.py"),
+        "-a", files["annotated_vcf"],
+        "-c", "20",
+    ]
+
+
+def gatk_filter_command(files, workers):
+    return [
+        "python", script_path("cohort_filtering", "apply_gatk_filter.py"),
+        "-a", files["annotated_vcf"],
+        "-o", "gatk_filtered.vcf.gz",
+    ]
+
+
+def higlass_gene_command(files, workers):
+    return [
+        "python", script_path("cohort_higlass", "create_higlass_gene_file.py"),
+        "-r", files["regenie_genes"],
+        "-s", files["snplist"],
+        "-g", files["gene_info"],
+        "-a", AAF_BIN,
+        "-o", "higlass_gene_tests.sorted.vcf.gz",
+    ]
+
+
+# name: (command builder, supports --profile)
+SCRIPTS = {
+    "create_variant_result_file": (variant_result_command, True),
+    "create_variant_details_file": (variant_details_command, True),
+    "create_mask_files": (mask_files_command, True),
+    "apply_gatk_filter": (gatk_filter_command, True),
+    "create_higlass_gene_file": (higlass_gene_command, False),
+}
+
+
+def parse_scale(scale):
+    ''' "1000x100000" -> (1000, 100000) '''
+    try:
+        num_samples, num_variants = scale.lower().split("x")
+        return int(num_samples), int(num_variants)
+    except ValueError:
+        raise click.BadParameter(f"{scale} is not of the form SAMPLESxVARIANTS, e.g. 1000x100000")
+
+
+def cohort_files(work_dir, num_samples, num_variants, seed, regenerate):
+    ''' generates the cohort of the given scale, unless it exists already in work_dir '''
+    cohort_dir = os.path.join(work_dir, f"cohort_{num_samples}x{num_variants}_seed{seed}")
+    files = cohort_file_names(cohort_dir)
+    if regenerate or not all(os.path.exists(path) for path in files.values()) \
+            or not os.path.exists(files["annotated_vcf"] + ".tbi"):
+        print(f"Generating cohort with {num_samples} samples and {num_variants} variants in {cohort_dir}")
+        start = time.perf_counter()
+        files = generate_cohort(cohort_dir, num_samples, num_variants, seed=seed)
+        print(f"Generated in {time.perf_counter() - start:.1f}s")
+    # The scripts take the sample information file, large cohorts exceed the size limit of a JSON string argument
+    return {name: os.path.abspath(path) for name, path in files.items()}
+
+
+def run_script(command, run_dir):
+    '''
+    Runs command in run_dir and returns wall time in seconds, peak RSS in MB
+    (largest of the script and its child processes) and the return code
+    '''
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, "log.txt"), "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=run_dir, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / 1024 if sys.platform != "darwin" else usage.ru_maxrss / 1024 ** 2
+    return seconds, peak_rss, process.returncode
+
+
+def benchmark_script(name, files, num_variants, run_dir, workers, repeat):
+    build_command, has_profile = SCRIPTS[name]
+    command = build_command(files, workers)
+    profile_file = os.path.join(run_dir, "profile.json")
+    if has_profile:
+        command += ["--profile", profile_file]
+
+    times, peak_rss, returncode = [], 0, 0
+    for _ in range(repeat):
+        try:
+            seconds, rss, returncode = run_script(command, run_dir)
+        except OSError as e:
+            # e.g. the sample info JSON of large cohorts exceeds the maximum argument length
+            return {"script": name, "returncode": None, "error": str(e)}
+        times.append(seconds)
+        peak_rss = max(peak_rss, rss)
+        if returncode != 0:
+            break
+
+    result = {
+        "script": name,
+        "returncode": returncode,
+        "seconds": round(min(times), 3),
+        "all_seconds": [round(seconds, 3) for seconds in times],
+        "variants_per_second": round(num_variants / min(times), 1),
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+    if returncode != 0:
+        result["log"] = os.path.join(run_dir, "log.txt")
+    elif has_profile and os.path.exists(profile_file):
+        with open(profile_file) as f:
+            profile = json.load(f)
+        result["phases"] = profile["phases"]
+        result["chunks"] = profile["chunks"]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DOCKERFILES, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(results, baseline_file):
+    ''' prints the speedup of every run compared to the same scale and script in baseline_file '''
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    baseline_seconds = {
+        (r["num_samples"], r["num_variants"], r["script"]): r["seconds"]
+        for r in baseline["results"] if r["returncode"] == 0
+    }
+    print(f"\nCompared to {baseline_file} ({baseline['environment'].get('git_commit')}):")
+    for r in results:
+        key = (r["num_samples"], r["num_variants"], r["script"])
+        if key not in baseline_seconds or r["returncode"] != 0:
+            continue
+        speedup = baseline_seconds[key] / r["seconds"] if r["seconds"] else float("inf")
+        print(f"  {r['script']:<28} {r['num_samples']:>6} x {r['num_variants']:<8} "
+              f"{baseline_seconds[key]:>9.2f}s -> {r['seconds']:>9.2f}s  ({speedup:.2f}x)")
+
+
+################################################
+#   Main
+################################################
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("-s", "--scale", "scales", multiple=True, default=DEFAULT_SCALES, show_default=True,
+              help="Cohort size as SAMPLESxVARIANTS. Can be given multiple times")
+@click.option("-x", "--script", "scripts", multiple=True, type=click.Choice(list(SCRIPTS)),
+              help="Script to benchmark. Can be given multiple times (default: all)")
+@click.option("-d", "--work-dir", default="benchmark_data", type=str, show_default=True,
+              help="Directory for the generated cohorts and the script outputs. Cohorts are reused between runs")
+@click.option("-o", "--output", default="benchmark_results.json", type=str, show_default=True, help="Output JSON file")
+@click.option("-w", "--workers", default=1, type=int, show_default=True, help="Number of workers of create_variant_result_file.py")
+@click.option("-r", "--repeat", default=1, type=int, show_default=True, help="Number of runs per script. The fastest one is reported")
+@click.option("-b", "--baseline", default=None, type=str, help="Results of a previous run to compare against")
+@click.option("--seed", default=1, type=int, show_default=True, help="Random seed of the generated cohorts")
+@click.option("--regenerate", is_flag=True, help="Generate the cohorts even if they exist in the work directory")
+def main(scales, scripts, work_dir, output, workers, repeat, baseline, seed, regenerate):
+    """Times the cohort scripts end to end and per phase on synthetic cohorts of several sizes
+    and writes variants per second and peak memory of every run to a JSON file.
+
+    Example usage:
+
+    python benchmarks/run_benchmarks.py -s 100x100000 -s 1000x100000 -s 10000x1000000 -o results.json
+
+    python benchmarks/run_benchmarks.py -x create_variant_result_file -w 4 -b results.json
+
+    """
+    scripts = scripts or list(SCRIPTS)
+    results = []
+    for scale in scales:
+        num_samples, num_variants = parse_scale(scale)
+        files = cohort_files(work_dir, num_samples, num_variants, seed, regenerate)
+        for name in scripts:
+            run_dir = os.path.join(work_dir, f"run_{num_samples}x{num_variants}", name)
+            print(f"Running {name} on {num_samples} samples x {num_variants} variants")
+            result = benchmark_script(name, files, num_variants, run_dir, workers, repeat)
+            result.update({"num_samples": num_samples, "num_variants": num_variants})
+            if "error" in result:
+                print(f"  FAILED: {result['error']}")
+            elif result["returncode"] != 0:
+                print(f"  FAILED with exit code {result['returncode']}, see {result['log']}")
+            else:
+                print(f"  {result['seconds']}s, {result['variants_per_second']} variants/s, {result['peak_rss_mb']} MB peak RSS")
+            results.append(result)
+
+    report = {
+        "environment": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "workers": workers,
+            "seed": seed,
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
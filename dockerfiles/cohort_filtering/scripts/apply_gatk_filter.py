@@ -3,8 +3,12 @@
 ################################################
 
 import click
-from granite.lib import vcf_parser
-import os
+import re
+from collections import Counter
+from bgzf import BgzfWriter, TabixIndex
+from vcf_reader import VcfReader
+from filter_hwe import REPORT_HEADER, HWEFilter, PopulationCounter, read_popmap
+from profiler import get_profiler
 
 
 ################################################
@@ -22,14 +26,174 @@ READ_POS_RANK_SUM_INDEL = -20.0
 SOR_SNP = 3.0
 SOR_INDEL = 10.0
 
-CHUNK_SIZE = 1000000
-CHUNK_PREFIX = "gatk_filter_chunk"
+# Filters in the order they are applied: name, description
+FILTER_STEPS = [
+    ("chromosomes", "record not on one of the selected chromosomes"),
+    ("biallelic", "record is not biallelic"),
+    ("min_qual", "QUAL below the minimum"),
+    ("max_missing", "proportion of called alleles below the minimum, after genotypes below min_dp are set to missing"),
+    ("mac", "minor allele count below the minimum"),
+    ("hwe", "out of HWE in more than the allowed proportion of populations"),
+    ("gatk", "GATK best practice thresholds not met or tags missing"),
+]
+
+
+################################################
+#   Classes
+################################################
+
+class FilterFunnel(object):
+    ''' Number of records removed by each filter step '''
+
+    def __init__(self):
+        self.num_variants = 0
+        self.removed = {name: 0 for name, _ in FILTER_STEPS}
+
+    def remove(self, step, num_records=1):
+        self.removed[step] += num_records
+
+    def lines(self):
+        remaining = self.num_variants
+        yield f"filter\tremoved\tremaining\tdescription\n"
+        yield f"input\t0\t{remaining}\tall records of the input VCF\n"
+        for name, description in FILTER_STEPS:
+            remaining -= self.removed[name]
+            yield f"{name}\t{self.removed[name]}\t{remaining}\t{description}\n"
+
+    def write(self, report):
+        with open(report, "w") as f:
+            f.writelines(self.lines())
+
+
+class SiteQC(object):
+    '''
+    Genotype and site filters as applied by vcftools --minDP, --max-missing and --mac.
+
+    GTs of genotypes with DP below min_dp (or without DP) are set to missing in the record.
+    The proportion of called alleles and the minor allele count are then computed
+    on the remaining genotypes.
+    '''
+
+    def __init__(self, min_dp=None, max_missing=None, mac=None):
+        self.min_dp = min_dp
+        self.max_missing = max_missing
+        self.mac = mac
+        self.missing_gts = {}
+        self.gt_alleles = {}
+
+    def genotypes(self, record):
+        ''' returns the GT values of the record in the order of the sample columns, after applying min_dp '''
+        format_keys = record.FORMAT.split(":")
+        GT_idx = format_keys.index("GT")
+        sample_cols = record.sample_columns
+        if self.min_dp is None:
+            if GT_idx == 0:
+                return [sample_col.partition(":")[0] for sample_col in sample_cols]
+            return [sample_col.split(":")[GT_idx] for sample_col in sample_cols]
+
+        DP_idx = format_keys.index("DP") if "DP" in format_keys else None
+        gts = []
+        masked_cols = None
+        for i, sample_col in enumerate(sample_cols):
+            fields = sample_col.split(":")
+            gt = fields[GT_idx]
+            dp = fields[DP_idx] if DP_idx is not None and DP_idx < len(fields) else "."
+            if dp in (".", "") or int(dp) < self.min_dp:
+                missing_gt = self.missing_gt(gt)
+                if missing_gt != gt:
+                    fields[GT_idx] = gt = missing_gt
+                    if masked_cols is None:
+                        masked_cols = list(sample_cols)
+                    masked_cols[i] = ":".join(fields)
+            gts.append(gt)
+        # Records without masked genotypes are written as they were read
+        if masked_cols is not None:
+            record.GENOTYPES = dict(zip(record.IDs_genotypes, masked_cols))
+        return gts
+
+    def missing_gt(self, gt):
+        ''' "0/1" -> "./.", "0|1" -> ".|.", "1" -> "." '''
+        missing_gt = self.missing_gts.get(gt)
+        if missing_gt is None:
+            missing_gt = self.missing_gts[gt] = re.sub(r"[^/|]+", ".", gt)
+        return missing_gt
+
+    def alleles(self, gt):
+        ''' allele indices of gt, None for missing alleles '''
+        alleles = self.gt_alleles.get(gt)
+        if alleles is None:
+            alleles = self.gt_alleles[gt] = [
+                None if allele == "." else int(allele) for allele in re.split(r"[/|]", gt)
+            ]
+        return alleles
+
+    def failed_filter(self, record, gts):
+        ''' returns the name of the first site filter the record does not pass, None if it passes all '''
+        if self.max_missing is None and self.mac is None:
+            return None
+        num_alleles = 2 + record.ALT.count(",")
+        allele_counts = [0] * num_alleles
+        total, missing = 0, 0
+        for gt, count in Counter(gts).items():
+            for allele in self.alleles(gt):
+                total += count
+                if allele is None:
+                    missing += count
+                elif allele < num_alleles:
+                    allele_counts[allele] += count
+        if self.max_missing is not None and total and 1 - missing / total < self.max_missing:
+            return "max_missing"
+        if self.mac is not None and min(allele_counts) < self.mac:
+            return "mac"
+        return None
 
 
 ################################################
 #   Functions
 ################################################
 
+def passes_gatk_filter(record):
+    '''
+    Returns True if the record passes the GATK best practice thresholds.
+    Raises ValueError (from granite) if one of the tags is missing.
+    * in ALT and ID is replaced with -, VEP does not work for ALT=="*"
+    '''
+    ref = record.REF
+    alt = record.ALT
+
+    is_indel = len(ref) > 1 or len(alt) > 1
+
+    v_fs = float(record.get_tag_value("FS"))
+    v_inbreeding = float(record.get_tag_value("InbreedingCoeff"))
+    v_mqrs = float(record.get_tag_value("MQRankSum"))
+    v_qd = float(record.get_tag_value("QD"))
+    v_rprs = float(record.get_tag_value("ReadPosRankSum"))
+    v_sor = float(record.get_tag_value("SOR"))
+
+    record.ALT = alt.replace("*", "-")
+    record.ID = record.ID.replace("*", "-")
+
+    if is_indel:
+        return (
+            v_fs < FS_INDEL
+            and v_qd > QD
+            and v_rprs > READ_POS_RANK_SUM_INDEL
+            and v_sor <= SOR_INDEL
+        )
+    return (
+        v_fs < FS_SNP
+        and v_inbreeding > INBREEDING
+        and v_mqrs > MQ_RANK_SUM
+        and v_qd > QD
+        and v_rprs > READ_POS_RANK_SUM_SNP
+        and v_sor <= SOR_SNP
+    )
+
+
+def qual(record):
+    ''' QUAL as float, -1 if missing (as vcftools reads it) '''
+    return -1.0 if record.QUAL == "." else float(record.QUAL)
+
 
 @click.command()
 @click.help_option("--help", "-h")
@@ -45,12 +209,118 @@ CHUNK_PREFIX = "gatk_filter_chunk"
     "--out",
     required=True,
     type=str,
-    help="the output file name of the gzipped VCF after filtering",
+    help="the output file name of the VCF after filtering (bgzipped and tabix indexed)",
+)
+@click.option(
+    "--chromosomes",
+    required=False,
+    type=str,
+    default=None,
+    help="Comma-separated list of chromosomes to keep, e.g. chr1,chr2. Default: all",
+)
+@click.option(
+    "--set-id",
+    is_flag=True,
+    help="Set the ID of every record to CHROM_POS_REF_ALT (first ALT)",
+)
+@click.option(
+    "--biallelic",
+    is_flag=True,
+    help="Keep only biallelic records (vcftools --min-alleles 2 --max-alleles 2)",
 )
-def main(annotated_vcf, out):
-    """This script applies GATK best practice filter. It will be applied to CHUNK_SIZE variants at a time.
-    The intermediate filtered VCF files are gzipped and merged in the end. This prevents the creation of an
-    uncompressed VCF containing all variants.
+@click.option(
+    "--min-qual",
+    required=False,
+    type=float,
+    default=None,
+    help="Minimum QUAL (vcftools --minQ)",
+)
+@click.option(
+    "--min-dp",
+    required=False,
+    type=int,
+    default=None,
+    help="Genotypes with a lower DP are set to missing (vcftools --minDP)",
+)
+@click.option(
+    "--max-missing",
+    required=False,
+    type=float,
+    default=None,
+    help="Minimum proportion of called alleles, between 0 and 1 (vcftools --max-missing)",
+)
+@click.option(
+    "--mac",
+    required=False,
+    type=int,
+    default=None,
+    help="Minimum minor allele count (vcftools --mac)",
+)
+@click.option(
+    "--popmap",
+    required=False,
+    type=str,
+    default=None,
+    help="Tab-separated file of samples and population designations. Enables the HWE filter (see filter_hwe.py)",
+)
+@click.option(
+    "--hwe",
+    required=False,
+    type=float,
+    default=0.001,
+    show_default=True,
+    help="Minimum Hardy-Weinberg p-value of a locus in a population",
+)
+@click.option(
+    "--hwe-cutoff",
+    required=False,
+    type=float,
+    default=0.25,
+    show_default=True,
+    help="Proportion of populations in which a locus can be below the HWE p-value without being filtered",
+)
+@click.option(
+    "--hwe-report",
+    required=False,
+    type=str,
+    default=None,
+    help="Output file with the HWE test over all samples for the loci removed by the HWE filter",
+)
+@click.option(
+    "--funnel",
+    required=False,
+    type=str,
+    default=None,
+    help="Output TSV with the number of records removed by each filter",
+)
+@click.option(
+    "-t",
+    "--threads",
+    required=False,
+    type=int,
+    default=6,
+    show_default=True,
+    help="Number of threads that compress the output",
+)
+@click.option(
+    "--profile",
+    required=False,
+    type=str,
+    default=None,
+    help="Write wall time, calls and throughput of every phase of the script to this JSON file",
+)
+@click.option(
+    "--cprofile",
+    required=False,
+    type=str,
+    default=None,
+    help="Write cProfile stats (pstats) to this file",
+)
+def main(annotated_vcf, out, chromosomes, set_id, biallelic, min_qual, min_dp, max_missing, mac,
+         popmap, hwe, hwe_cutoff, hwe_report, funnel, threads, profile, cprofile):
+    """This script applies GATK best practice filter. Optionally, the chromosome selection, ID assignment,
+    site QC (vcftools) and HWE filters that precede it are applied in the same pass, in the order of FILTER_STEPS.
+    Only the final VCF is written. It is compressed by a pool of threads while the input is read, and tabix indexed.
 
     GATK best practices filters
     - Include SNPs: QD > 2.0, FS < 60, MQRankSum > -12.5, ReadPosRankSum > -8.0, SOR <= 3
@@ -62,109 +332,107 @@ def main(annotated_vcf, out):
 
     python apply_gatk_filter.py -a annotated_vcf.vcf.gz -o annotated_vcf_filtered.vcf.gz
 
+    python apply_gatk_filter.py -a joint_called.vcf.gz -o filtered.vcf.gz --chromosomes chr1,chr2 --set-id --biallelic
+    --min-qual 90 --min-dp 10 --max-missing 0.9 --mac 1 --popmap popmap.txt --funnel filtering_funnel.tsv
+
     """
 
-    vcf_obj = vcf_parser.Vcf(annotated_vcf)
+    profiler = get_profiler(profile, cprofile)
+    vcf_obj = VcfReader(annotated_vcf)
 
-    num_variants = 0
-    num_excluded = 0
+    keep_chromosomes = set(chromosomes.split(",")) if chromosomes else None
+    site_qc = SiteQC(min_dp, max_missing, mac)
+    genotype_filters = min_dp is not None or max_missing is not None or mac is not None
+    filter_funnel = FilterFunnel()
     num_missing_tags = 0
 
+    f_hwe_report = None
+    hwe_filter = None
+    if popmap:
+        counter = PopulationCounter(vcf_obj.header.IDs_genotypes, read_popmap(popmap))
+        print(f"HWE filtering: p-value < {hwe} in more than {hwe_cutoff} of the populations {', '.join(counter.populations)}")
+        if hwe_report:
+            f_hwe_report = open(hwe_report, "w")
+            f_hwe_report.write(REPORT_HEADER)
+        hwe_filter = HWEFilter(counter, hwe, hwe_cutoff, f_hwe_report, profiler)
 
     print(f"SNP filtering: FS < {FS_SNP}, InbreedingCoeff > {INBREEDING}, MQRankSum > {MQ_RANK_SUM}, QD > {QD}, ReadPosRankSum > {READ_POS_RANK_SUM_SNP}, SOR <= {SOR_SNP}")
     print(f"INDEL filtering: FS < {FS_INDEL}, QD > {QD}, ReadPosRankSum > {READ_POS_RANK_SUM_INDEL}, SOR <= {SOR_INDEL}")
 
-    chunk = 0
-    chunk_files = []
-    f_out = None
-
-    for record in vcf_obj.parse_variants():
-        
-        if num_variants % CHUNK_SIZE == 0:
-            compress_and_close_chunk(chunk-1, f_out)
-            chunk_file = f"{CHUNK_PREFIX}_{chunk}.vcf"
-            f_out = open(chunk_file, "w")
-            chunk_files.append(f"{chunk_file}.gz")
-            vcf_obj.write_header(f_out)
-            chunk += 1
-        
-        num_variants += 1
-
-        try:
-            id = record.ID
-            ref = record.REF
-            alt = record.ALT
-
-            is_indel = len(ref) > 1 or len(alt) > 1
-
-            v_fs = float(record.get_tag_value("FS"))
-            v_inbreeding = float(record.get_tag_value("InbreedingCoeff"))
-            v_mqrs = float(record.get_tag_value("MQRankSum"))
-            v_qd = float(record.get_tag_value("QD"))
-            v_rprs = float(record.get_tag_value("ReadPosRankSum"))
-            v_sor = float(record.get_tag_value("SOR"))
-
-            # Replace * with -. VEP does not work for record.ALT=="*"
-            record.ALT = alt.replace("*", "-")
-            record.ID = id.replace("*", "-")
-
-            if is_indel and (
-                v_fs < FS_INDEL
-                and v_qd > QD
-                and v_rprs > READ_POS_RANK_SUM_INDEL
-                and v_sor <= SOR_INDEL
-            ):
-                vcf_obj.write_variant(f_out, record)
-            elif (not is_indel) and (
-                v_fs < FS_SNP
-                and v_inbreeding > INBREEDING
-                and v_mqrs > MQ_RANK_SUM
-                and v_qd > QD
-                and v_rprs > READ_POS_RANK_SUM_SNP
-                and v_sor <= SOR_SNP
-            ):
-                vcf_obj.write_variant(f_out, record)
+    def write_passing(records):
+        ''' applies the GATK filter to records that passed the previous filters and writes them '''
+        nonlocal num_missing_tags
+        t = profiler.start()
+        for record in records:
+            try:
+                passes = passes_gatk_filter(record)
+            except ValueError: # This is thrown by Granite if the tag is not there
+                num_missing_tags += 1
+                passes = False
+            except Exception:
+                raise Exception(
+                    "\nERROR applying GATK filter for variant {0}\n".format(record.ID)
+                )
+            t = profiler.lap("gatk_filter", t)
+            if passes:
+                f_out.write_record(record.to_string())
+                t = profiler.lap("write", t)
             else:
-                #print(id, is_indel, v_fs, v_inbreeding, v_mqrs, v_qd, v_rprs, v_sor)
-                num_excluded += 1
-            
-        except ValueError: # This is thrown by Granite if the tag is not there
-            num_missing_tags += 1
-            num_excluded += 1
-            pass
-        except Exception:
-            raise Exception(
-                "\nERROR applying GATK filter for variant {0}\n".format(id)
-            )
-
-    compress_and_close_chunk(chunk-1, f_out)
-    # Files need to be in the correct order to produce a sorted vcf. This is required for tabix to work.
-    cmd_result = os.system(f"bcftools concat {' '.join(chunk_files)} -o {out} --threads 6 -O z  || exit 1") 
-    if cmd_result > 0: # exit status shows error
-        raise Exception(f"bcftools concat command failed.")
-    cmd_result = os.system(f"tabix -p vcf -f {out} || exit 1")
-    if cmd_result > 0: # exit status shows error
-        raise Exception(f"tabix command failed.")
-    os.system(f"rm -f {CHUNK_PREFIX}*")
-
-    # Merge chunks and then remove them
+                filter_funnel.remove("gatk")
+
+    with BgzfWriter(out, TabixIndex(), threads=threads) as f_out:
+        vcf_obj.write_header(f_out)
+
+        for record in profiler.iterate("read_vcf", vcf_obj.parse_variants()):
+            filter_funnel.num_variants += 1
+            profiler.count("variants")
+
+            t = profiler.start()
+            if keep_chromosomes is not None and record.CHROM not in keep_chromosomes:
+                filter_funnel.remove("chromosomes")
+                continue
+            if set_id:
+                record.ID = f"{record.CHROM}_{record.POS}_{record.REF}_{record.ALT.split(',')[0]}"
+            if biallelic and ("," in record.ALT or record.ALT == "."):
+                filter_funnel.remove("biallelic")
+                continue
+            if min_qual is not None and qual(record) < min_qual:
+                filter_funnel.remove("min_qual")
+                continue
+            gts = None
+            if genotype_filters:
+                gts = site_qc.genotypes(record)
+                failed = site_qc.failed_filter(record, gts)
+                if failed:
+                    filter_funnel.remove(failed)
+                    profiler.lap("site_qc", t)
+                    continue
+            profiler.lap("site_qc", t)
+
+            if hwe_filter is None:
+                write_passing([record])
+            else:
+                write_passing(hwe_filter.add(record, gts))
+
+        if hwe_filter is not None:
+            write_passing(hwe_filter.flush())
+            filter_funnel.remove("hwe", hwe_filter.num_removed)
+            if f_hwe_report is not None:
+                f_hwe_report.close()
 
+        t = profiler.start()
+    profiler.lap("close", t)
 
+    num_variants = filter_funnel.num_variants
+    num_excluded = sum(filter_funnel.removed.values())
     print("GATK best practice filtering done.")
-    print(f"Original number of variants: {num_variants}")
+    for line in filter_funnel.lines():
+        print(line, end="")
     print(f"Variants excluded: {num_excluded}. {num_missing_tags} of those had missing tags.")
     print(f"New number of variants: {num_variants-num_excluded}")
-
-
-
-def compress_and_close_chunk(chunk:int, file_handle):
-    if chunk < 0 or not file_handle or file_handle.closed:
-        return
-    file_handle.close()
-    file_name = f"{CHUNK_PREFIX}_{chunk}.vcf"
-    os.system(f"bgzip --threads 6 -c {file_name} > {file_name}.gz || exit 1")
-    os.system(f"rm -f {file_name}")
-
+    if funnel:
+        filter_funnel.write(funnel)
+    profiler.write()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+################################################
+#   Libraries
+################################################
+
+import click
+import numpy as np
+from bgzf import BgzfWriter, TabixIndex
+from vcf_reader import VcfReader
+from hwe import GENOTYPE_CODES, OTHER, HOM_REF, HET, HOM_ALT, hwe_exact_batch, expected_genotypes
+from profiler import NullProfiler, get_profiler
+
+
+################################################
+#   Top level variables
+################################################
+
+# Number of records whose HWE p-values are computed at once
+HWE_BATCH_SIZE = 10000
+
+REPORT_HEADER = "CHR\tPOS\tOBS(HOM1/HET/HOM2)\tE(HOM1/HET/HOM2)\tChiSq_HWE\tP_HWE\tP_HET_DEFICIT\tP_HET_EXCESS\tPOPULATIONS_BELOW_HWE\n"
+
+
+################################################
+#   Classes
+################################################
+
+class PopulationCounter(object):
+    '''
+    Counts the genotypes of every population of the popmap in a single pass over
+    the sample columns of a record. Samples that are not in the popmap are only
+    counted for the whole cohort.
+    '''
+
+    def __init__(self, IDs_genotypes, popmap):
+        self.populations = sorted(set(popmap.values()))
+        pop_index = {pop: i for i, pop in enumerate(self.populations)}
+        unassigned = len(self.populations)
+        # Bin of each sample column: population * number of genotype codes
+        self.offsets = np.array([
+            pop_index.get(popmap.get(id), unassigned) * (OTHER + 1) for id in IDs_genotypes
+        ], dtype=np.int64)
+        self.n_bins = (len(self.populations) + 1) * (OTHER + 1)
+
+    def count(self, record):
+        ''' returns an array of shape (populations + 1, 4) with the genotype counts, unassigned samples last '''
+        sample_cols = record.sample_columns
+        GT_idx = record.FORMAT.split(":").index("GT")
+        if GT_idx == 0:
+            gts = [sample_col.partition(":")[0] for sample_col in sample_cols]
+        else:
+            gts = [sample_col.split(":")[GT_idx] for sample_col in sample_cols]
+        return self.count_genotypes(gts)
+
+    def count_genotypes(self, gts):
+        ''' same as count, for the GT values of the record in the order of the sample columns '''
+        gt_codes = [GENOTYPE_CODES.get(gt, OTHER) for gt in gts]
+        return np.bincount(self.offsets + gt_codes, minlength=self.n_bins).reshape(-1, OTHER + 1)
+
+
+class HWEFilter(object):
+    '''
+    Collects records in batches and computes the HWE exact test for every population
+    at once. add() and flush() return the records of a completed batch that pass, in order.
+
+    As with filter_hwe_by_pop.pl, a record fails in a population if its p-value is
+    below hwe, and all records at a position are removed if the number of failures
+    at that position divided by the number of populations is above cutoff.
+    Only biallelic records are tested.
+    '''
+
+    def __init__(self, counter, hwe, cutoff, f_report=None, profiler=None):
+        self.counter = counter
+        self.n_populations = len(counter.populations)
+        self.hwe = hwe
+        self.cutoff = cutoff
+        self.f_report = f_report
+        self.profiler = profiler or NullProfiler()
+        self.records = []
+        self.counts = []
+        self.num_variants = 0
+        self.num_removed = 0
+
+    def add(self, record, gts=None):
+        '''
+        adds a record. Records of the same position must be added consecutively.
+        gts are the GT values of the record, if they are known already
+        '''
+        passed = []
+        if len(self.records) >= HWE_BATCH_SIZE:
+            last = self.records[-1]
+            if (last.CHROM, last.POS) != (record.CHROM, record.POS):
+                passed = self.flush()
+        t = self.profiler.start()
+        self.records.append(record)
+        if gts is None:
+            self.counts.append(self.counter.count(record))
+        else:
+            self.counts.append(self.counter.count_genotypes(gts))
+        self.num_variants += 1
+        self.profiler.lap("count_genotypes", t)
+        return passed
+
+    def flush(self):
+        if not self.records:
+            return []
+        profiler = self.profiler
+        t = profiler.start()
+        counts = np.stack(self.counts)
+        biallelic = np.array([
+            "," not in record.ALT and record.ALT != "." for record in self.records
+        ])
+
+        pop_counts = counts[:, :self.n_populations]
+        p_hwe, _, _ = hwe_exact_batch(pop_counts[..., HOM_REF], pop_counts[..., HET], pop_counts[..., HOM_ALT])
+        below_hwe = (p_hwe.reshape(len(self.records), self.n_populations) < self.hwe) & biallelic[:, None]
+        failures = below_hwe.sum(axis=1)
+
+        # Failures are counted per position, over all records at that position
+        exclude = np.zeros(len(self.records), dtype=bool)
+        start = 0
+        for i in range(1, len(self.records) + 1):
+            if i == len(self.records) or \
+               (self.records[i].CHROM, self.records[i].POS) != (self.records[start].CHROM, self.records[start].POS):
+                if failures[start:i].sum() / self.n_populations > self.cutoff:
+                    exclude[start:i] = True
+                start = i
+        t = profiler.lap("hwe_test", t, len(self.records))
+
+        if self.f_report is not None:
+            self.write_report(counts, below_hwe, biallelic, exclude)
+            profiler.lap("report", t)
+
+        passed = [record for record, excluded in zip(self.records, exclude) if not excluded]
+        self.num_removed += len(self.records) - len(passed)
+        self.records = []
+        self.counts = []
+        return passed
+
+    def write_report(self, counts, below_hwe, biallelic, exclude):
+        ''' writes the HWE test over all samples, as vcftools --hardy does, for the removed biallelic records '''
+        idx = np.flatnonzero(exclude & biallelic)
+        if len(idx) == 0:
+            return
+        cohort_counts = counts[idx].sum(axis=1)
+        p_hwe, p_lo, p_hi = hwe_exact_batch(cohort_counts[:, HOM_REF], cohort_counts[:, HET], cohort_counts[:, HOM_ALT])
+        for j, i in enumerate(idx):
+            record = self.records[i]
+            hom1, het, hom2 = cohort_counts[j, :OTHER].tolist()
+            expected, chisq = expected_genotypes(hom1, het, hom2)
+            populations = ",".join(pop for pop, below in zip(self.counter.populations, below_hwe[i]) if below)
+            self.f_report.write(
+                f"{record.CHROM}\t{record.POS}\t{hom1}/{het}/{hom2}\t"
+                f"{expected[0]:.2f}/{expected[1]:.2f}/{expected[2]:.2f}\t"
+                f"{chisq:g}\t{p_hwe[j]:g}\t{p_lo[j]:g}\t{p_hi[j]:g}\t{populations}\n"
+            )
+
+
+################################################
+#   Functions
+################################################
+
+def read_popmap(popmap_file):
+    ''' returns {sample_id: population} from a whitespace-separated popmap file '''
+    popmap = {}
+    with open(popmap_file) as f:
+        for line in f:
+            if not line.strip() or line[0].isspace():
+                continue
+            sample_id, population = line.split()[:2]
+            popmap[sample_id] = population
+    return popmap
+
+
+def write_records(f_out, records, profiler):
+    if records:
+        t = profiler.start()
+        for record in records:
+            f_out.write_record(record.to_string())
+        profiler.lap("write", t, len(records))
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("-v", "--vcf", required=True, type=str, help="Input VCF file (gzipped)")
+@click.option("-p", "--popmap", required=True, type=str, help="Tab-separated file of samples and population designations")
+@click.option("-o", "--out", required=True, type=str, help="Output VCF file (bgzipped and tabix indexed)")
+@click.option("--hwe", default=0.001, type=float, show_default=True, help="Minimum Hardy-Weinberg p-value of a locus in a population")
+@click.option("-c", "--cutoff", default=0.25, type=float, show_default=True, help="Proportion of populations in which a locus can be below the HWE p-value without being filtered")
+@click.option("-r", "--report", default="filtered.hwe", type=str, show_default=True, help="Output file with the HWE test over all samples for the filtered loci")
+@click.option("--profile", required=False, type=str, default=None, help="Write wall time, calls and throughput of every phase of the script to this JSON file")
+@click.option("--cprofile", required=False, type=str, default=None, help="Write cProfile stats (pstats) to this file")
+def main(vcf, popmap, out, hwe, cutoff, report, profile, cprofile):
+    """Filters loci that are out of Hardy-Weinberg equilibrium in more than a proportion of the populations.
+    Replaces filter_hwe_by_pop.pl, which ran vcftools --hardy once per population and then twice more
+    to filter and report. Here the VCF is read once, genotypes are counted per population in a single
+    sweep and the exact HWE test is computed in vectorized batches.
+
+    Example usage:
+
+    python filter_hwe.py -v input.vcf.gz -p popmap.txt -o output.vcf.gz --hwe 0.001 -c 0.25
+
+    """
+    profiler = get_profiler(profile, cprofile)
+    vcf_obj = VcfReader(vcf)
+    sample_popmap = read_popmap(popmap)
+    counter = PopulationCounter(vcf_obj.header.IDs_genotypes, sample_popmap)
+
+    samples_in_vcf = set(vcf_obj.header.IDs_genotypes)
+    for population in counter.populations:
+        samples = [id for id, pop in sample_popmap.items() if pop == population]
+        found = sum(1 for id in samples if id in samples_in_vcf)
+        print(f"Processing population: {population} ({len(samples)} inds, {found} in VCF)")
+
+    with BgzfWriter(out, TabixIndex()) as f_out, open(report, "w") as f_report:
+        vcf_obj.write_header(f_out)
+        f_report.write(REPORT_HEADER)
+        hwe_filter = HWEFilter(counter, hwe, cutoff, f_report, profiler)
+        for record in profiler.iterate("read_vcf", vcf_obj.parse_variants()):
+            write_records(f_out, hwe_filter.add(record), profiler)
+            profiler.count("variants")
+        write_records(f_out, hwe_filter.flush(), profiler)
+
+    print(f"Outputting results of HWE test for filtered loci to '{report}'")
+    num_kept = hwe_filter.num_variants - hwe_filter.num_removed
+    print(f"Kept {num_kept} of a possible {hwe_filter.num_variants} loci (removed {hwe_filter.num_removed} loci)")
+    profiler.write()
+
+
+if __name__ == "__main__":
+    main()
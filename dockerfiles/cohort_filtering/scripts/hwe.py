@@ -0,0 +1,122 @@
+################################################
+#   Libraries
+################################################
+
+import numpy as np
+from scipy.special import gammaln
+
+
+################################################
+#   Top level variables
+################################################
+
+# Genotype codes used for counting. Anything else (missing, partially missing,
+# haploid or multiallelic calls) is not counted, as in vcftools --hardy
+HOM_REF, HET, HOM_ALT, OTHER = 0, 1, 2, 3
+GENOTYPE_CODES = {
+    "0/0": HOM_REF, "0|0": HOM_REF,
+    "0/1": HET, "1/0": HET, "0|1": HET, "1|0": HET,
+    "1/1": HOM_ALT, "1|1": HOM_ALT,
+}
+
+# Heterozygote counts whose probability is within this relative distance of the
+# observed one are treated as equally likely (ties of the exact test)
+TIE_TOLERANCE = 1e-9
+
+# Maximum number of cells (tables x possible heterozygote counts) computed at once
+MAX_BATCH_CELLS = 1 << 22
+
+
+################################################
+#   Functions
+################################################
+
+def hwe_exact_batch(hom1, het, hom2):
+    '''
+    Vectorized exact test for Hardy-Weinberg equilibrium (Wigginton et al. 2005),
+    as computed by vcftools --hardy, for arrays of genotype counts.
+
+    Returns three flat float arrays: p_hwe, p_het_deficit and p_het_excess.
+    Tables without called genotypes get p-values of 1.
+
+    The probability of every possible heterozygote count given the number of
+    minor alleles is evaluated in log space from log-factorials, for all distinct
+    tables at once, and then normalized.
+    '''
+    tables = np.stack([
+        np.asarray(hom1, dtype=np.int64).ravel(),
+        np.asarray(het, dtype=np.int64).ravel(),
+        np.asarray(hom2, dtype=np.int64).ravel(),
+    ], axis=1)
+    p_hwe = np.ones(len(tables))
+    p_lo = np.ones(len(tables))
+    p_hi = np.ones(len(tables))
+    if len(tables) == 0:
+        return p_hwe, p_lo, p_hi
+
+    # Rare variants produce the same few tables over and over
+    unique, inverse = np.unique(tables, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    u_hwe = np.ones(len(unique))
+    u_lo = np.ones(len(unique))
+    u_hi = np.ones(len(unique))
+
+    obs_het = unique[:, 1]
+    obs_homr = np.minimum(unique[:, 0], unique[:, 2])
+    n = unique.sum(axis=1)
+    rare = 2 * obs_homr + obs_het
+
+    log_factorials = gammaln(np.arange(n.max() + 2, dtype=np.float64) + 1)
+
+    # Tables are processed ordered by number of minor alleles, in batches of bounded size
+    order = np.flatnonzero(n > 0)
+    order = order[np.argsort(rare[order], kind="stable")]
+    widths = rare[order] + 1
+    start = 0
+    while start < len(order):
+        # Largest batch whose tables x widest table stays below MAX_BATCH_CELLS
+        cells = np.arange(1, len(order) - start + 1) * widths[start:]
+        stop = start + max(1, int(np.searchsorted(cells, MAX_BATCH_CELLS, side="right")))
+        idx = order[start:stop]
+        u_hwe[idx], u_lo[idx], u_hi[idx] = _hwe_exact(obs_het[idx], rare[idx], n[idx], widths[stop - 1], log_factorials)
+        start = stop
+
+    return u_hwe[inverse], u_lo[inverse], u_hi[inverse]
+
+
+def _hwe_exact(obs_het, rare, n, width, log_factorials):
+    ''' exact test for tables with the given number of minor alleles, one row per table '''
+    h = np.arange(width)[None, :]
+    rare_ = rare[:, None]
+    n_ = n[:, None]
+    # Possible heterozygote counts have the same parity as the number of minor alleles
+    valid = (h <= rare_) & ((rare_ - h) % 2 == 0)
+    homr = np.where(valid, (rare_ - h) // 2, 0)
+    homc = np.where(valid, n_ - h - homr, 0)
+    log_p = (h * np.log(2.0) - log_factorials[np.where(valid, h, 0)]
+             - log_factorials[homr] - log_factorials[homc])
+    log_p = np.where(valid, log_p, -np.inf)
+    probs = np.exp(log_p - log_p.max(axis=1, keepdims=True))
+    probs /= probs.sum(axis=1, keepdims=True)
+
+    rows = np.arange(len(obs_het))
+    p_obs = probs[rows, obs_het][:, None]
+    p_hwe = np.minimum(1.0, np.where(probs <= p_obs * (1 + TIE_TOLERANCE), probs, 0).sum(axis=1))
+    p_lo = np.minimum(1.0, np.where(h <= obs_het[:, None], probs, 0).sum(axis=1))
+    p_hi = np.minimum(1.0, np.where(h >= obs_het[:, None], probs, 0).sum(axis=1))
+    return p_hwe, p_lo, p_hi
+
+
+def expected_genotypes(hom1, het, hom2):
+    ''' expected genotype counts under HWE and the chi-squared statistic, as reported by vcftools --hardy '''
+    n = hom1 + het + hom2
+    if n == 0:
+        return (0.0, 0.0, 0.0), float("nan")
+    p = (2 * hom1 + het) / (2 * n)
+    q = 1 - p
+    expected = (n * p * p, 2 * n * p * q, n * q * q)
+    chisq = 0.0
+    for obs, exp in zip((hom1, het, hom2), expected):
+        if exp > 0:
+            chisq += (obs - exp) ** 2 / exp
+    return expected, chisq
@@ -55,50 +55,34 @@ echo ""
 echo "== Run Peddy to infer ancestry =="
 sample_info=$(python "$SCRIPT_LOCATION"/run_peddy.py -a "$joint_called_vcf" -s "$sample_info" || exit 1)
 
-# Remove chrM - regenie does not work with it
 echo ""
-echo "== Removing unsupported chromosomes =="
-bcftools --version
-bcftools filter "$joint_called_vcf" -r chr1,chr2,chr3,chr4,chr5,chr6,chr7,chr8,chr9,chr10,chr11,chr12,chr13,chr14,chr15,chr16,chr17,chr18,chr19,chr20,chr21,chr22,chrX,chrY --threads 6 -O z > tmp.no_chrM.vcf.gz || exit 1
-#bcftools filter "$joint_called_vcf" -r chr1 -O z > tmp.no_chrM.vcf.gz || exit 1
-bcftools index -t tmp.no_chrM.vcf.gz --threads 6 || exit 1
-
-
-# Assign an ID to each variants - existing IDs will be overwritten as these can contain duplicate IDs
-echo ""
-echo "== Assigning unique ID to each variant =="
-#bcftools annotate --set-id '%CHROM\_%POS\_%REF\_%FIRST_ALT' tmp.no_chrM.vcf.gz > tmp.no_chrM.id.vcf || exit 1
-bcftools annotate --set-id '%CHROM\_%POS\_%REF\_%FIRST_ALT' tmp.no_chrM.vcf.gz --threads 6 -O z > tmp.no_chrM.id.vcf.gz || exit 1
-bcftools index -t tmp.no_chrM.id.vcf.gz --threads 6 || exit 1
-
-rm -f tmp.no_chrM.vcf.gz
-
-# Perform variant and sample filtering
-echo ""
-echo "== Performing variant filtering =="
-vcftools --gzvcf tmp.no_chrM.id.vcf.gz \
-         --recode \
-         --recode-INFO-all \
-         --max-missing 0.9 \
-         --min-alleles 2 \
-         --max-alleles 2 \
-         --minQ 90 \
-         --minDP 10 \
-         --mac 1 --stdout | gzip -c > tmp.no_chrM.id.filtered.recode.vcf.gz || exit 1
-
-rm -f tmp.no_chrM.id.vcf.gz
-
-echo ""
-echo "== Perform Hardy-Weinberg filtering by population =="
+echo "== Create population map for Hardy-Weinberg filtering =="
 python "$SCRIPT_LOCATION"/create_hwe_popmap.py -s "$sample_info" -o tmp.popmap.txt || exit 1
-"$SCRIPT_LOCATION"/filter_hwe_by_pop.pl -v tmp.no_chrM.id.filtered.recode.vcf.gz -p tmp.popmap.txt -o tmp.no_chrM.id.hwe.vcf.gz || exit 1
-rm -f tmp.no_chrM.id.filtered.recode.vcf.gz
 
+# All filters are applied in a single pass over the VCF, in this order:
+#  - Remove unsupported chromosomes (e.g. chrM - regenie does not work with it)
+#  - Assign a unique ID (CHROM_POS_REF_ALT) to each variant - existing IDs will be overwritten as these can contain duplicate IDs
+#  - Variant filtering, as vcftools --max-missing 0.9 --min-alleles 2 --max-alleles 2 --minQ 90 --minDP 10 --mac 1
+#  - Hardy-Weinberg filtering by population
+#  - GATK best practice filter
+# The number of variants removed by each filter is written to filtering_funnel.tsv
 echo ""
-echo "== Apply GATK best practice filter =="
+echo "== Performing variant, Hardy-Weinberg and GATK best practice filtering =="
 # This will also index the output file
-python "$SCRIPT_LOCATION"/apply_gatk_filter.py -a tmp.no_chrM.id.hwe.vcf.gz -o joint_called_vcf_filtered.vcf.gz || exit 1
-rm -f tmp.no_chrM.id.hwe.vcf.gz
+python "$SCRIPT_LOCATION"/apply_gatk_filter.py -a "$joint_called_vcf" \
+                                               -o joint_called_vcf_filtered.vcf.gz \
+                                               --chromosomes chr1,chr2,chr3,chr4,chr5,chr6,chr7,chr8,chr9,chr10,chr11,chr12,chr13,chr14,chr15,chr16,chr17,chr18,chr19,chr20,chr21,chr22,chrX,chrY \
+                                               --set-id \
+                                               --biallelic \
+                                               --min-qual 90 \
+                                               --min-dp 10 \
+                                               --max-missing 0.9 \
+                                               --mac 1 \
+                                               --popmap tmp.popmap.txt \
+                                               --hwe 0.001 \
+                                               --hwe-cutoff 0.25 \
+                                               --hwe-report filtered.hwe \
+                                               --funnel filtering_funnel.tsv || exit 1
 
 echo ""
 echo "== DONE =="
@@ -0,0 +1,201 @@
+################################################
+#   Libraries
+################################################
+
+import gzip
+import io
+from granite.lib import vcf_parser
+from granite.lib.vcf_parser import MissingTag, TagFormatError, VcfFormatError
+
+
+################################################
+#   Top level variables
+################################################
+
+# Marks a tag that is not in INFO, None marks a flag
+_MISSING = object()
+
+
+################################################
+#   Classes
+################################################
+
+class LazyVariant(object):
+    '''
+    Drop-in for granite Vcf.Variant that does not parse more than it is asked for.
+
+    Only the fixed columns are split when the record is created. INFO is parsed
+    into a dict the first time a tag is requested, sample columns are split when
+    they are first accessed, by index (sample_columns, get_sample) or by sample
+    ID (GENOTYPES, built as in granite).
+
+    to_string returns the raw line as long as the fixed columns are unchanged
+    and GENOTYPES has not been built. Otherwise the record is rebuilt from its
+    attributes, as granite does.
+    '''
+
+    __slots__ = (
+        "CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT",
+        "IDs_genotypes", "_line", "_fixed", "_samples", "_sample_cols",
+        "_genotypes", "_info", "_info_src",
+    )
+
+    def __init__(self, line_strip, IDs_genotypes):
+        if IDs_genotypes:
+            fields = line_strip.split("\t", 9)
+            if len(fields) < 9:
+                raise VcfFormatError(
+                    f"\nERROR in variant VCF structure, missing FORMAT column for variant\n{line_strip}\n"
+                )
+            self._samples = fields[9] if len(fields) == 10 else None
+            n_found = self._samples.count("\t") + 1 if self._samples is not None else 0
+            if n_found != len(IDs_genotypes):
+                raise VcfFormatError(
+                    f"\nERROR in variant VCF structure, expected {len(IDs_genotypes)} sample columns "
+                    f"but found {n_found} for variant\n{line_strip}\n"
+                )
+            self.FORMAT = fields[8]
+            # Same line as granite would write
+            self._line = line_strip
+        else:
+            fields = line_strip.split("\t", 8)
+            self._samples = None
+            self.FORMAT = ""
+            # granite drops the columns after INFO of records without samples
+            self._line = line_strip if len(fields) == 8 else None
+        self.CHROM = fields[0]
+        self.POS = int(fields[1])
+        self.ID = fields[2]
+        self.REF = fields[3]
+        self.ALT = fields[4]
+        self.QUAL = fields[5]
+        self.FILTER = fields[6]
+        self.INFO = fields[7]
+        self.IDs_genotypes = IDs_genotypes
+        self._fixed = (self.CHROM, self.POS, self.ID, self.REF, self.ALT, self.QUAL, self.FILTER, self.INFO, self.FORMAT)
+        self._sample_cols = None
+        self._genotypes = None
+        self._info = None
+        self._info_src = None
+
+    @property
+    def sample_columns(self):
+        ''' list of the sample columns, in the order of IDs_genotypes '''
+        if self._sample_cols is None:
+            if self._genotypes is not None:
+                self._sample_cols = [self._genotypes[id] for id in self.IDs_genotypes]
+            else:
+                self._sample_cols = self._samples.split("\t") if self._samples is not None else []
+        return self._sample_cols
+
+    @property
+    def raw_samples(self):
+        ''' sample columns as a single tab separated string, as in the line if they were not changed '''
+        if self._genotypes is not None or self._sample_cols is not None:
+            return "\t".join(self.sample_columns)
+        return self._samples if self._samples is not None else ""
+
+    def get_sample(self, idx):
+        ''' sample column at index idx of IDs_genotypes '''
+        return self.sample_columns[idx]
+
+    @property
+    def GENOTYPES(self):
+        ''' {sample ID: sample column}, changes to the dict are written by to_string '''
+        if self._genotypes is None:
+            self._genotypes = dict(zip(self.IDs_genotypes, self.sample_columns))
+            # sample_columns is no longer kept in sync
+            self._sample_cols = None
+        return self._genotypes
+
+    @GENOTYPES.setter
+    def GENOTYPES(self, genotypes):
+        self._genotypes = genotypes
+        self._sample_cols = None
+
+    def is_modified(self):
+        ''' True if the record can not be written as its raw line '''
+        return self._line is None or self._genotypes is not None or \
+            (self.CHROM, self.POS, self.ID, self.REF, self.ALT, self.QUAL, self.FILTER, self.INFO, self.FORMAT) != self._fixed
+
+    def to_string(self):
+        ''' variant as string representation '''
+        if not self.is_modified():
+            return self._line + "\n"
+        variant_as_list = [self.CHROM, str(self.POS), self.ID, self.REF, self.ALT, self.QUAL, self.FILTER, self.INFO]
+        if self.IDs_genotypes:
+            variant_as_list.append(self.FORMAT)
+            if self._genotypes is not None:
+                variant_as_list.extend(self._genotypes[id] for id in self.IDs_genotypes)
+            elif self._samples is not None:
+                variant_as_list.append(self._samples)
+        return "\t".join(variant_as_list) + "\n"
+
+    def repr(self):
+        ''' variant representation as CHROM:POSREF>ALT '''
+        return f"{self.CHROM}:{self.POS}{self.REF}>{self.ALT}"
+
+    def info_dict(self):
+        ''' {tag: value} of INFO, None for flags. The first occurrence of a tag is kept '''
+        if self._info is None or self._info_src is not self.INFO:
+            info = {}
+            if self.INFO != ".":
+                for item in self.INFO.split(";"):
+                    if item:
+                        tag, is_value, value = item.partition("=")
+                        if tag not in info:
+                            info[tag] = value if is_value else None
+            self._info = info
+            self._info_src = self.INFO
+        return self._info
+
+    def get_tag_value(self, tag_to_get, is_flag=False, sep=";"):
+        ''' get value from tag (tag_to_get) in INFO, raises the same exceptions as granite '''
+        if sep != ";":
+            return vcf_parser.Vcf.Variant.get_tag_value(self, tag_to_get, is_flag, sep)
+        value = self.info_dict().get(tag_to_get, _MISSING)
+        if value is _MISSING:
+            if is_flag:
+                return False
+            raise MissingTag(f"\nERROR in variant INFO field, {tag_to_get} tag is missing\n")
+        if value is None:
+            if is_flag:
+                return True
+            raise TagFormatError(f"\nERROR in variant INFO field, {tag_to_get} tag is a flag, not key=value\n")
+        if is_flag:
+            raise TagFormatError(f"\nERROR in variant INFO field, {tag_to_get} tag is key=value, not a flag\n")
+        return value
+
+
+class VcfReader(vcf_parser.Vcf):
+    '''
+    granite Vcf that yields LazyVariant records. The header is parsed by granite,
+    records are read with buffered decompression and decoding, and unchanged
+    records are written back as their raw line.
+    '''
+
+    Variant = LazyVariant
+
+    @staticmethod
+    def read_vcf(inputfile):
+        ''' read vcf file, gzipped or ungzipped, return a generator '''
+        if inputfile.endswith(".gz") or inputfile.endswith(".bgz"):
+            with io.TextIOWrapper(gzip.open(inputfile, "rb"), encoding="utf-8") as f:
+                yield from f
+        else:
+            with open(inputfile, encoding="utf-8") as f:
+                yield from f
+
+    def parse_variants(self):
+        ''' return a generator to variants stored as LazyVariant objects '''
+        IDs_genotypes = self.header.IDs_genotypes
+        for line in self.read_vcf(self.inputfile):
+            if line[0] != "#":
+                line_strip = line.rstrip()
+                if line_strip:
+                    try:
+                        yield LazyVariant(line_strip, IDs_genotypes)
+                    except VcfFormatError:
+                        raise
+                    except Exception:
+                        raise VcfFormatError(f"\nERROR in variant VCF structure, malformed variant line:\n{line_strip}\n")
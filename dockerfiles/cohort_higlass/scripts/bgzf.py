@@ -0,0 +1,596 @@
+################################################
+#   Libraries
+################################################
+
+import gzip
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+################################################
+#   Top level variables
+################################################
+
+# Maximum uncompressed size of a BGZF block (same as bgzip)
+BGZF_BLOCK_SIZE = 0xff00
+
+# gzip header of a BGZF block with the BC extra field. The total block size - 1 is appended
+BGZF_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+
+# Empty BGZF block that marks the end of a file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Tabix binning index parameters
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+TBI_META_BIN = 37450
+
+# Tabix formats
+TBI_FORMAT_GENERIC = 0
+TBI_FORMAT_VCF = 2
+
+
+################################################
+#   Functions
+################################################
+
+def compress_block(data, level=6):
+    ''' compresses up to BGZF_BLOCK_SIZE bytes into a single BGZF block '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = len(BGZF_HEADER) + 2 + len(deflated) + 8
+    return b"".join([
+        BGZF_HEADER,
+        struct.pack("<H", block_size - 1),
+        deflated,
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)),
+    ])
+
+
+def reg2bin(beg, end):
+    ''' tabix bin of the 0-based, half-open interval [beg, end) '''
+    end -= 1
+    if beg >> 14 == end >> 14: return 4681 + (beg >> 14)
+    if beg >> 17 == end >> 17: return 585 + (beg >> 17)
+    if beg >> 20 == end >> 20: return 73 + (beg >> 20)
+    if beg >> 23 == end >> 23: return 9 + (beg >> 23)
+    if beg >> 26 == end >> 26: return 1 + (beg >> 26)
+    return 0
+
+
+def vcf_interval(line):
+    '''
+    Returns (chrom, beg, end) of a VCF data line as tabix -p vcf computes it:
+    0-based start, end from the length of REF or from INFO END=
+    '''
+    fields = line.split("\t", 8)
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    info = fields[7]
+    if info.startswith("END="):
+        end_str = info[4:]
+    else:
+        end_pos = info.find(";END=")
+        end_str = info[end_pos + 5:] if end_pos >= 0 else ""
+    if end_str and end_str[0] != ".":
+        end_str = end_str.split(";", 1)[0]
+        if end_str.isdigit() and int(end_str) > beg:
+            end = int(end_str)
+    return fields[0], beg, end
+
+
+def tsv_interval(line, col_seq, col_beg, col_end):
+    '''
+    Returns (chrom, beg, end) of a tab separated data line as tabix -s col_seq -b col_beg -e col_end
+    computes it (1-based columns): 0-based start, end from col_end or one base after the start if it is 0
+    '''
+    fields = line.rstrip("\n").split("\t", max(col_seq, col_beg, col_end))
+    beg = int(fields[col_beg - 1]) - 1
+    end = int(fields[col_end - 1]) if col_end else beg + 1
+    return fields[col_seq - 1], beg, end
+
+
+def read_tabix_contigs(index_file):
+    ''' returns the sequence names of a .tbi index in the order they appear in the indexed file '''
+    with gzip.open(index_file, "rb") as f_idx:
+        magic, n_ref = struct.unpack("<4si", f_idx.read(8))
+        if magic != b"TBI\x01":
+            raise ValueError(f"{index_file} is not a tabix index")
+        f_idx.read(24)  # format, col_seq, col_beg, col_end, meta, skip
+        l_nm, = struct.unpack("<i", f_idx.read(4))
+        names = f_idx.read(l_nm)
+    return [name.decode() for name in names.split(b"\x00")[:n_ref]]
+
+
+class TabixIndex(object):
+    '''
+    Builds a tabix (.tbi) index while records are written.
+    Records have to be pushed in coordinate order together with the
+    virtual offsets of their first byte and of the byte after them.
+    '''
+
+    def __init__(self, fmt=TBI_FORMAT_VCF, col_seq=1, col_beg=2, col_end=0, meta_char="#", skip=0):
+        self.fmt = fmt
+        self.col_seq = col_seq
+        self.col_beg = col_beg
+        self.col_end = col_end
+        self.meta_char = meta_char
+        self.skip = skip
+        self.names = []
+        self.bins = []    # per reference: {bin: [[beg_offset, end_offset], ...]}
+        self.linear = []  # per reference: [offset of the first record overlapping each 16kb window]
+        self.meta = []    # per reference: [first_offset, last_offset, n_records]
+        self.last_chrom = None
+        self.last_beg = -1
+
+    def push(self, chrom, beg, end, start_offset, end_offset):
+        ''' adds the record chrom:[beg, end) stored between the two virtual offsets '''
+        if chrom != self.last_chrom:
+            if chrom in self.names:
+                raise ValueError(f"Records are not sorted: {chrom} appears in two separate blocks")
+            self.names.append(chrom)
+            self.bins.append({})
+            self.linear.append([])
+            self.meta.append([start_offset, end_offset, 0])
+            self.last_chrom = chrom
+            self.last_beg = -1
+        elif beg < self.last_beg:
+            raise ValueError(f"Records are not sorted: {chrom}:{beg + 1} after {chrom}:{self.last_beg + 1}")
+        self.last_beg = beg
+
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        linear = self.linear[-1]
+        last_window = (max(end, beg + 1) - 1) >> TBI_MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> TBI_MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+        meta = self.meta[-1]
+        meta[1] = end_offset
+        meta[2] += 1
+
+    def push_vcf_line(self, line, start_offset, end_offset):
+        chrom, beg, end = vcf_interval(line)
+        self.push(chrom, beg, end, start_offset, end_offset)
+
+    def push_line(self, line, start_offset, end_offset):
+        ''' adds a data line, VCF or tab separated with the columns of the index '''
+        if self.fmt == TBI_FORMAT_VCF:
+            chrom, beg, end = vcf_interval(line)
+        else:
+            chrom, beg, end = tsv_interval(line, self.col_seq, self.col_beg, self.col_end)
+        self.push(chrom, beg, end, start_offset, end_offset)
+
+    def resolve_block_offsets(self, block_offsets):
+        '''
+        Replaces virtual offsets of the form (block number << 16 | offset in block)
+        by virtual offsets in the file, given the compressed offset of every block
+        '''
+        def resolve(offset):
+            return (block_offsets[offset >> 16] << 16) | (offset & 0xffff)
+
+        for bins in self.bins:
+            for chunks in bins.values():
+                for chunk in chunks:
+                    chunk[0], chunk[1] = resolve(chunk[0]), resolve(chunk[1])
+        self.linear = [[None if offset is None else resolve(offset) for offset in linear] for linear in self.linear]
+        self.meta = [[resolve(first_offset), resolve(last_offset), n_records] for first_offset, last_offset, n_records in self.meta]
+
+    def to_bytes(self):
+        ''' uncompressed content of the .tbi file '''
+        names = b"".join(name.encode() + b"\x00" for name in self.names)
+        out = [
+            b"TBI\x01",
+            struct.pack("<i", len(self.names)),
+            struct.pack("<6i", self.fmt, self.col_seq, self.col_beg, self.col_end, ord(self.meta_char), self.skip),
+            struct.pack("<i", len(names)),
+            names,
+        ]
+        for bins, linear, (first_offset, last_offset, n_records) in zip(self.bins, self.linear, self.meta):
+            out.append(struct.pack("<i", len(bins) + 1))
+            for bin_, chunks in sorted(bins.items()):
+                out.append(struct.pack("<Ii", bin_, len(chunks)))
+                out.extend(struct.pack("<QQ", beg, end) for beg, end in chunks)
+            out.append(struct.pack("<IiQQQQ", TBI_META_BIN, 2, first_offset, last_offset, n_records, 0))
+            # Windows without records point to the previous record
+            offsets, previous = [], 0
+            for offset in linear:
+                previous = offset if offset is not None else previous
+                offsets.append(previous)
+            out.append(struct.pack("<i", len(offsets)))
+            out.append(struct.pack(f"<{len(offsets)}Q", *offsets))
+        # Number of records without coordinates
+        out.append(struct.pack("<Q", 0))
+        return b"".join(out)
+
+    def write(self, index_file):
+        with BgzfWriter(index_file) as f_idx:
+            f_idx.write_bytes(self.to_bytes())
+
+    @classmethod
+    def read(cls, index_file):
+        ''' loads a .tbi index written by tabix or by this class '''
+        with gzip.open(index_file, "rb") as f_idx:
+            content = f_idx.read()
+        magic, n_ref = struct.unpack_from("<4si", content, 0)
+        if magic != b"TBI\x01":
+            raise ValueError(f"{index_file} is not a tabix index")
+        fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from("<7i", content, 8)
+        index = cls(fmt, col_seq, col_beg, col_end, chr(meta), skip)
+        pos = 36 + l_nm
+        index.names = [name.decode() for name in content[36:pos].split(b"\x00")[:n_ref]]
+
+        for _ in range(n_ref):
+            bins, meta = {}, None
+            n_bin, = struct.unpack_from("<i", content, pos)
+            pos += 4
+            for _ in range(n_bin):
+                bin_, n_chunk = struct.unpack_from("<Ii", content, pos)
+                pos += 8
+                chunks = [list(chunk) for chunk in struct.iter_unpack("<QQ", content[pos:pos + 16 * n_chunk])]
+                pos += 16 * n_chunk
+                if bin_ == TBI_META_BIN:
+                    meta = [chunks[0][0], chunks[0][1], chunks[1][0]]
+                else:
+                    bins[bin_] = chunks
+            n_intv, = struct.unpack_from("<i", content, pos)
+            pos += 4
+            linear = list(struct.unpack_from(f"<{n_intv}Q", content, pos))
+            pos += 8 * n_intv
+            if meta is None:
+                offsets = [chunk for chunks in bins.values() for chunk in chunks]
+                meta = [min(beg for beg, _ in offsets), max(end for _, end in offsets), 0] if offsets else [0, 0, 0]
+            index.bins.append(bins)
+            index.linear.append(linear)
+            index.meta.append(meta)
+        return index
+
+    def start_offset(self, chrom, beg):
+        '''
+        Virtual offset from which records of chrom starting at or after
+        the 0-based position beg can be read, or None if there are none
+        '''
+        if chrom not in self.names:
+            return None
+        rid = self.names.index(chrom)
+        linear = self.linear[rid]
+        window = beg >> TBI_MIN_SHIFT
+        if window >= len(linear):
+            return None
+        offset = linear[window]
+        # Windows without records may point to an earlier record or the start of the file
+        first_offset = self.meta[rid][0]
+        return first_offset if offset is None or offset < first_offset else offset
+
+    def balanced_regions(self, n_regions):
+        '''
+        Splits the indexed records into at most n_regions groups of about the same
+        compressed size, using the linear index. Each group is a list of
+        (chrom, start, end) regions (1-based, inclusive, end None for the end of chrom)
+        in file order, so that the groups together cover every record exactly once
+        if records are assigned to regions by their start position.
+        '''
+        # Compressed size of each 16kb window
+        costs = []
+        for linear, (first_offset, last_offset, _) in zip(self.linear, self.meta):
+            offsets, previous = [], first_offset
+            for offset in linear:
+                previous = max(previous, offset or 0)
+                offsets.append(previous >> 16)
+            offsets.append(last_offset >> 16)
+            costs.append([max(0, offsets[w + 1] - offsets[w]) for w in range(len(offsets) - 1)])
+        total = sum(sum(cost) for cost in costs)
+        target = total / n_regions if total else float("inf")
+
+        groups, group, size = [], [], 0
+        window_size = 1 << TBI_MIN_SHIFT
+        for chrom, cost in zip(self.names, costs):
+            start_window = 0
+            for window, window_cost in enumerate(cost):
+                size += window_cost
+                if size >= target and len(groups) < n_regions - 1:
+                    group.append((chrom, start_window * window_size + 1, (window + 1) * window_size))
+                    groups.append(group)
+                    group, size = [], 0
+                    start_window = window + 1
+            group.append((chrom, start_window * window_size + 1, None))
+        groups.append(group)
+        return [group for group in groups if group]
+
+
+class BgzfReader(object):
+    ''' Reads lines of a BGZF compressed file starting at a virtual offset '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.handle = open(file_name, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_raw_block(self):
+        ''' next block as (compressed block, decompressed content), None at the end of the file '''
+        header = self.handle.read(12)
+        if len(header) < 12:
+            return None
+        xlen, = struct.unpack("<H", header[10:12])
+        extra = self.handle.read(xlen)
+        block_size, pos = None, 0
+        while pos < xlen:
+            subfield_id, subfield_len = extra[pos:pos + 2], struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+            if subfield_id == b"BC":
+                block_size, = struct.unpack("<H", extra[pos + 4:pos + 6])
+            pos += 4 + subfield_len
+        if header[:2] != b"\x1f\x8b" or block_size is None:
+            raise ValueError(f"{self.file_name} is not BGZF compressed")
+        deflated = self.handle.read(block_size + 1 - 12 - xlen - 8)
+        trailer = self.handle.read(8) # CRC32 and size
+        return header + extra + deflated + trailer, zlib.decompress(deflated, -15)
+
+    def _read_block(self):
+        ''' decompressed content of the next block, None at the end of the file '''
+        block = self._read_raw_block()
+        return block[1] if block is not None else None
+
+    def blocks(self, offset=0):
+        '''
+        generator over (file offset, compressed block, decompressed content)
+        of the non-empty blocks starting at the file offset
+        '''
+        self.handle.seek(offset)
+        while True:
+            block_offset = self.handle.tell()
+            block = self._read_raw_block()
+            if block is None:
+                return
+            if block[1]:
+                yield block_offset, block[0], block[1]
+
+    def header(self, meta_char="#"):
+        '''
+        returns the header lines as text and the virtual offset of the first
+        data line (None if there are no data lines)
+        '''
+        meta_byte = meta_char.encode()
+        header = bytearray()
+        line_start = True
+        for block_offset, _, data in self.blocks(0):
+            pos = 0
+            while pos < len(data):
+                if line_start and data[pos:pos + 1] != meta_byte:
+                    return header.decode(), (block_offset << 16) | pos
+                newline = data.find(b"\n", pos)
+                end = newline + 1 if newline >= 0 else len(data)
+                header += data[pos:end]
+                line_start = newline >= 0
+                pos = end
+        return header.decode(), None
+
+    def lines(self, virtual_offset=0):
+        ''' generator over the lines starting at virtual_offset '''
+        self.handle.seek(virtual_offset >> 16)
+        data = self._read_block()
+        if data is None:
+            return
+        remainder = data[virtual_offset & 0xffff:]
+        while True:
+            data = self._read_block()
+            if data is None:
+                break
+            remainder += data
+            lines = remainder.split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line.decode() + "\n"
+        if remainder:
+            yield remainder.decode()
+
+    def fetch(self, index, chrom, start, end=None):
+        '''
+        generator over the data lines of chrom with a start position (1-based)
+        between start and end (inclusive, None for the end of chrom)
+        '''
+        offset = index.start_offset(chrom, start - 1)
+        if offset is None:
+            return
+        seen_chrom = False
+        for line in self.lines(offset):
+            if line.startswith(index.meta_char):
+                continue
+            fields = line.split("\t", 2)
+            if fields[0] != chrom:
+                if seen_chrom:
+                    break
+                continue
+            seen_chrom = True
+            pos = int(fields[1])
+            if pos < start:
+                continue
+            if end is not None and pos > end:
+                break
+            yield line
+
+    def close(self):
+        self.handle.close()
+
+
+class BgzfWriter(object):
+    '''
+    Writes a BGZF compressed file (readable by gzip, bgzip and tabix) through a single handle.
+    Lines are collected in a buffer of at most one block, which is compressed
+    as soon as it is full, so memory does not depend on the file size.
+
+    With threads > 1, full blocks are compressed by a pool of threads while the
+    caller keeps writing, and are written to the file in order. At most two
+    blocks per thread are waiting to be written at any time.
+
+    If index is a TabixIndex, every data line written with write_record is
+    added to it and the index is written to <file_name>.tbi on close.
+    '''
+
+    def __init__(self, file_name, index=None, compress_level=6, threads=1):
+        self.file_name = file_name
+        self.index = index
+        self.compress_level = compress_level
+        self.handle = open(file_name, "wb")
+        self.buffer = bytearray()
+        self.compressed_offset = 0
+        self.closed = False
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.pending = deque()
+        self.num_blocks = 0
+        # Compressed offset of every block, used to resolve the index offsets on close
+        self.block_offsets = [0] if self.executor is not None else None
+        # Start offset and content of a data line that is written in pieces
+        self.line_start = None
+        self.line_head = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def tell(self):
+        '''
+        virtual offset of the next byte that will be written. With threads, the
+        compressed offset is not known yet and the block number is used instead
+        '''
+        if self.executor is not None:
+            return (self.num_blocks << 16) | len(self.buffer)
+        return (self.compressed_offset << 16) | len(self.buffer)
+
+    def write_bytes(self, data):
+        self.buffer += data
+        if len(self.buffer) < BGZF_BLOCK_SIZE:
+            return
+        # Full blocks are compressed first and removed from the buffer at once
+        start = 0
+        with memoryview(self.buffer) as view:
+            while len(self.buffer) - start >= BGZF_BLOCK_SIZE:
+                self._flush_block(bytes(view[start:start + BGZF_BLOCK_SIZE]))
+                start += BGZF_BLOCK_SIZE
+        del self.buffer[:start]
+
+    def write(self, text):
+        ''' writes text (e.g. header lines) that is not indexed '''
+        self.write_bytes(text.encode())
+
+    def write_record(self, line):
+        ''' writes a data line and adds it to the index '''
+        start_offset = self.tell()
+        self.write_bytes(line.encode())
+        if self.index is not None:
+            self.index.push_line(line, start_offset, self.tell())
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write_record(line)
+
+    def write_data(self, data):
+        '''
+        writes bytes of data lines that do not have to start or end at a line
+        boundary, e.g. cut out of another BGZF file. Completed lines are added to the index
+        '''
+        if self.index is None:
+            self.write_bytes(data)
+            return
+        pos = 0
+        while pos < len(data):
+            if self.line_start is None:
+                self.line_start = self.tell()
+            newline = data.find(b"\n", pos)
+            end = newline + 1 if newline >= 0 else len(data)
+            self.line_head += data[pos:end]
+            self.write_bytes(data[pos:end])
+            if newline >= 0:
+                self._push_line(self.tell())
+            pos = end
+
+    def write_block(self, block, data):
+        '''
+        writes a compressed block of another BGZF file as it is, without recompressing it.
+        data is the decompressed content of the block, its lines are indexed as with write_data.
+        Buffered bytes are flushed to a block of their own first
+        '''
+        self.flush()
+        block_start = self.tell()
+        self.num_blocks += 1
+        if self.executor is None:
+            self._write_block(block)
+        else:
+            compressed = Future()
+            compressed.set_result(block)
+            self.pending.append(compressed)
+            while len(self.pending) > 2 * self.threads:
+                self._write_block(self.pending.popleft().result())
+        if self.index is None:
+            return
+        pos = 0
+        while pos < len(data):
+            if self.line_start is None:
+                self.line_start = block_start | pos
+            newline = data.find(b"\n", pos)
+            end = newline + 1 if newline >= 0 else len(data)
+            self.line_head += data[pos:end]
+            if newline >= 0:
+                # A line ending with the block ends at the start of the next one
+                self._push_line(block_start | end if end < len(data) else self.tell())
+            pos = end
+
+    def _push_line(self, end_offset):
+        self.index.push_line(self.line_head.decode(), self.line_start, end_offset)
+        self.line_start = None
+        self.line_head = bytearray()
+
+    def flush(self):
+        ''' compresses the buffered bytes into a block, even if it is not full '''
+        if self.buffer:
+            self._flush_block(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _flush_block(self, data):
+        self.num_blocks += 1
+        if self.executor is None:
+            self._write_block(compress_block(data, self.compress_level))
+            return
+        self.pending.append(self.executor.submit(compress_block, data, self.compress_level))
+        while len(self.pending) > 2 * self.threads:
+            self._write_block(self.pending.popleft().result())
+
+    def _write_block(self, block):
+        self.handle.write(block)
+        self.compressed_offset += len(block)
+        if self.block_offsets is not None:
+            self.block_offsets.append(self.compressed_offset)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+            while self.pending:
+                self._write_block(self.pending.popleft().result())
+            self.handle.write(BGZF_EOF)
+        finally:
+            self.handle.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        if self.index is not None:
+            if self.block_offsets is not None:
+                self.index.resolve_block_offsets(self.block_offsets)
+            self.index.write(self.file_name + ".tbi")
@@ -0,0 +1,270 @@
+################################################
+#   Libraries
+################################################
+
+import json
+import mmap
+import struct
+from array import array
+from collections import namedtuple
+import numpy as np
+
+
+################################################
+#   Top level variables
+################################################
+
+# First and last bytes of a carrier index file
+CARRIER_INDEX_MAGIC = b"CGAPCIX1"
+
+# Variants are grouped in bins of this many base pairs
+CARRIER_INDEX_BIN_SIZE = 1000000
+
+# Arrays in the file start at multiples of this many bytes, so that they can be mapped as they are
+ALIGNMENT = 8
+
+# Arrays of a bin, see bin_layout
+BinArrays = namedtuple("BinArrays", ["positions", "indptr", "indices", "id_offsets", "ids"])
+
+
+################################################
+#   Functions
+################################################
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+
+def bin_layout(n_variants, n_carriers, ids_size, sample_dtype):
+    '''
+    Returns [(name, dtype, count)] of the arrays of a bin, in the order they are stored.
+    Every array is followed by padding to ALIGNMENT bytes.
+
+    positions: POS of the variants, sorted
+    indptr: carriers of variant i are indices[indptr[i]:indptr[i + 1]] (CSR)
+    indices: sample indexes of the carriers
+    id_offsets: ID of variant i is ids[id_offsets[i]:id_offsets[i + 1]]
+    ids: variant IDs, utf-8
+    '''
+    return [
+        ("positions", "<u4", n_variants),
+        ("indptr", "<u8", n_variants + 1),
+        ("indices", sample_dtype, n_carriers),
+        ("id_offsets", "<u4", n_variants + 1),
+        ("ids", "u1", ids_size),
+    ]
+
+
+def sample_dtype(num_samples):
+    ''' smallest dtype for the sample indexes '''
+    return "<u2" if num_samples <= 0xffff else "<u4"
+
+
+################################################
+#   Classes
+################################################
+
+class CarrierIndexWriter(object):
+    '''
+    Writes the carriers of every variant as a sparse sample x variant matrix.
+
+    Variants have to be added in coordinate order. They are grouped by chromosome
+    and bins of bin_size bp, and each bin is stored as CSR arrays of sample indexes
+    (see bin_layout) as soon as the next bin starts. The sample information (list of
+    dicts, in the order of the sample indexes), the chromosomes and the position of every bin
+    are written as JSON at the end of the file, followed by its length and CARRIER_INDEX_MAGIC.
+    '''
+
+    def __init__(self, file_name, samples, bin_size=CARRIER_INDEX_BIN_SIZE):
+        self.file_name = file_name
+        self.samples = samples
+        self.bin_size = bin_size
+        self.sample_dtype = sample_dtype(len(samples))
+        self.handle = open(file_name, "wb")
+        self.handle.write(CARRIER_INDEX_MAGIC)
+        self.offset = len(CARRIER_INDEX_MAGIC)
+        self.contigs = []
+        self.bins = []  # [chrom, bin, offset, n_variants, n_carriers, ids_size]
+        self.num_variants = 0
+        self.num_carriers = 0
+        self.last_chrom = None
+        self.last_pos = -1
+        self.current_bin = None
+        self._reset_bin()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _reset_bin(self):
+        self.positions = array("I")
+        self.indptr = [0]
+        self.indices = array("I")
+        self.id_offsets = [0]
+        self.ids = bytearray()
+
+    def add(self, chrom, pos, id, carriers):
+        ''' adds a variant with the sample indexes of its carriers '''
+        if chrom != self.last_chrom:
+            if chrom in self.contigs:
+                raise ValueError(f"{self.file_name}: variants are not sorted, {chrom} appears again after {self.last_chrom}")
+            self.contigs.append(chrom)
+            self.last_chrom = chrom
+            self.last_pos = -1
+        elif pos < self.last_pos:
+            raise ValueError(f"{self.file_name}: variants are not sorted, {chrom}:{pos} after {chrom}:{self.last_pos}")
+        self.last_pos = pos
+
+        bin_key = (chrom, pos // self.bin_size)
+        if bin_key != self.current_bin:
+            self._flush_bin()
+            self.current_bin = bin_key
+        self.positions.append(pos)
+        self.indices.extend(carriers)
+        self.indptr.append(len(self.indices))
+        self.ids += id.encode("utf-8")
+        self.id_offsets.append(len(self.ids))
+        self.num_variants += 1
+        self.num_carriers += len(carriers)
+
+    def _flush_bin(self):
+        if not self.positions:
+            return
+        chrom, bin_number = self.current_bin
+        arrays = {
+            "positions": self.positions,
+            "indptr": self.indptr,
+            "indices": self.indices,
+            "id_offsets": self.id_offsets,
+            "ids": self.ids,
+        }
+        self.bins.append([chrom, bin_number, self.offset, len(self.positions), len(self.indices), len(self.ids)])
+        for name, dtype, count in bin_layout(len(self.positions), len(self.indices), len(self.ids), self.sample_dtype):
+            data = np.asarray(arrays[name], dtype=dtype).tobytes()
+            data += b"\0" * _padding(len(data))
+            self.handle.write(data)
+            self.offset += len(data)
+        self._reset_bin()
+
+    def close(self):
+        if self.handle.closed:
+            return
+        self._flush_bin()
+        footer = json.dumps({
+            "bin_size": self.bin_size,
+            "sample_dtype": self.sample_dtype,
+            "samples": self.samples,
+            "contigs": self.contigs,
+            "bins": self.bins,
+        }).encode("utf-8")
+        self.handle.write(footer)
+        self.handle.write(struct.pack("<Q", len(footer)))
+        self.handle.write(CARRIER_INDEX_MAGIC)
+        self.handle.close()
+
+
+class CarrierIndex(object):
+    '''
+    Reads a file written by CarrierIndexWriter. The file is memory mapped and only
+    the bins of a query are read, as numpy arrays that point into the mapping.
+
+    Example:
+
+        with CarrierIndex("variant_carriers.cidx") as carrier_index:
+            for chrom, pos, id, carriers in carrier_index.fetch("chr1", 1000000, 2000000):
+                sample_ids = [carrier_index.samples[idx]["sample_id"] for idx in carriers]
+            carriers = carrier_index.carriers("chr1_1234567_A_G")
+    '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.handle = open(file_name, "rb")
+        self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer_size = 8 + len(CARRIER_INDEX_MAGIC)
+        if self.data[:len(CARRIER_INDEX_MAGIC)] != CARRIER_INDEX_MAGIC or self.data[-len(CARRIER_INDEX_MAGIC):] != CARRIER_INDEX_MAGIC:
+            raise ValueError(f"{file_name} is not a carrier index")
+        footer_size, = struct.unpack("<Q", self.data[-trailer_size:-len(CARRIER_INDEX_MAGIC)])
+        footer = json.loads(self.data[-trailer_size - footer_size:-trailer_size].decode("utf-8"))
+        self.bin_size = footer["bin_size"]
+        self.sample_dtype = footer["sample_dtype"]
+        self.samples = footer["samples"]
+        self.contigs = footer["contigs"]
+        self.bins = {}          # {(chrom, bin): (offset, n_variants, n_carriers, ids_size)}
+        self.contig_bins = {}   # {chrom: [bin, ...]}, sorted
+        for chrom, bin_number, offset, n_variants, n_carriers, ids_size in footer["bins"]:
+            self.bins[(chrom, bin_number)] = (offset, n_variants, n_carriers, ids_size)
+            self.contig_bins.setdefault(chrom, []).append(bin_number)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _bin_arrays(self, chrom, bin_number):
+        ''' BinArrays of a bin, None if it has no variants '''
+        entry = self.bins.get((chrom, bin_number))
+        if entry is None:
+            return None
+        offset, n_variants, n_carriers, ids_size = entry
+        arrays = []
+        for _, dtype, count in bin_layout(n_variants, n_carriers, ids_size, self.sample_dtype):
+            array_ = np.frombuffer(self.data, dtype=dtype, count=count, offset=offset)
+            arrays.append(array_)
+            offset += array_.nbytes + _padding(array_.nbytes)
+        return BinArrays._make(arrays)
+
+    def fetch(self, chrom, start, end=None):
+        '''
+        generator over (chrom, pos, id, carriers) of the variants of chrom with a position
+        (1-based) between start and end (inclusive, None for the end of chrom).
+        carriers is a numpy array with the sample indexes of the carriers
+        '''
+        for bin_number in self.contig_bins.get(chrom, []):
+            if bin_number < start // self.bin_size:
+                continue
+            if end is not None and bin_number > end // self.bin_size:
+                break
+            arrays = self._bin_arrays(chrom, bin_number)
+            first = np.searchsorted(arrays.positions, start, side="left")
+            last = len(arrays.positions) if end is None else np.searchsorted(arrays.positions, end, side="right")
+            for i in range(first, last):
+                yield (
+                    chrom,
+                    int(arrays.positions[i]),
+                    arrays.ids[arrays.id_offsets[i]:arrays.id_offsets[i + 1]].tobytes().decode("utf-8"),
+                    arrays.indices[arrays.indptr[i]:arrays.indptr[i + 1]],
+                )
+
+    def carriers(self, variant_id):
+        '''
+        numpy array with the sample indexes of the carriers of a variant,
+        None if it is not in the index. variant_id is CHROM_POS_REF_ALT, the first
+        variant with that ID is returned
+        '''
+        try:
+            chrom, pos, _, _ = variant_id.rsplit("_", 3)
+            pos = int(pos)
+        except ValueError:
+            raise ValueError(f"{variant_id} is not a variant ID (CHROM_POS_REF_ALT)")
+        for _, _, id, carriers in self.fetch(chrom, pos, pos):
+            if id == variant_id:
+                return carriers
+        return None
+
+    def carrier_samples(self, variant_id):
+        ''' sample information (dicts) of the carriers of a variant, None if it is not in the index '''
+        carriers = self.carriers(variant_id)
+        if carriers is None:
+            return None
+        return [self.samples[idx] for idx in carriers]
+
+    def close(self):
+        try:
+            self.data.close()
+        except BufferError:
+            # Arrays returned by a query still point into the mapping, it is closed with them
+            pass
+        self.handle.close()
@@ -1,28 +1,41 @@
 import click
-import csv, gzip
-
-@click.command()
-@click.help_option("--help", "-h")
-@click.option("-r", "--regenie-output", required=True, type=str, help="Regenie output file")
-@click.option("-s", "--snp-list", required=True, type=str, help="Mask SNP list file")
-@click.option("-g", "--gene-info", required=True, type=str, help="Gene inserts file from portal")
-@click.option("-a", "--aaf-bin", required=True, type=str, help="AAF bin to extract")
-@click.option("-o", "--out", required=True, type=str, help="the output file name")
-def main(regenie_output, snp_list, gene_info, aaf_bin, out):
-    """This script takes a gene-based regenie output file and transforms it in a vcf 
-       that the Higlass browser can understand
-
-    Example usage: 
-
-    python create_higlass_gene_file.py -r /path/to/out.regenie  -g gene_inserts_from_portal.tsv -o higlass_gene_tests.vcf
-
-    """
-
+import csv, gzip, tempfile
+from array import array
+from bgzf import BgzfWriter, TabixIndex
+
+# AAF bin of the Regenie results of all variants in a mask (ID ends with .all)
+ALL_VARIANTS_AAF_BIN = "1"
+
+r_map = {
+    "CHROM": 0,
+    "GENPOS": 1,
+    "ID": 2,
+    "ALLELE0": 3,
+    "ALLELE1": 4,
+    "A1FREQ": 5,
+    "N": 6,
+    "TEST": 7,
+    "BETA": 8,
+    "SE": 9,
+    "CHISQ": 10,
+    "LOG10P": 11,
+    "EXTRA": 12,
+
+}
+
+def mask_aaf_bin(mask_id):
+    ''' AAF bin of a Regenie mask ID, e.g. 0.01 for ENSG00000164002.mask_cadd.0.01, 1 for .all '''
+    mask_id_ = mask_id.split(".", 2)
+    aaf_bin = mask_id_[2] if len(mask_id_) > 2 else ""
+    return ALL_VARIANTS_AAF_BIN if aaf_bin == "all" else aaf_bin
+
+def read_gene_info(gene_info):
+    ''' {gene ID: {chrom, start, end, symbol}} '''
     gene_mapping = {}
 
     with open(gene_info, 'r') as f:
         tsv_file = csv.reader(f, delimiter="\t")
-     
+
         # header: ens_id	chr	start	end	strand	gene
         for info in tsv_file:
             if info[0] == "ens_id":
@@ -35,11 +48,18 @@ def main(regenie_output, snp_list, gene_info, aaf_bin, out):
                 "end": info[3],
                 "symbol": info[5]
             }
-
-    #print(gene_mapping)
-
-    # contains information about which mask contains which SNPs
-    mask_snp_list = {}
+    return gene_mapping
+
+def read_snp_list(snp_list, snp_file, aaf_bins=None):
+    '''
+    contains information about which mask contains which SNPs.
+    The MASK_SNPS=...; INFO fields are written to snp_file in the order of the SNP list.
+    Returns {AAF bin: {gene ID: [start, end, start, end, ...]}} with the byte ranges of the fields
+    of every gene in snp_file. The fields of a gene are usually next to each other and end up in
+    a single range. Only the bins in aaf_bins are kept (None for all of them)
+    '''
+    snp_file_size = 0
+    snp_spans = {}
     with gzip.open(snp_list, 'rt') as f:
         for line in f:
 
@@ -50,54 +70,62 @@ def main(regenie_output, snp_list, gene_info, aaf_bin, out):
             mask_id = line_[0]
             snps = line_[1]
 
-            if aaf_bin != "1" and (not mask_id.endswith(aaf_bin)):
+            aaf_bin = mask_aaf_bin(mask_id)
+            # The file of AAF bin 1 lists the SNPs of all bins
+            if aaf_bins is not None and aaf_bin not in aaf_bins and ALL_VARIANTS_AAF_BIN not in aaf_bins:
                 continue
 
             mask_id_ = mask_id.split(".")
             gene_id = mask_id_[0]
             mask = mask_id_[1].upper()
 
-            if gene_id not in mask_snp_list:
-                mask_snp_list[gene_id] = ""
-            mask_snp_list[gene_id] += f"{mask}_SNPS={snps};"
-
-
-
-    r_map = {
-        "CHROM": 0,
-        "GENPOS": 1,
-        "ID": 2,
-        "ALLELE0": 3,
-        "ALLELE1": 4,
-        "A1FREQ": 5,
-        "N": 6,
-        "TEST": 7,
-        "BETA": 8,
-        "SE": 9,
-        "CHISQ": 10,
-        "LOG10P": 11,
-        "EXTRA": 12,
-
+            snp_info = f"{mask}_SNPS={snps};".encode()
+            start, snp_file_size = snp_file_size, snp_file_size + len(snp_info)
+            snp_file.write(snp_info)
+            bin_spans = snp_spans.setdefault(aaf_bin, {})
+            spans = bin_spans.get(gene_id)
+            if spans is None:
+                bin_spans[gene_id] = array("Q", (start, snp_file_size))
+            elif spans[-1] == start:
+                spans[-1] = snp_file_size
+            else:
+                spans.extend((start, snp_file_size))
+    return snp_spans
+
+def merge_snp_spans(snp_spans):
+    ''' {gene ID: byte ranges} of all AAF bins, in the order of the SNP list '''
+    merged = {}
+    for bin_spans in snp_spans.values():
+        for gene_id, spans in bin_spans.items():
+            merged.setdefault(gene_id, []).extend(zip(spans[::2], spans[1::2]))
+    return {
+        gene_id: array("Q", (offset for span in sorted(spans) for offset in span))
+        for gene_id, spans in merged.items()
     }
 
-    genes_without_annotations = []
-
-    # Formatted regnie results:
-    # regenie_results = {
-    #     "ENSG00000177465": {
-    #         "mask_cadd": {
-    #             "BURDEN": 0.9,
-    #             "SKAT": 0.8,
-    #             ...
-    #         },
-    #         ...
-    #     },
-    #     ...
-    # }
+def read_regenie_results(regenie_output, gene_mapping, aaf_bins=None):
+    '''
+    Formatted regnie results of every AAF bin, only the bins in aaf_bins are kept (None for all of them):
+    regenie_results = {
+        "0.01": {
+            "ENSG00000177465": {
+                "mask_cadd": {
+                    "BURDEN": 0.9,
+                    "SKAT": 0.8,
+                    ...
+                },
+                ...
+            },
+            ...
+        },
+        ...
+    }
+    '''
+    genes_without_annotations = set()
     regenie_results = {}
 
     with gzip.open(regenie_output, 'rt') as f_in:
-        
+
         for line in f_in:
             if line.startswith("##") or line.startswith("CHROM"):
                 continue
@@ -118,9 +146,9 @@ def main(regenie_output, snp_list, gene_info, aaf_bin, out):
 
             if gene_id not in gene_mapping:
                 print(f"WARNING: {gene_id} not found in annotations. Skipping.")
-                genes_without_annotations.append(gene_id)
+                genes_without_annotations.add(gene_id)
                 continue
-            
+
             p_value = result[r_map["LOG10P"]]
             regenie_test = result[r_map["TEST"]]
             test_used = ""
@@ -141,26 +169,37 @@ def main(regenie_output, snp_list, gene_info, aaf_bin, out):
             # else: # all other tests only consider all variants in the mask
             #     if not regenie_id.endswith("all"):
             #         continue
-            
-            # Select the right lines based on the test used.
-            if aaf_bin == "1" and (not regenie_id.endswith("all")):
-                continue
-            if aaf_bin != "1" and (not regenie_id.endswith(aaf_bin)):
+
+            # Every line goes to the results of its AAF bin
+            aaf_bin = mask_aaf_bin(regenie_id)
+            if aaf_bins is not None and aaf_bin not in aaf_bins:
                 continue
 
-            if gene_id not in regenie_results:
-                regenie_results[gene_id] = {}
+            bin_results = regenie_results.setdefault(aaf_bin, {})
+
+            if gene_id not in bin_results:
+                bin_results[gene_id] = {}
+
+            if mask not in bin_results[gene_id]:
+                bin_results[gene_id][mask] = {}
 
-            if mask not in regenie_results[gene_id]:
-                regenie_results[gene_id][mask] = {}
+            bin_results[gene_id][mask][test_used] = p_value
+    return regenie_results
 
-            regenie_results[gene_id][mask][test_used] = p_value
-               
-    with open(out, 'w') as f_out:
+def write_gene_file(out, regenie_results, gene_mapping, snp_file, snp_spans):
+    ''' writes the genes with results sorted by chromosome and start, bgzipped and tabix indexed '''
+    # Coordinate index of the genes with results, sorted by chromosome (as text) and start
+    # as sort -k1,1 -k2,2n would sort the records
+    gene_order = sorted(
+        regenie_results.keys(),
+        key=lambda gene_id: ("chr" + gene_mapping[gene_id]["chrom"], int(gene_mapping[gene_id]["start"]), gene_id)
+    )
+
+    with BgzfWriter(out, TabixIndex()) as f_out:
         f_out.write('##fileformat=VCFv4.3\n')
         f_out.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
 
-        for gene_id in regenie_results.keys():
+        for gene_id in gene_order:
             gene_annotation = gene_mapping[gene_id]
 
             chr = "chr" + gene_annotation["chrom"]
@@ -174,13 +213,69 @@ def main(regenie_output, snp_list, gene_info, aaf_bin, out):
                     mask_u = mask.upper()
                     p_value = regenie_results[gene_id][mask][test]
                     info += f"{mask_u}_{test}={p_value};"
-            
-            if gene_id in mask_snp_list:
-                info += mask_snp_list[gene_id]
 
-            f_out.write(f"{chr}\t{gene_start}\t{gene_id}\t.\t.\t0\tPASS\t{info}\n")
+            spans = snp_spans.get(gene_id, ())
+            for i in range(0, len(spans), 2):
+                snp_file.seek(spans[i])
+                info += snp_file.read(spans[i + 1] - spans[i]).decode()
+
+            f_out.write_record(f"{chr}\t{gene_start}\t{gene_id}\t.\t.\t0\tPASS\t{info}\n")
+
+def aaf_bin_output(out, aaf_bin):
+    ''' output file of an AAF bin, e.g. higlass_gene_tests.sorted.aaf_0.01.vcf.gz for higlass_gene_tests.sorted.vcf.gz '''
+    for extension in (".vcf.gz", ".vcf"):
+        if out.endswith(extension):
+            return f"{out[:-len(extension)]}.aaf_{aaf_bin}{extension}"
+    return f"{out}.aaf_{aaf_bin}"
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option("-r", "--regenie-output", required=True, type=str, help="Regenie output file")
+@click.option("-s", "--snp-list", required=True, type=str, help="Mask SNP list file")
+@click.option("-g", "--gene-info", required=True, type=str, help="Gene inserts file from portal")
+@click.option("-a", "--aaf-bin", required=False, type=str, multiple=True, help="AAF bin to extract. Can be given more than once")
+@click.option("--all-aaf-bins", is_flag=True, default=False, help="Extract every AAF bin in the Regenie output")
+@click.option("-o", "--out", required=True, type=str, help="the output file name (bgzipped and tabix indexed)")
+def main(regenie_output, snp_list, gene_info, aaf_bin, all_aaf_bins, out):
+    """This script takes a gene-based regenie output file and transforms it in a vcf
+       that the Higlass browser can understand
+
+       Genes are written sorted by chromosome and start, bgzipped and tabix indexed.
+
+       With several AAF bins or --all-aaf-bins, the inputs are read once and a file is written
+       for every bin, named after out with .aaf_<bin> before the extension. AAF bin 1 stands
+       for the results of all variants in a mask (.all).
+
+    Example usage:
+
+    python create_higlass_gene_file.py -r /path/to/out.regenie  -g gene_inserts_from_portal.tsv -o higlass_gene_tests.sorted.vcf.gz
+
+    python create_higlass_gene_file.py -r /path/to/out.regenie  -g gene_inserts_from_portal.tsv -a 0.01 -a 0.05 -a 1 -o higlass_gene_tests.sorted.vcf.gz
+
+    """
+    if not aaf_bin and not all_aaf_bins:
+        raise click.UsageError("Either --aaf-bin or --all-aaf-bins is required")
+    aaf_bins = None if all_aaf_bins else set(aaf_bin)
+
+    gene_mapping = read_gene_info(gene_info)
+
+    with tempfile.TemporaryFile() as snp_file:
+        snp_spans = read_snp_list(snp_list, snp_file, aaf_bins)
+        regenie_results = read_regenie_results(regenie_output, gene_mapping, aaf_bins)
+
+        if all_aaf_bins:
+            outputs = [(bin_, aaf_bin_output(out, bin_)) for bin_ in sorted(regenie_results)]
+        elif len(aaf_bin) == 1:
+            outputs = [(aaf_bin[0], out)]
+        else:
+            outputs = [(bin_, aaf_bin_output(out, bin_)) for bin_ in dict.fromkeys(aaf_bin)]
+
+        for bin_, bin_out in outputs:
+            # The file of AAF bin 1 lists the SNPs of all bins
+            bin_spans = merge_snp_spans(snp_spans) if bin_ == ALL_VARIANTS_AAF_BIN else snp_spans.get(bin_, {})
+            write_gene_file(bin_out, regenie_results.get(bin_, {}), gene_mapping, snp_file, bin_spans)
+            print(f"AAF bin {bin_}: {len(regenie_results.get(bin_, {}))} genes written to {bin_out}")
 
-        
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,46 @@
-import click, json, os
-from utils import VALID_GENOTYPES
-from granite.lib import vcf_parser
-
-CHUNK_SIZE = 1000000
-CHUNK_PREFIX = "variant_details_chunk"
+import click, json
+from utils import carrier_indexes, read_sample_info
+from vcf_reader import VcfReader
+from bgzf import BgzfWriter, TabixIndex
+from carrier_index import CarrierIndexWriter
+from profiler import get_profiler
 
 @click.command()
 @click.help_option("--help", "-h")
 @click.option("-a", "--annotated-vcf", required=True, type=str, help="Jointly called, annotated and filtered VCF")
-@click.option("-s", "--sample-info", required=True, type=str, help="Encoded JSON with sample information")
-@click.option("-o", "--output", required=True, type=str, help="File name of details file")
-def main(annotated_vcf, sample_info, output):
+@click.option("-s", "--sample-info", required=True, type=str, help="Encoded JSON with sample information, or the path of a JSON file with it")
+@click.option("-o", "--output", required=True, type=str, help="File name of details file (bgzipped and tabix indexed, or carrier index)")
+@click.option("-f", "--output-format", required=False, type=click.Choice(["vcf", "carrier_index"]), default="vcf", show_default=True, help="VCF with the sample info of the carriers in INFO, or sparse carrier index (see carrier_index.py)")
+@click.option("-t", "--threads", required=False, type=int, default=6, show_default=True, help="Number of threads that compress the output")
+@click.option("--profile", required=False, type=str, default=None, help="Write wall time, calls and throughput of every phase of the script to this JSON file")
+@click.option("--cprofile", required=False, type=str, default=None, help="Write cProfile stats (pstats) to this file")
+def main(annotated_vcf, sample_info, output, output_format, threads, profile, cprofile):
     """
     This script takes the annotated, filtered VCF and sample
     information and produces a VCF files that contains the variants together with the sample info.
+    The output is compressed by a pool of threads while the input is read, and tabix indexed.
+
+    The sample info of every sample is formatted once. For each variant, only the carriers
+    are looked up in the sample columns, see carrier_indexes.
+
+    With --output-format carrier_index, the sample info is stored once and the carriers of
+    every variant as sample indexes, in a file that can be queried by region or variant ID
+    with carrier_index.CarrierIndex.
+
+    Example usage:
+
+    python create_variant_details_file.py -a annotated.vcf.gz -s "$(cat sample_info.json)" -o variant_details.vcf.gz
+
+    python create_variant_details_file.py -a annotated.vcf.gz -s "$(cat sample_info.json)" -f carrier_index -o variant_carriers.cidx
+
+    python create_variant_details_file.py -a annotated.vcf.gz -s sample_info.json -o variant_details.vcf.gz
 
     """
 
-    vcf_obj = vcf_parser.Vcf(annotated_vcf)
+    profiler = get_profiler(profile, cprofile)
+    vcf_obj = VcfReader(annotated_vcf)
 
-    sample_info_dec = json.loads(sample_info)
+    sample_info_dec = json.loads(read_sample_info(sample_info))
     sample_info_dict = {}
     for sample in sample_info_dec:
         sample_id = sample["sample_id"]
@@ -30,56 +51,46 @@ def main(annotated_vcf, sample_info, output):
             "contact": sample["contact"] or "",
         }
 
-    num_variants = 0
-    chunk = 0
-    chunk_files = []
-    f_out = None
+    ##samples is comma separated list with SAMPLE_ID:LINKTO_ID:IS_AFFECTED:TISSUE_TYPE:CONTACT
+    sample_tokens = []
+    for sample in vcf_obj.header.IDs_genotypes:
+        if sample in sample_info_dict:
+            info = sample_info_dict[sample]
+            sample_tokens.append(f"{sample}:{info['linkto_id']}:{info['is_affected']}:{info['tissue_type']}:{info['contact']},")
+        else:
+            sample_tokens.append(None)
+    # Samples without sample info, only an error if they are carriers
+    missing_samples = {idx for idx, token in enumerate(sample_tokens) if token is None}
 
-    for record in vcf_obj.parse_variants():
+    if output_format == "carrier_index":
+        f_out = CarrierIndexWriter(output, [
+            dict(sample_id=sample, **sample_info_dict.get(sample, {}))
+            for sample in vcf_obj.header.IDs_genotypes
+        ])
+    else:
+        f_out = BgzfWriter(output, TabixIndex(), threads=threads)
+        vcf_obj.write_header(f_out)
 
-        if num_variants % CHUNK_SIZE == 0:
-            compress_and_close_chunk(chunk-1, f_out)
-            chunk_file = f"{CHUNK_PREFIX}_{chunk}.vcf"
-            f_out = open(chunk_file, "w")
-            chunk_files.append(f"{chunk_file}.gz")
-            vcf_obj.write_header(f_out)
-            chunk += 1
-        
-        num_variants += 1
+    for record in profiler.iterate("read_vcf", vcf_obj.parse_variants()):
+        profiler.count("variants")
 
-        samples = record.IDs_genotypes
+        t = profiler.start()
         GT_idx = record.FORMAT.split(":").index("GT")
-        ##samples is comma separated list with SAMPLE_ID:LINKTO_ID:IS_AFFECTED:TISSUE_TYPE:CONTACT
-        info="samples="
-        for sample in samples:
-            gt = record.GENOTYPES[sample].split(":")[GT_idx]
-            if gt in VALID_GENOTYPES and gt not in ["./.", "0/0", "0|0"]:
-                linkto_id = sample_info_dict[sample]["linkto_id"]
-                is_affected = sample_info_dict[sample]["is_affected"]
-                tissue_type = sample_info_dict[sample]["tissue_type"]
-                contact = sample_info_dict[sample]["contact"]
-                info += f"{sample}:{linkto_id}:{is_affected}:{tissue_type}:{contact},"
-
-
-        f_out.write(f"{record.CHROM}\t{record.POS}\t{record.ID}\t{record.REF}\t{record.ALT}\t0\tPASS\t{info}\n")
-    
-    compress_and_close_chunk(chunk-1, f_out)
-    # Files need to be in the correct order to produce a sorted vcf. This is required for tabix to work.
-    cmd_result = os.system(f"bcftools concat {' '.join(chunk_files)} -o {output} --threads 6 -O z  || exit 1") 
-    if cmd_result > 0: # exit status shows error
-        raise Exception(f"bcftools concat command failed.")
-    cmd_result = os.system(f"tabix -p vcf -f {output} || exit 1")
-    if cmd_result > 0: # exit status shows error
-        raise Exception(f"tabix command failed.")
-    os.system(f"rm -f {CHUNK_PREFIX}*")
-
-def compress_and_close_chunk(chunk:int, file_handle):
-    if chunk < 0 or not file_handle or file_handle.closed:
-        return
-    file_handle.close()
-    file_name = f"{CHUNK_PREFIX}_{chunk}.vcf"
-    os.system(f"bgzip --threads 6 -c {file_name} > {file_name}.gz || exit 1")
-    os.system(f"rm -f {file_name}")
-    
+        carriers = carrier_indexes(record.raw_samples, GT_idx)
+        if missing_samples and not missing_samples.isdisjoint(carriers):
+            raise KeyError(record.IDs_genotypes[min(missing_samples.intersection(carriers))])
+        t = profiler.lap("genotypes", t)
+
+        if output_format == "carrier_index":
+            f_out.add(record.CHROM, record.POS, record.ID, carriers)
+        else:
+            info = "samples=" + "".join(sample_tokens[idx] for idx in carriers)
+            f_out.write_record(f"{record.CHROM}\t{record.POS}\t{record.ID}\t{record.REF}\t{record.ALT}\t0\tPASS\t{info}\n")
+        profiler.lap("write", t)
+
+    with profiler.phase("close"):
+        f_out.close()
+    profiler.write()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
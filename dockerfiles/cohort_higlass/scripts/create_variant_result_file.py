@@ -2,14 +2,23 @@
 #   Libraries
 ################################################
 
+import bisect
 import click
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
 from granite.lib import vcf_parser
 from granite.lib.shared_vars import DStags
-import math
-import gzip
-from scipy.stats import fisher_exact
-from utils import get_worst_consequence, get_worst_transcript, clean_dbnsfp, parse_regenie_results, get_maxds, get_variant_result_file_header,get_variant_result_higlass_file_header
+from utils import CsqParser, read_sample_info, consequence_cache_stats, get_regenie_results, split_regenie_results, regenie_results_are_sorted, RegenieMergeJoin, RegenieResultsDict, get_maxds, get_maxds_values, get_variant_result_higlass_file_header
 from utils import get_cases, VALID_GENOTYPES
+from bgzf import BgzfReader, BgzfWriter, TabixIndex, BGZF_BLOCK_SIZE
+from fisher import FisherBatch, FisherCache, FISHER_CACHE_SIZE
+from profiler import get_profiler, NullProfiler, PhaseProfiler
+from multires import MultiresTrack, MultiresWriter, MAX_VARIANTS_PER_TILE, multires_output
+from result_summary import ResultSummary, TOP_HITS
+from variant_results import variant_result_header, variant_result_index
 
 ################################################
 #   Top level variables
@@ -23,22 +32,22 @@ from utils import get_cases, VALID_GENOTYPES
 # e.g., AF and p
 SIGNIFICANT_DIGITS = 3
 
-# Number of variants to keep in memory and to append to the result files at once
-# A higher number will require more memory
-NUM_VARIANTS_TO_PROCESS = 500000
+# Number of variants to keep in memory until their Fisher exact tests are run together
+# and they are written to the result files. A higher number will require more memory
+NUM_VARIANTS_TO_PROCESS = 50000
 
 #significant digits when calculated above 1
 # e.g., OR and log10
 ROUND_DIGITS = 4
 
-dbNSFP_fields = {
+dbNSFP_fields = [
     # dbNSFP fields that may be a list
     # and need to be assigned to transcripts
-    'Polyphen2_HVAR_pred': 0,
-    'Polyphen2_HVAR_score': 0,
-    'SIFT_pred': 0,
-    'SIFT_score': 0
-}
+    'Polyphen2_HVAR_pred',
+    'Polyphen2_HVAR_score',
+    'SIFT_pred',
+    'SIFT_score'
+]
 
 
 ################################################
@@ -47,65 +56,87 @@ dbNSFP_fields = {
 
 VEP_TAG = 'CSQ'
 
+# Everythin in the following list will be included in the Higlass result file
+INFO_LIST = [
+    "transcript", "case_AC", "case_AN", "case_AF", "control_AC", "control_AN", "control_AF", "gnomADg_AC", "gnomADg_AN", "gnomADg_AF", "gnomADe2_AC", "gnomADe2_AN", "gnomADe2_AF", "most_severe_consequence", "level_most_severe_consequence", "cadd_raw_rs", "cadd_phred", "polyphen_pred", "polyphen_rankscore", "polyphen_score", "gerp_score", "gerp_rankscore", "sift_rankscore", "sift_pred", "sift_score", "spliceai_score_max", "fisher_or_gnomADg", "fisher_ml10p_gnomADg", "fisher_or_gnomADe2", "fisher_ml10p_gnomADe2", "fisher_or_control", "fisher_ml10p_control", "regenie_ml10p", "regenie_beta", "regenie_chisq", "regenie_se",
+]
+
+# Number of regions per worker when the VCF is processed in parallel.
+# More regions balance the work better between workers
+REGIONS_PER_WORKER = 4
+
 ################################################
 #   Functions
 ################################################
 
 
-def summarize_genotypes(sample_gts, variant_id):
-    ''' 
-    Expects a dict of the form
-    {
-        "sample_1": "0/1",
-        "sample_2": "./1",
-    }
-    and calculates AC, AN and AF across all samples.
-    
+class GenotypeCounter(object):
     '''
+    Counts AC and AN of cases and controls in a single pass over the sample columns.
 
-    s_AC = s_AN = 0
-
-    for sample in sample_gts:
-        gt = sample_gts[sample]
-
-        if gt not in VALID_GENOTYPES:
-            raise Exception(f"Unexpected genotype {gt} found for variant {variant_id}. Did you run bcftools norm multiallelics?")
-
-        # if genotye has not been called, move on
-        if gt == "./.":
-            continue
-
-        s_AN += 2 # add 2 to total count if there is a genotype called
-        s_AC += gt.count('1') # then count the alternative alleles
-        
-    # with counting done, we need to calculate AF and store all 3 values in the result dict
-    s_AF = s_AC/s_AN if s_AC > 0 else 0
-
-    return {
-        "AC": s_AC,
-        "AN": s_AN,
-        "AF": s_AF,
-    }
-
-def fisher_calculation(proband_alt, proband_ref, gnomAD_alt, gnomAD_ref):
-    '''
-    This function is called within fisher_exact_gnomAD
-    and runs the actual Fisher exact test once the values
-    have been generated by the main function.
+    The columns of cases and controls are determined once. The GT of every sample
+    is mapped to the index of the genotype in VALID_GENOTYPES and the genotypes
+    are counted per group, so that AC and AN are obtained from the genotype counts.
+    AN counts 2 alleles for every called genotype and AF is 0 without alternate alleles.
     '''
-    oddsratio, pvalue = fisher_exact([[proband_alt, proband_ref], [gnomAD_alt, gnomAD_ref]], alternative='greater')
-    oddsratio_rounded = round(oddsratio, ROUND_DIGITS)
-    #print(proband_alt, proband_ref, gnomAD_alt, gnomAD_ref, pvalue)
-    minuslog10p = 0 if pvalue == 0 else round(-math.log10(pvalue), ROUND_DIGITS)
-    return pvalue, oddsratio_rounded, minuslog10p
 
-def fisher_exact_gnomAD(case_AC, case_AN, gnomAD_AC, gnomAD_AN):
+    CONTROL, CASE = 0, 1
+
+    def __init__(self, IDs_genotypes, case_sample_ids):
+        self.case_sample_ids = list(case_sample_ids)
+        self.control_sample_ids = [id for id in IDs_genotypes if id not in case_sample_ids]
+        case_sample_ids = set(case_sample_ids)
+
+        n_genotypes = len(VALID_GENOTYPES)
+        self.genotype_codes = {gt: i for i, gt in enumerate(VALID_GENOTYPES)}
+        # Bin of each sample column: group * number of genotypes
+        self.offsets = np.array([
+            (self.CASE if id in case_sample_ids else self.CONTROL) * n_genotypes for id in IDs_genotypes
+        ], dtype=np.int64)
+        self.n_bins = 2 * n_genotypes
+        # Alternate alleles and called alleles of each genotype
+        self.genotype_AC = np.array([gt.count('1') for gt in VALID_GENOTYPES], dtype=np.int64)
+        self.genotype_AN = np.array([0 if gt == "./." else 2 for gt in VALID_GENOTYPES], dtype=np.int64)
+
+    def count(self, record):
+        ''' returns the summaries ({AC, AN, AF}) of cases and controls '''
+        codes = self.genotype_codes
+        sample_cols = record.GENOTYPES.values() # in the order of IDs_genotypes
+        GT_idx = record.FORMAT.split(":").index("GT")
+        try:
+            if GT_idx == 0:
+                gt_codes = [codes[sample_col.partition(":")[0]] for sample_col in sample_cols]
+            else:
+                gt_codes = [codes[sample_col.split(":")[GT_idx]] for sample_col in sample_cols]
+        except (KeyError, IndexError):
+            self._raise_unexpected_genotype(record, GT_idx)
+
+        genotype_counts = np.bincount(self.offsets + gt_codes, minlength=self.n_bins).reshape(2, -1)
+        AC = (genotype_counts @ self.genotype_AC).tolist()
+        AN = (genotype_counts @ self.genotype_AN).tolist()
+        return self._summary(AC[self.CASE], AN[self.CASE]), self._summary(AC[self.CONTROL], AN[self.CONTROL])
+
+    @staticmethod
+    def _summary(AC, AN):
+        return {
+            "AC": AC,
+            "AN": AN,
+            "AF": AC/AN if AC > 0 else 0,
+        }
+
+    def _raise_unexpected_genotype(self, record, GT_idx):
+        ''' raises an error for the first unexpected genotype, in the order of cases and controls '''
+        for sample in self.case_sample_ids + self.control_sample_ids:
+            gt = record.GENOTYPES[sample].split(":")[GT_idx]
+            if gt not in VALID_GENOTYPES:
+                raise Exception(f"Unexpected genotype {gt} found for variant {record.ID}. Did you run bcftools norm multiallelics?")
+
+def gnomAD_table(case_AC, case_AN, gnomAD_AC, gnomAD_AN):
     '''
-    This generated the necessary inputs for a  Fisher
-    exact test (2 by 2) on the probands (cases)
-    versus gnomAD values
-    and calls the fisher_calculation function to
-    carry out the test. It return a tuple: p_value, oddsratio, minuslog10p
+    This generates the 2 by 2 table for a Fisher exact test
+    on the probands (cases) versus gnomAD values.
+    It returns [proband_alt, proband_ref, gnomAD_alt, gnomAD_ref]
+    or None if the test can not be run for this variant
     '''
 
     #can only run the test if there are values for gnomAD
@@ -119,7 +150,7 @@ def fisher_exact_gnomAD(case_AC, case_AN, gnomAD_AC, gnomAD_AN):
         if "&" not in gnomAD_AC and "&" not in gnomAD_AN:
             gnomAD_alt = int(gnomAD_AC)
             gnomAD_ref = int(gnomAD_AN) - gnomAD_alt
-            return fisher_calculation(proband_alt, proband_ref, gnomAD_alt, gnomAD_ref)
+            return [proband_alt, proband_ref, gnomAD_alt, gnomAD_ref]
 
         # if the entry does have an "&" we want to select the most rare to compare to
         else:
@@ -132,7 +163,7 @@ def fisher_exact_gnomAD(case_AC, case_AN, gnomAD_AC, gnomAD_AN):
             # We want to select the most rare from the list of possibilites. If there is a 0 in the AN list, we
             # can't compute that. Skip variant in that case
             if (len(gnomAD_alt_list) != len(gnomAD_AN_list)) or (0 in gnomAD_AN_list):
-                return 'NA', 'NA', 'NA'
+                return None
 
             allele_frequencies = [i / j for i, j in zip(gnomAD_alt_list, gnomAD_AN_list)]
             index_min_af = allele_frequencies.index(min(allele_frequencies))
@@ -140,20 +171,392 @@ def fisher_exact_gnomAD(case_AC, case_AN, gnomAD_AC, gnomAD_AN):
             gnomAD_alt = gnomAD_alt_list[index_min_af]
             gnomAD_ref = gnomAD_AN_list[index_min_af] - gnomAD_alt_list[index_min_af]
 
-            return fisher_calculation(proband_alt, proband_ref, gnomAD_alt, gnomAD_ref)
+            return [proband_alt, proband_ref, gnomAD_alt, gnomAD_ref]
+
+    return None
+
+
+class VariantResultBuilder(object):
+    '''
+    Holds everything that is derived once from the VCF header and the sample info.
+    variant_info() turns a VCF record into the values written to the result files
+    '''
+
+    def __init__(self, vcf_obj, sample_info, af_threshold_higlass, profiler=None):
+        self.profiler = profiler or NullProfiler()
+
+        # Fields read from the worst transcript of every variant
+        csq_fields = {
+            "impact": 'IMPACT',
+            "transcript_id": 'Feature',
+            "cadd_phred": 'CADD_PHRED',
+            "cadd_raw_rs": 'CADD_raw_rankscore',
+            "polyphen_pred": 'Polyphen2_HVAR_pred',
+            "polyphen_rankscore": 'Polyphen2_HVAR_rankscore',
+            "polyphen_score": 'Polyphen2_HVAR_score',
+            "gerp_score": 'GERP++_RS',
+            "gerp_rankscore": 'GERP++_RS_rankscore',
+            "sift_rankscore": 'SIFT_converted_rankscore',
+            "sift_pred": 'SIFT_pred',
+            "sift_score": 'SIFT_score',
+            # We want gnomAD v2 and v3 allele frequencies etc. to computer Fisher exact test scores
+            "gnomADg_AC": 'gnomADg_AC',
+            "gnomADg_AN": 'gnomADg_AN',
+            "gnomADg_AF": 'gnomADg_AF',
+            "gnomADe2_AC": 'gnomADe2_AC',
+            "gnomADe2_AN": 'gnomADe2_AN',
+            "gnomADe2_AF": 'gnomADe2_AF',
+        }
+
+        # Get SpliceAI ds indexes
+        # DStags import from granite.shared_vars
+        self.SpAItag_list, self.SpAI_idx_list = [], []
+        for DStag in DStags:
+            tag, idx = vcf_obj.header.check_tag_definition(DStag)
+            self.SpAItag_list.append(tag)
+            self.SpAI_idx_list.append(idx)
+        #end for
+        # If SpliceAI is within VEP, the scores are read from the first transcript while parsing CSQ
+        self.SpAI_in_VEP = all(tag == VEP_TAG for tag in self.SpAItag_list)
+        SpAI_fields = {DStag: DStag for DStag in DStags} if self.SpAI_in_VEP else {}
+
+        # Transcripts are decoded in a single pass.
+        # dbNSFP values are resolved by transcript
+        self.csq_parser = CsqParser(vcf_obj.header, csq_fields, dbNSFP_fields, SpAI_fields, VEP_TAG)
+
+        cohort_sample_ids = vcf_obj.header.IDs_genotypes # This includes cases and controls
+        case_sample_ids =  get_cases(sample_info)
+
+        # Verify that every case ID is present in the cohort VCF
+        if(not set(case_sample_ids).issubset(set(cohort_sample_ids))):
+            raise Exception("Not every case ID could be found in the cohort VCF.")
+
+        self.genotype_counter = GenotypeCounter(cohort_sample_ids, case_sample_ids)
+        self.af_threshold_higlass = float(af_threshold_higlass)
+
+    def variant_info(self, record, regenie_results, fisher_batch):
+        '''
+        Returns the dict of results of the variant or None if it has no VEP annotation.
+        The Fisher tests are queued in fisher_batch and resolved in write_variant_results
+        '''
+        profiler = self.profiler
+        t = profiler.start()
+        id = record.ID
+        # Retrieve annotations and allele counts
+        try: vep_tag_value = record.get_tag_value(VEP_TAG)
+        except Exception: return None
+
+        transcript = self.csq_parser.parse(vep_tag_value)
+        worst_consequence = transcript.worst_consequence
+        impact = transcript.impact
+        transcript_id = transcript.transcript_id
+
+        cadd_phred = transcript.cadd_phred
+        cadd_raw_rs = transcript.cadd_raw_rs
+
+        polyphen_pred = transcript.polyphen_pred
+        polyphen_rankscore = transcript.polyphen_rankscore
+        polyphen_score = transcript.polyphen_score
+
+        gerp_score = transcript.gerp_score
+        gerp_rankscore = transcript.gerp_rankscore
+
+        sift_rankscore = transcript.sift_rankscore
+        sift_pred = transcript.sift_pred
+        sift_score = transcript.sift_score
+
+        # Get max SpliceAI max_ds
+        if self.SpAI_in_VEP:
+            spliceai_score_max = get_maxds_values([getattr(transcript, DStag) for DStag in DStags])
+        else:
+            spliceai_score_max = get_maxds(record, self.SpAItag_list, self.SpAI_idx_list)
+        spliceai_score_max = spliceai_score_max if spliceai_score_max else ''
+
+        gnomADg_AC = transcript.gnomADg_AC
+        gnomADg_AN = transcript.gnomADg_AN
+        gnomADg_AF = transcript.gnomADg_AF
+        gnomADe2_AC = transcript.gnomADe2_AC
+        gnomADe2_AN = transcript.gnomADe2_AN
+        gnomADe2_AF = transcript.gnomADe2_AF
+        t = profiler.lap("parse_csq", t)
+
+        # count the genotypes (GT) of cases and controls
+        case_sample_gt_summarized, control_sample_gt_summarized = self.genotype_counter.count(record)
+
+        case_AC = case_sample_gt_summarized["AC"]
+        case_AN = case_sample_gt_summarized["AN"]
+        control_AC = control_sample_gt_summarized["AC"]
+        control_AN = control_sample_gt_summarized["AN"]
+        t = profiler.lap("count_genotypes", t)
+
+        # Queue Fisher calculations for the different control groups. They are run for the whole chunk at once
+        fisher_gnomADg = fisher_batch.add(gnomAD_table(case_AC, case_AN, gnomADg_AC, gnomADg_AN))
+        fisher_gnomADe2 = fisher_batch.add(gnomAD_table(case_AC, case_AN, gnomADe2_AC, gnomADe2_AN))
+        fisher_control = fisher_batch.add([case_AC, case_AN-case_AC, control_AC, control_AN-control_AC])
+        t = profiler.lap("queue_fisher", t)
+
+        regenie_result = regenie_results.get(record.CHROM, record.POS, id) or {}
+        t = profiler.lap("regenie_join", t)
+
+        # Include Higlass specific filtering into this logic
+        include_for_higlass = True
+        if gnomADg_AF and float(gnomADg_AF) > self.af_threshold_higlass:
+            include_for_higlass = False
+
+        vi = {
+            # We are adding these general infos here as well, so that we don't have to run parse_variants again later
+            "id": id,
+            "chrom": record.CHROM,
+            "pos": record.POS,
+            "ref": record.REF,
+            "alt": record.ALT,
+
+            "transcript": transcript_id,
+            "most_severe_consequence": worst_consequence,
+            "level_most_severe_consequence": impact,
+            "case_AC": case_AC,
+            "case_AN": case_AN,
+            "case_N": int(case_AN/2),
+            "case_AF": case_sample_gt_summarized["AF"],
+            "control_AC": control_AC,
+            "control_AN": control_AN,
+            "control_N": int(control_AN/2),
+            "control_AF": control_sample_gt_summarized["AF"],  
+
+            "cadd_raw_rs": cadd_raw_rs,
+            "cadd_phred": cadd_phred,
+            "polyphen_pred": polyphen_pred,
+            "polyphen_rankscore": polyphen_rankscore,
+            "polyphen_score": polyphen_score,
+            "gerp_score": gerp_score,
+            "gerp_rankscore": gerp_rankscore,
+            "sift_rankscore": sift_rankscore,
+            "sift_pred": sift_pred,
+            "sift_score": sift_score,
+            "spliceai_score_max": spliceai_score_max,
+
+            "gnomADg_AC": gnomADg_AC,
+            "gnomADg_AN": gnomADg_AN,
+            "gnomADg_AF": gnomADg_AF,
+            "gnomADe2_AC": gnomADe2_AC,
+            "gnomADe2_AN": gnomADe2_AN,
+            "gnomADe2_AF": gnomADe2_AF,
+            # Handles into fisher_batch. Replaced by the test results in write_variant_results
+            "fisher_gnomADg": fisher_gnomADg,
+            "fisher_gnomADe2": fisher_gnomADe2,
+            "fisher_control": fisher_control,
+
+            "regenie_ml10p" : regenie_result.get("regenie_ml10p", ""),
+            "regenie_beta" : regenie_result.get("regenie_beta", ""),
+            "regenie_chisq" : regenie_result.get("regenie_chisq", ""),
+            "regenie_se" : regenie_result.get("regenie_se", ""),
+            "regenie_test": regenie_result.get("regenie_test", ""),
+
+            "include_for_higlass": include_for_higlass
+        }
+        profiler.lap("build_result", t)
+        return vi
+
+
+def process_variants(records, builder, regenie_results, fisher_batch, f_out, f_out_hg, summary=None):
+    '''
+    Processes records in chunks of NUM_VARIANTS_TO_PROCESS variants.
+    Fisher tests are run for all variants of a chunk at once before they are written.
+    The results are added to summary if it is a ResultSummary
+    '''
+    profiler = builder.profiler
+    pending_variants = []
+    for record in profiler.iterate("read_vcf", records):
+        if len(pending_variants) == NUM_VARIANTS_TO_PROCESS:
+            write_variant_results(pending_variants, fisher_batch, f_out, f_out_hg, profiler, summary)
+            profiler.chunk("variants", len(pending_variants))
+            pending_variants = []
+
+        try:
+            vi = builder.variant_info(record, regenie_results, fisher_batch)
+        except Exception:
+            raise ValueError(f'ERROR processing variant_infos for variant {record.ID}')
+        if vi is not None:
+            pending_variants.append(vi)
+
+    write_variant_results(pending_variants, fisher_batch, f_out, f_out_hg, profiler, summary)
+    profiler.chunk("variants", len(pending_variants))
+
+
+################################################
+#   Region workers
+################################################
+
+class RecordFile(object):
+    ''' Plain text file with the write_record method of BgzfWriter '''
+
+    def __init__(self, handle):
+        self.handle = handle
+
+    def write(self, text):
+        self.handle.write(text)
 
-    return 'NA', 'NA', 'NA'
+    write_record = write
 
+    def writelines(self, lines):
+        self.handle.writelines(lines)
+
+
+def parse_region_variants(vcf_obj, index, regions):
+    ''' generator over the records of regions [(chrom, start, end), ...] as Variant objects, see Vcf.parse_variants '''
+    with BgzfReader(vcf_obj.inputfile) as reader:
+        for chrom, start, end in regions:
+            for line in reader.fetch(index, chrom, start, end):
+                line_strip = line.rstrip()
+                if line_strip:
+                    yield vcf_obj.Variant(line_strip, vcf_obj.header.IDs_genotypes)
+
+
+def region_group_lookup(region_groups):
+    ''' returns a function that maps (chrom, pos) to the index of the region group containing it '''
+    starts, groups = {}, {}
+    for i, regions in enumerate(region_groups):
+        for chrom, start, _ in regions:
+            starts.setdefault(chrom, []).append(start)
+            groups.setdefault(chrom, []).append(i)
+
+    def group_of(chrom, pos):
+        if chrom not in starts:
+            return None
+        j = bisect.bisect_right(starts[chrom], pos) - 1
+        return groups[chrom][j] if j >= 0 else None
+    return group_of
+
+
+# State of a worker process, set up once by init_worker
+_worker = {}
+
+def init_worker(annotated_vcf, sample_info, af_threshold_higlass, fisher_cache, fisher_cache_size, profile, summary_top_hits):
+    vcf_obj = vcf_parser.Vcf(annotated_vcf)
+    # Phases recorded by workers are sent back to the main process with the results
+    profiler = PhaseProfiler() if profile else NullProfiler()
+    cache = FisherCache(fisher_cache_size, ROUND_DIGITS)
+    if fisher_cache:
+        cache.load(fisher_cache)
+    # New results are sent back to the main process, which keeps the cache that is stored
+    cache.journal = []
+    _worker.update(
+        vcf_obj=vcf_obj,
+        index=TabixIndex.read(annotated_vcf + ".tbi"),
+        builder=VariantResultBuilder(vcf_obj, sample_info, af_threshold_higlass, profiler),
+        cache=cache,
+        # Summaries of the regions are sent back to the main process and merged there
+        summary_top_hits=summary_top_hits,
+    )
+
+
+def process_region_group(task):
+    '''
+    Processes the records of a group of regions into plain text result files.
+    contigs is set if the Regenie results of the group are sorted and can be streamed
+    '''
+    regions, regenie_file, contigs, out_file, hg_file = task
+    cache = _worker["cache"]
+    hits, misses = cache.hits, cache.misses
+    if contigs:
+        regenie_results = RegenieMergeJoin(regenie_file, contigs)
+    else:
+        regenie_results = RegenieResultsDict(regenie_file)
+
+    summary = ResultSummary(_worker["summary_top_hits"]) if _worker["summary_top_hits"] is not None else None
+    records = parse_region_variants(_worker["vcf_obj"], _worker["index"], regions)
+    with open(out_file, "w") as f_out, open(hg_file, "w") as f_out_hg:
+        process_variants(records, _worker["builder"], regenie_results, FisherBatch(ROUND_DIGITS, cache), f_out, RecordFile(f_out_hg), summary)
+
+    journal, cache.journal = cache.journal, []
+    profile = _worker["builder"].profiler.pop_stats()
+    return out_file, hg_file, cache.hits - hits, cache.misses - misses, journal, getattr(regenie_results, "num_unmatched", 0), profile, summary
+
+
+def process_regions(workers, annotated_vcf, regenie_output, sample_info, af_threshold_higlass, fisher_cache, fisher_cache_size, cache, f_out, f_out_hg, profiler, summary=None):
+    '''
+    Splits the annotated VCF into balanced regions using its tabix index and processes them
+    with a pool of workers. The results of the regions are written in coordinate order,
+    so the result files are the same for any number of workers.
+    The summaries of the regions are merged into summary if it is a ResultSummary.
+    Returns the number of unmatched Regenie results
+    '''
+    index_file = annotated_vcf + ".tbi"
+    if not os.path.exists(index_file):
+        raise Exception(f"{index_file} not found. The annotated VCF needs to be tabix indexed to use multiple workers.")
+    index = TabixIndex.read(index_file)
+    region_groups = index.balanced_regions(workers * REGIONS_PER_WORKER)
+    print(f"Processing {len(region_groups)} regions with {workers} workers.")
+
+    tmp_dir = tempfile.mkdtemp(prefix="variant_results_", dir=os.path.dirname(os.path.abspath(f_out.file_name)))
+    try:
+        # Each group of regions gets its share of the Regenie results
+        regenie_files = [os.path.join(tmp_dir, f"regenie_{i}.txt.gz") for i in range(len(region_groups))]
+        with profiler.phase("split_regenie"):
+            num_unmatched = split_regenie_results(regenie_output, region_group_lookup(region_groups), regenie_files)
+        if regenie_results_are_sorted(regenie_output, annotated_vcf):
+            print("Regenie results are sorted. Streaming them alongside the VCF.")
+            contigs = index.names
+        else:
+            print("WARNING: Regenie results are not sorted like the annotated VCF. Loading them into memory.")
+            contigs, num_unmatched = None, 0
+
+        tasks = [
+            (regions, regenie_files[i], contigs, os.path.join(tmp_dir, f"results_{i}.txt"), os.path.join(tmp_dir, f"higlass_{i}.vcf"))
+            for i, regions in enumerate(region_groups)
+        ]
+        initargs = (annotated_vcf, sample_info, af_threshold_higlass, fisher_cache, fisher_cache_size, profiler.enabled,
+                    summary.top_hits if summary is not None else None)
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            # imap returns the results in the order of the regions
+            for out_file, hg_file, hits, misses, journal, unmatched, profile, region_summary in pool.imap(process_region_group, tasks):
+                profiler.merge(profile)
+                t = profiler.start()
+                with open(out_file, "rb") as f_in:
+                    for data in iter(lambda: f_in.read(BGZF_BLOCK_SIZE), b""):
+                        f_out.write_data(data)
+                with open(hg_file) as f_in:
+                    f_out_hg.writelines(f_in)
+                os.remove(out_file)
+                os.remove(hg_file)
+                profiler.lap("merge_regions", t)
+
+                cache.hits += hits
+                cache.misses += misses
+                for table, result in journal:
+                    cache.put(table, result)
+                num_unmatched += unmatched
+                if summary is not None:
+                    summary.merge(region_summary)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return num_unmatched
+
+
+################################################
+#   Main
+################################################
 
 @click.command()
 @click.help_option("--help", "-h")
 @click.option("-r", "--regenie-output", required=True, type=str, help="Regenie output file")
 @click.option("-a", "--annotated-vcf", required=True, type=str, help="Annotated, jointly called VCF")
-@click.option("-s", "--sample-info", required=True, type=str, help="JSON string with sample info")
-@click.option("-o", "--out", required=True, type=str, help="the output file name of the variant level results (gzipped)")
+@click.option("-s", "--sample-info", required=True, type=str, help="JSON string with sample info, or the path of a JSON file with it")
+@click.option("-o", "--out", required=True, type=str, help="the output file name of the variant level results (bgzipped)")
 @click.option("-f", "--af-threshold-higlass", required=True, type=str, help="Rare variant AF threshold for variants to include in Higlass")
-@click.option("-e", "--higlass-vcf", required=True, type=str, help="Output Higlass VCF file containing the results (gzipped)")
-def main(regenie_output, annotated_vcf, sample_info, out, af_threshold_higlass, higlass_vcf):
+@click.option("-e", "--higlass-vcf", required=True, type=str, help="Output Higlass VCF file containing the results (bgzipped and tabix indexed)")
+@click.option("-m", "--multires-vcf", required=False, type=str, default=None, help="Also build the multi-resolution Higlass VCF (bgzipped and tabix indexed) while the Higlass VCF is written")
+@click.option("-k", "--multires-key", required=False, type=str, multiple=True, default=["fisher_ml10p_control"], show_default=True, help="INFO field the variants of the multi-resolution Higlass VCF are ranked by. With more than one, a file is written for every key, named after multires-vcf with .<key> before the extension")
+@click.option("--multires-max-per-tile", required=False, type=int, default=MAX_VARIANTS_PER_TILE, show_default=True, help="Number of variants per consequence level kept in a tile of the multi-resolution Higlass VCF")
+@click.option("--summary", required=False, type=str, default=None, help="Write a JSON summary of the results (top hits, Manhattan bins, QQ plot and lambda GC of every test) to this file")
+@click.option("--summary-top-hits", required=False, type=int, default=TOP_HITS, show_default=True, help="Number of variants with the lowest p-values per test in the summary")
+@click.option("--fisher-cache", required=False, type=str, default=None, help="Local file the Fisher exact test results are loaded from and stored to. Reruns of the same cohort (e.g. with a different AF threshold) skip the statistics")
+@click.option("--fisher-cache-size", required=False, type=int, default=FISHER_CACHE_SIZE, show_default=True, help="Maximum number of contingency tables kept in the Fisher cache. A table takes about 450 bytes (90 MB for 200000), the main process and every worker keep a cache of this size")
+@click.option("-w", "--workers", required=False, type=int, default=1, show_default=True, help="Number of worker processes. With more than one, the annotated VCF is processed in parallel by genomic region (requires the tabix index)")
+@click.option("--debug", is_flag=True, default=False, help="Print cache statistics")
+@click.option("--profile", required=False, type=str, default=None, help="Write wall time, calls and throughput of every phase of the script to this JSON file")
+@click.option("--cprofile", required=False, type=str, default=None, help="Write cProfile stats (pstats) of the main process to this file")
+def main(regenie_output, annotated_vcf, sample_info, out, af_threshold_higlass, higlass_vcf, multires_vcf, multires_key, multires_max_per_tile, summary, summary_top_hits, fisher_cache, fisher_cache_size, workers, debug, profile, cprofile):
     """This script takes a variant-based regenie output file and adds Fisher exact test results.
        It also produces a Higlass compatible VCF with some annotations
 
@@ -161,263 +564,120 @@ def main(regenie_output, annotated_vcf, sample_info, out, af_threshold_higlass,
 
     python create_variant_result_file.py -r /path/to/out.regenie -a regenie_input_source.vcf -o variant_level_results.txt.gz -e higlass_variant_tests.vcf
 
+    python create_variant_result_file.py -r /path/to/out.regenie -a regenie_input_source.vcf -o variant_level_results.txt.gz -e higlass_variant_tests.vcf.gz -m higlass_variant_tests.multires.vcf.gz -k fisher_ml10p_control -k regenie_ml10p
+
+    python create_variant_result_file.py -r /path/to/out.regenie -a regenie_input_source.vcf -o variant_level_results.txt.gz -e higlass_variant_tests.vcf.gz --summary variant_level_summary.json
+
+    python create_variant_result_file.py -r /path/to/out.regenie -a regenie_input_source.vcf -s sample_info.json -o variant_level_results.txt.gz -e higlass_variant_tests.vcf.gz
+
     """
 
+    profiler = get_profiler(profile, cprofile)
+    sample_info = read_sample_info(sample_info)
     vcf_obj = vcf_parser.Vcf(annotated_vcf)
-
-    # Get annotation indices
-    idx_transcript = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Ensembl_transcriptid')
-    idx_consequence = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Consequence')
-    idx_canonical = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'CANONICAL')
-    idx_impact = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'IMPACT')
-    idx_cadd_phred = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'CADD_PHRED') 
-    idx_cadd_rs = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'CADD_raw_rankscore')
-    idx_enst = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Feature')
-
-    idx_polyphen_pred = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Polyphen2_HVAR_pred')
-    idx_polyphen_rankscore = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Polyphen2_HVAR_rankscore')
-    idx_polyphen_score = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Polyphen2_HVAR_score')
-
-    idx_gerp_score = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'GERP++_RS')
-    idx_gerp_rankscore = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'GERP++_RS_rankscore')
-
-    idx_sift_rankscore = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SIFT_converted_rankscore')
-    idx_sift_pred = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SIFT_pred')
-    idx_sift_score = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SIFT_score')
-
-    # idx_spliceai_ds_ag = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SpliceAI_pred_DS_AG')
-    # idx_spliceai_ds_al = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SpliceAI_pred_DS_AL')
-    # idx_spliceai_ds_dg = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SpliceAI_pred_DS_DG')
-    # idx_spliceai_ds_dl = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'SpliceAI_pred_DS_DL')
-    # Get SpliceAI ds indexes
-    # DStags import from granite.shared_vars
-    SpAItag_list, SpAI_idx_list = [], []
-    for DStag in DStags:
-        tag, idx = vcf_obj.header.check_tag_definition(DStag)
-        SpAItag_list.append(tag)
-        SpAI_idx_list.append(idx)
-    #end for
-
-    # We want gnomAD v2 and v3 allele frequencies etc. to computer Fisher exact test scores
-    idx_gnomADg_AC = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'gnomADg_AC')
-    idx_gnomADg_AN = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'gnomADg_AN')
-    idx_gnomADg_AF = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'gnomADg_AF')
-    idx_gnomADe2_AC = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'gnomADe2_AC')
-    idx_gnomADe2_AN = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'gnomADe2_AN')
-    idx_gnomADe2_AF = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'gnomADe2_AF')
-
-    cohort_sample_ids = vcf_obj.header.IDs_genotypes # This includes cases and controls
-    case_sample_ids =  get_cases(sample_info)
-    control_sample_ids = [id for id in cohort_sample_ids if id not in case_sample_ids]
-
-    # Verify that every case ID is present in the cohort VCF
-    if(not set(case_sample_ids).issubset(set(cohort_sample_ids))):
-        raise Exception("Not every case ID could be found in the cohort VCF.")
-        
-
-    # Get VEP indexes
-    # Indexes to resolve dbNSFP values by transcript
-    for field in dbNSFP_fields:
-        dbNSFP_fields[field] = vcf_obj.header.get_tag_field_idx(VEP_TAG, field)
-    #end for
-
-    # Extract Regenie results - THIS MIGHT BE MEMORY INTENSIVE (since it is loading the whole file into memory)
-    regenie_results = parse_regenie_results(regenie_output)
-
-    # Everythin in the following list will be included in the Higlass result file
-    info_list = [
-         "transcript", "case_AC", "case_AN", "case_AF", "control_AC", "control_AN", "control_AF", "gnomADg_AC", "gnomADg_AN", "gnomADg_AF", "gnomADe2_AC", "gnomADe2_AN", "gnomADe2_AF", "most_severe_consequence", "level_most_severe_consequence", "cadd_raw_rs", "cadd_phred", "polyphen_pred", "polyphen_rankscore", "polyphen_score", "gerp_score", "gerp_rankscore", "sift_rankscore", "sift_pred", "sift_score", "spliceai_score_max", "fisher_or_gnomADg", "fisher_ml10p_gnomADg", "fisher_or_gnomADe2", "fisher_ml10p_gnomADe2", "fisher_or_control", "fisher_ml10p_control", "regenie_ml10p", "regenie_beta", "regenie_chisq", "regenie_se",
-    ]
+    builder = VariantResultBuilder(vcf_obj, sample_info, af_threshold_higlass, profiler)
 
     # Write headers of result files
-    f_out = gzip.open(out, 'wt')
-    header = get_variant_result_file_header()
+    # Both files are written through a single BGZF handle and indexed while they are written
+    f_out = BgzfWriter(out, variant_result_index())
+    header = variant_result_header()
     f_out.write(header)
-    f_out.close()
 
-    f_out_hg = gzip.open(higlass_vcf, 'wt')
+    f_out_hg = BgzfWriter(higlass_vcf, TabixIndex())
+    if multires_vcf:
+        # The multi-resolution tracks are aggregated from the records as they are written
+        keys = list(dict.fromkeys(multires_key))
+        tracks = [
+            MultiresTrack(multires_vcf if len(keys) == 1 else multires_output(multires_vcf, key), key, multires_max_per_tile)
+            for key in keys
+        ]
+        f_out_hg = MultiresWriter(f_out_hg, tracks)
     header_hg = get_variant_result_higlass_file_header()
     f_out_hg.write(header_hg)
-    f_out_hg.close()
-
-
-    num_variants = 0
-    result_file_content = "" # Collect new content for the variant result file here and append it to "out"
-    result_hg_file_content = "" # Collect new content for the Higlass variant result file here and append it to "out"
-    
-    for record in vcf_obj.parse_variants():
-        num_variants += 1
-        if num_variants % NUM_VARIANTS_TO_PROCESS == 0:
-            f_out = gzip.open(out, 'at')
-            f_out.write(result_file_content)
-            f_out.close()
-            result_file_content = ""
-
-            f_out_hg = gzip.open(higlass_vcf, 'at')
-            f_out_hg.write(result_hg_file_content)
-            f_out_hg.close()
-            result_hg_file_content = ""
-        
-        id = record.ID
-        # Retrieve annotations and allele counts
-        try: 
-            #vep_tag_value = record.get_tag_value(VEP_TAG)
-
-             # Clean dbNSFP by resolving values by transcript
-            VEP_clean = clean_dbnsfp(record, VEP_TAG, dbNSFP_fields, idx_transcript, idx_enst)
-            if not VEP_clean: continue
-
-            worst_transcript = get_worst_transcript(VEP_clean, idx_canonical, idx_consequence)
-            worst_transcript_ = worst_transcript.split('|')
-            worst_consequence = get_worst_consequence(worst_transcript_[idx_consequence])
-            impact = worst_transcript_[idx_impact]
-            transcript_id = worst_transcript_[idx_enst]
-
-            cadd_phred = worst_transcript_[idx_cadd_phred]
-            cadd_raw_rs = worst_transcript_[idx_cadd_rs]
-
-            polyphen_pred = worst_transcript_[idx_polyphen_pred]
-            polyphen_rankscore = worst_transcript_[idx_polyphen_rankscore]
-            polyphen_score = worst_transcript_[idx_polyphen_score]
-
-            gerp_score = worst_transcript_[idx_gerp_score]
-            gerp_rankscore = worst_transcript_[idx_gerp_rankscore]
-
-            sift_rankscore = worst_transcript_[idx_sift_rankscore]
-            sift_pred = worst_transcript_[idx_sift_pred]
-            sift_score = worst_transcript_[idx_sift_score]
-
-            # spliceai_ds_ag = worst_transcript_[idx_spliceai_ds_ag]
-            # spliceai_ds_al = worst_transcript_[idx_spliceai_ds_al]
-            # spliceai_ds_dg = worst_transcript_[idx_spliceai_ds_dg]
-            # spliceai_ds_dl = worst_transcript_[idx_spliceai_ds_dl]
-            # spliceai_score_max = max([spliceai_ds_ag,spliceai_ds_al,spliceai_ds_dg,spliceai_ds_dl])
-            # Get max SpliceAI max_ds
-            spliceai_score_max = get_maxds(record, SpAItag_list, SpAI_idx_list)
-            spliceai_score_max = spliceai_score_max if spliceai_score_max else ''
-
-            
-            gnomADg_AC = worst_transcript_[idx_gnomADg_AC]
-            gnomADg_AN = worst_transcript_[idx_gnomADg_AN]
-            gnomADg_AF = worst_transcript_[idx_gnomADg_AF]
-            gnomADe2_AC = worst_transcript_[idx_gnomADe2_AC]
-            gnomADe2_AN = worst_transcript_[idx_gnomADe2_AN]
-            gnomADe2_AF = worst_transcript_[idx_gnomADe2_AF]
-
-            # get the index for genotype (GT) and pull genotypes for all samples
-            GT_idx = record.FORMAT.split(":").index("GT")
-            case_sample_genotypes = {}
-            for sample in case_sample_ids:
-                case_sample_genotypes[sample] = record.GENOTYPES[sample].split(":")[GT_idx]
-
-            control_sample_genotypes = {}
-            for sample in control_sample_ids:
-                control_sample_genotypes[sample] = record.GENOTYPES[sample].split(":")[GT_idx]
-
-            case_sample_gt_summarized = summarize_genotypes(case_sample_genotypes, id)
-            control_sample_gt_summarized = summarize_genotypes(control_sample_genotypes, id)
-
-            case_AC = case_sample_gt_summarized["AC"]
-            case_AN = case_sample_gt_summarized["AN"]
-            control_AC = control_sample_gt_summarized["AC"]
-            control_AN = control_sample_gt_summarized["AN"]
-
-            # Perform Fisher calculations for the different control groups
-            fisher_p_gnomADg, fisher_or_gnomADg, fisher_ml10p_gnomADg = fisher_exact_gnomAD(case_AC, case_AN, gnomADg_AC, gnomADg_AN)
-            fisher_p_gnomADe2, fisher_or_gnomADe2, fisher_ml10p_gnomADe2 = fisher_exact_gnomAD(case_AC, case_AN, gnomADe2_AC, gnomADe2_AN)
-            fisher_p_control, fisher_or_control, fisher_ml10p_control = fisher_calculation(case_AC, case_AN-case_AC, control_AC, control_AN-control_AC) 
-
-            # Include Higlass specific filtering into this logic
-            include_for_higlass = True
-            if gnomADg_AF and float(gnomADg_AF) > float(af_threshold_higlass):
-                include_for_higlass = False
-
-            vi = {
-                # We are adding these general infos here as well, so that we don't have to run parse_variants again later
-                "chrom": record.CHROM,
-                "pos": record.POS,
-                "ref": record.REF,
-                "alt": record.ALT,
-
-                "transcript": transcript_id,
-                "most_severe_consequence": worst_consequence,
-                "level_most_severe_consequence": impact,
-                "case_AC": case_AC,
-                "case_AN": case_AN,
-                "case_N": int(case_AN/2),
-                "case_AF": case_sample_gt_summarized["AF"],
-                "control_AC": control_AC,
-                "control_AN": control_AN,
-                "control_N": int(control_AN/2),
-                "control_AF": control_sample_gt_summarized["AF"],  
-                                                                                            
-                "cadd_raw_rs": cadd_raw_rs,
-                "cadd_phred": cadd_phred,
-                "polyphen_pred": polyphen_pred,
-                "polyphen_rankscore": polyphen_rankscore,
-                "polyphen_score": polyphen_score,
-                "gerp_score": gerp_score,
-                "gerp_rankscore": gerp_rankscore,
-                "sift_rankscore": sift_rankscore,
-                "sift_pred": sift_pred,
-                "sift_score": sift_score,
-                "spliceai_score_max": spliceai_score_max,
-
-                "gnomADg_AC": gnomADg_AC,
-                "gnomADg_AN": gnomADg_AN,
-                "gnomADg_AF": gnomADg_AF,
-                "gnomADe2_AC": gnomADe2_AC,
-                "gnomADe2_AN": gnomADe2_AN,
-                "gnomADe2_AF": gnomADe2_AF,
-                "fisher_p_gnomADg": fisher_p_gnomADg,
-                "fisher_or_gnomADg": fisher_or_gnomADg,
-                "fisher_ml10p_gnomADg": fisher_ml10p_gnomADg,
-                "fisher_p_gnomADe2": fisher_p_gnomADe2,
-                "fisher_or_gnomADe2": fisher_or_gnomADe2,
-                "fisher_ml10p_gnomADe2": fisher_ml10p_gnomADe2,
-                "fisher_p_control": fisher_p_control,
-                "fisher_or_control": fisher_or_control,
-                "fisher_ml10p_control": fisher_ml10p_control,
-
-                "regenie_ml10p" : regenie_results[id]["regenie_ml10p"] if id in regenie_results else "",
-                "regenie_beta" : regenie_results[id]["regenie_beta"] if id in regenie_results else "",
-                "regenie_chisq" : regenie_results[id]["regenie_chisq"] if id in regenie_results else "",
-                "regenie_se" : regenie_results[id]["regenie_se"] if id in regenie_results else "",
-                "regenie_test": regenie_results[id]["regenie_test"] if id in regenie_results else "",
-
-                "include_for_higlass": include_for_higlass
-            }
 
+    # Top hits, Manhattan bins and p-value quantiles are accumulated while the results are written
+    result_summary = ResultSummary(summary_top_hits) if summary else None
+
+    cache = FisherCache(fisher_cache_size, ROUND_DIGITS)
+    if fisher_cache:
+        cache.load(fisher_cache)
+
+    if workers > 1:
+        num_unmatched = process_regions(workers, annotated_vcf, regenie_output, sample_info, af_threshold_higlass, fisher_cache, fisher_cache_size, cache, f_out, f_out_hg, profiler, result_summary)
+    else:
+        # Regenie results are streamed alongside the VCF if they are sorted the same way.
+        # Otherwise they are loaded into memory
+        regenie_results = get_regenie_results(regenie_output, annotated_vcf)
+        process_variants(vcf_obj.parse_variants(), builder, regenie_results, FisherBatch(ROUND_DIGITS, cache), f_out, f_out_hg, result_summary)
+        num_unmatched = getattr(regenie_results, "num_unmatched", 0)
+
+    with profiler.phase("close"):
+        f_out.close()
+        f_out_hg.close()
+
+    if num_unmatched:
+        print(f"WARNING: {num_unmatched} Regenie results did not match a variant in the annotated VCF.")
+    print(cache.stats())
+    if debug:
+        print(consequence_cache_stats())
+    if fisher_cache:
+        cache.save(fisher_cache)
+    if result_summary is not None:
+        result_summary.write(summary)
+        print(result_summary.stats())
+    profiler.write()
+
+
+def write_variant_results(variants, fisher_batch, f_out, f_out_hg, profiler=None, summary=None):
+    '''
+    Runs the queued Fisher exact tests of a chunk of variants and
+    writes the variants to the variant result file and the Higlass VCF.
+    The variants are added to summary if it is a ResultSummary
+    '''
+    profiler = profiler or NullProfiler()
+    t = profiler.start()
+    fisher_batch.compute()
+    t = profiler.lap("fisher", t, len(fisher_batch))
+
+    lines, lines_hg = [], []
+    for vi in variants:
+        id = vi["id"]
+        try:
+            for test in ["gnomADg", "gnomADe2", "control"]:
+                fisher_p, fisher_or, fisher_ml10p = fisher_batch.result(vi.pop(f"fisher_{test}"))
+                vi[f"fisher_p_{test}"] = fisher_p
+                vi[f"fisher_or_{test}"] = fisher_or
+                vi[f"fisher_ml10p_{test}"] = fisher_ml10p
 
             for key in vi:
                 if vi[key] == '':
                     vi[key] = 'NA'
 
-            result_file_content += f"{vi['chrom']} {vi['pos']} {id} {vi['ref']} {vi['alt']} {vi['regenie_test']} {vi['regenie_beta']} {vi['regenie_se']} {vi['regenie_chisq']} {vi['regenie_ml10p']} {vi['case_AF']} {vi['case_N']} {vi['control_AF']} {vi['control_N']} {vi['fisher_ml10p_control']} {vi['fisher_or_control']}  {vi['fisher_ml10p_gnomADg']} {vi['fisher_or_gnomADg']} {vi['fisher_ml10p_gnomADe2']} {vi['fisher_or_gnomADe2']} {vi['cadd_raw_rs']} {vi['cadd_phred']} {vi['polyphen_pred']} {vi['polyphen_rankscore']} {vi['polyphen_score']} {vi['gerp_score']} {vi['gerp_rankscore']} {vi['sift_rankscore']} {vi['sift_pred']} {vi['sift_score']} {vi['spliceai_score_max']}\n"
+            if summary is not None:
+                summary.add(vi)
+
+            lines.append(f"{vi['chrom']}\t{vi['pos']}\t{id}\t{vi['ref']}\t{vi['alt']}\t{vi['regenie_test']}\t{vi['regenie_beta']}\t{vi['regenie_se']}\t{vi['regenie_chisq']}\t{vi['regenie_ml10p']}\t{vi['case_AF']}\t{vi['case_N']}\t{vi['control_AF']}\t{vi['control_N']}\t{vi['fisher_ml10p_control']}\t{vi['fisher_or_control']}\t{vi['fisher_ml10p_gnomADg']}\t{vi['fisher_or_gnomADg']}\t{vi['fisher_ml10p_gnomADe2']}\t{vi['fisher_or_gnomADe2']}\t{vi['cadd_raw_rs']}\t{vi['cadd_phred']}\t{vi['polyphen_pred']}\t{vi['polyphen_rankscore']}\t{vi['polyphen_score']}\t{vi['gerp_score']}\t{vi['gerp_rankscore']}\t{vi['sift_rankscore']}\t{vi['sift_pred']}\t{vi['sift_score']}\t{vi['spliceai_score_max']}\n")
 
             info = ""
-            for field in info_list:
+            for field in INFO_LIST:
                 if vi[field] == 'NA':
                     continue
                 info+=field+"="+str(vi[field])+";"
             info = info.strip(";")
             
             if vi["include_for_higlass"]:
-                result_hg_file_content += f"{vi['chrom']}\t{vi['pos']}\t{id}\t{vi['ref']}\t{vi['alt']}\t0\tPASS\t{info}\n"
+                lines_hg.append(f"{vi['chrom']}\t{vi['pos']}\t{id}\t{vi['ref']}\t{vi['alt']}\t0\tPASS\t{info}\n")
 
         except Exception: 
             raise ValueError(f'ERROR processing variant_infos for variant {id}')
+    t = profiler.lap("format", t, len(variants))
 
+    # Compression happens while writing
+    f_out.writelines(lines)
+    f_out_hg.writelines(lines_hg)
+    profiler.lap("write", t, len(variants))
 
-    f_out = gzip.open(out, 'at')
-    f_out.write(result_file_content)
-    f_out.close()
-    result_file_content = ""
-
-    f_out_hg = gzip.open(higlass_vcf, 'at')
-    f_out_hg.write(result_hg_file_content)
-    f_out_hg.close()
-    result_hg_file_content = ""
+    fisher_batch.clear()
 
 
 
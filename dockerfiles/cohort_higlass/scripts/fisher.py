@@ -0,0 +1,318 @@
+################################################
+#   Libraries
+################################################
+
+import gzip
+import json
+import math
+import os
+from collections import OrderedDict
+import numpy as np
+from scipy.special import gammaln
+from scipy.stats import fisher_exact
+
+
+################################################
+#   Top level variables
+################################################
+
+# significant digits when calculated above 1
+# e.g., OR and log10
+ROUND_DIGITS = 4
+
+# Relative size below which the next hypergeometric term no longer changes the tail sum
+TAIL_TOLERANCE = 1e-18
+
+# Results that land this close to a rounding boundary (in units of the last rounded
+# digit) are recomputed with the scalar scipy path so that the rounded output is
+# identical to fisher_calculation
+ROUNDING_GUARD = 1e-3
+# scipy returns exactly 1 if 1 - p is below P_ONE and exactly 0 if log(p) is below
+# LOG_P_ZERO. The ranges in between are recomputed with the scalar scipy path as well
+P_ONE = 1e-20
+P_ONE_GUARD = 1e-9
+LOG_P_ZERO = -800.0
+LOG_P_ZERO_GUARD = -700.0
+
+# Maximum number of contingency tables kept in the Fisher cache.
+# An entry takes about 450 bytes, 200000 entries about 90 MB per process
+FISHER_CACHE_SIZE = 200000
+
+
+################################################
+#   Functions
+################################################
+
+def fisher_calculation(proband_alt, proband_ref, gnomAD_alt, gnomAD_ref, round_digits=ROUND_DIGITS):
+    '''
+    Runs a single one-sided ("greater") Fisher exact test with scipy.
+    Returns a tuple: p_value, oddsratio_rounded, minuslog10p
+    '''
+    oddsratio, pvalue = fisher_exact([[proband_alt, proband_ref], [gnomAD_alt, gnomAD_ref]], alternative='greater')
+    oddsratio_rounded = round(oddsratio, round_digits)
+    minuslog10p = 0 if pvalue == 0 else round(-math.log10(pvalue), round_digits)
+    return pvalue, oddsratio_rounded, minuslog10p
+
+
+class LogFactorialTable(object):
+    ''' log(n!) for n = 0..size-1, grown on demand '''
+
+    def __init__(self, size=1024):
+        self.values = gammaln(np.arange(size, dtype=np.float64) + 1)
+
+    def __getitem__(self, idx):
+        return self.values[idx]
+
+    def ensure(self, n):
+        ''' make sure log(n!) is available '''
+        if n < len(self.values):
+            return
+        size = len(self.values)
+        while size <= n:
+            size *= 2
+        self.values = gammaln(np.arange(size, dtype=np.float64) + 1)
+
+
+LOG_FACTORIALS = LogFactorialTable()
+
+
+def _log_hypergeom_pmf(x, N, n1, K, lf):
+    ''' log P(X = x) for X ~ Hypergeom(N, n1, K), vectorized '''
+    n2 = N - n1
+    return (lf[n1] + lf[n2] + lf[K] + lf[N - K] - lf[N]
+            - lf[x] - lf[n1 - x] - lf[K - x] - lf[n2 - K + x])
+
+
+def _sum_tail(start, stop, step, N, n1, K, lf):
+    '''
+    Sums the hypergeometric pmf from start towards stop (inclusive), moving by step (+1 or -1)
+    away from the mode, so that terms only decrease. Returns log of the first term and
+    the sum relative to that first term.
+    '''
+    log_first = _log_hypergeom_pmf(start, N, n1, K, lf)
+    n2 = N - n1
+    total = np.ones(len(start), dtype=np.float64)
+    term = np.ones(len(start), dtype=np.float64)
+    x = start.astype(np.int64)
+
+    active = np.flatnonzero(x != stop)
+    while len(active):
+        xa = x[active]
+        if step > 0:
+            # pmf(x+1) / pmf(x)
+            ratio = ((n1[active] - xa) * (K[active] - xa)) / ((xa + 1) * (n2[active] - K[active] + xa + 1))
+        else:
+            # pmf(x-1) / pmf(x)
+            ratio = (xa * (n2[active] - K[active] + xa)) / ((n1[active] - xa + 1) * (K[active] - xa + 1))
+        term[active] *= ratio
+        total[active] += term[active]
+        x[active] = xa + step
+        keep = (x[active] != stop[active]) & (term[active] > TAIL_TOLERANCE * total[active])
+        active = active[keep]
+    return log_first, total
+
+
+def fisher_exact_greater_batch(tables, round_digits=ROUND_DIGITS):
+    '''
+    Vectorized equivalent of calling fisher_calculation on every row of tables.
+
+    tables is an integer array of shape (n, 4) with the 2x2 contingency tables
+    flattened as [[a, b], [c, d]] -> [a, b, c, d].
+    Returns a list of (p_value, oddsratio_rounded, minuslog10p) tuples.
+
+    The upper tail P(X >= a) is summed with the pmf recurrence starting from a
+    log-factorial evaluation of the first term. Tables where a lies below the mode are
+    computed as 1 - P(X <= a-1). Rows that could round differently from scipy are
+    recomputed with fisher_calculation.
+    '''
+    tables = np.asarray(tables, dtype=np.int64).reshape(-1, 4)
+    n_tables = len(tables)
+    if n_tables == 0:
+        return []
+    if (tables < 0).any():
+        raise ValueError("All values in `table` must be nonnegative.")
+
+    a, b, c, d = tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3]
+    n1 = a + b
+    n2 = c + d
+    K = a + c
+    N = n1 + n2
+
+    # Degenerate tables: scipy returns (nan, 1.0)
+    degenerate = (n1 == 0) | (n2 == 0) | (K == 0) | (b + d == 0)
+
+    # Odds ratio as in scipy, rounded the same way round() rounds a numpy float
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratio = np.where((c > 0) & (b > 0), (a * d) / (c * b), np.inf)
+    oddsratio[degenerate] = np.nan
+    oddsratio_rounded = np.round(oddsratio, round_digits)
+
+    pvalue = np.ones(n_tables, dtype=np.float64)
+    scalar = np.zeros(n_tables, dtype=bool)
+
+    lower = np.maximum(0, K - n2)
+    upper = np.minimum(n1, K)
+    mode = ((n1 + 1) * (K + 1)) // (N + 2)
+    # a == lower means the whole support is included -> p is exactly 1
+    to_compute = ~degenerate & (a > lower)
+
+    if to_compute.any():
+        LOG_FACTORIALS.ensure(int(N[to_compute].max()))
+        lf = LOG_FACTORIALS
+
+        # Upper tail, summed from a upwards
+        idx = np.flatnonzero(to_compute & (a >= mode))
+        if len(idx):
+            log_first, total = _sum_tail(a[idx], upper[idx], 1, N[idx], n1[idx], K[idx], lf)
+            log_p = log_first + np.log(total)
+            pvalue[idx] = np.exp(log_p)
+            scalar[idx] = (log_p >= LOG_P_ZERO) & (log_p < LOG_P_ZERO_GUARD)
+            pvalue[idx[log_p < LOG_P_ZERO]] = 0.0
+
+        # Complement of the lower tail, summed from a-1 downwards
+        idx = np.flatnonzero(to_compute & (a < mode))
+        if len(idx):
+            log_first, total = _sum_tail(a[idx] - 1, lower[idx], -1, N[idx], n1[idx], K[idx], lf)
+            complement = np.exp(log_first) * total
+            pvalue[idx] = np.where(complement < P_ONE, 1.0, 1.0 - complement)
+            scalar[idx] = (complement >= P_ONE) & (complement < P_ONE_GUARD)
+
+        pvalue = np.minimum(pvalue, 1.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        minuslog10p = -np.log10(pvalue)
+        scaled = minuslog10p * 10 ** round_digits
+        scalar |= to_compute & (np.abs(scaled - np.floor(scaled) - 0.5) < ROUNDING_GUARD)
+
+    results = []
+    for i, (p, or_r, ml10p) in enumerate(zip(pvalue.tolist(), oddsratio_rounded.tolist(), minuslog10p.tolist())):
+        if scalar[i]:
+            results.append(fisher_calculation(*tables[i].tolist(), round_digits=round_digits))
+        elif p == 0:
+            results.append((p, or_r, 0))
+        else:
+            results.append((p, or_r, round(ml10p, round_digits)))
+    return results
+
+
+class FisherCache(object):
+    '''
+    Bounded LRU cache of Fisher exact test results keyed on the contingency table (a, b, c, d).
+    Rare variants produce the same few tables over and over, so most tests of a chunk
+    can be answered from here. The cache can be stored to and restored from a local file.
+    '''
+
+    def __init__(self, max_size=FISHER_CACHE_SIZE, round_digits=ROUND_DIGITS):
+        self.max_size = max_size
+        self.round_digits = round_digits
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # If set to a list, entries added with put() are recorded in it as well
+        self.journal = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, table):
+        ''' returns the cached result for table or None '''
+        result = self.entries.get(table)
+        if result is not None:
+            self.entries.move_to_end(table)
+        return result
+
+    def put(self, table, result):
+        self.entries[table] = result
+        self.entries.move_to_end(table)
+        if self.journal is not None:
+            self.journal.append((table, result))
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0
+        return f"Fisher cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {len(self)} tables cached"
+
+    def load(self, cache_file):
+        ''' restores entries stored with save(), if the file exists and was created with the same rounding '''
+        if not os.path.exists(cache_file):
+            return
+        with gzip.open(cache_file, 'rt') as f:
+            content = json.load(f)
+        if content["round_digits"] != self.round_digits:
+            print(f"WARNING: {cache_file} was created with a different rounding. Ignoring it.")
+            return
+        # Entries are stored from least to most recently used
+        for a, b, c, d, pvalue, oddsratio, minuslog10p in content["tables"][-self.max_size:]:
+            self.entries[(a, b, c, d)] = (pvalue, oddsratio, minuslog10p)
+
+    def save(self, cache_file):
+        tables = [
+            [*table, float(pvalue), float(oddsratio), minuslog10p]
+            for table, (pvalue, oddsratio, minuslog10p) in self.entries.items()
+        ]
+        with gzip.open(cache_file, 'wt') as f:
+            json.dump({"round_digits": self.round_digits, "tables": tables}, f)
+
+
+class FisherBatch(object):
+    '''
+    Collects 2x2 tables for a chunk of variants and runs the Fisher exact tests
+    for all of them at once with fisher_exact_greater_batch.
+
+    add() returns a handle that can be resolved with result() after compute().
+    '''
+
+    NA = ('NA', 'NA', 'NA')
+
+    def __init__(self, round_digits=ROUND_DIGITS, cache=None):
+        self.round_digits = round_digits
+        self.cache = cache
+        self.tables = []
+        self.results = []
+
+    def __len__(self):
+        return len(self.tables)
+
+    def add(self, table):
+        ''' table is [a, b, c, d] or None if the test cannot be run '''
+        if table is None:
+            return None
+        if min(table) < 0:
+            raise ValueError("All values in `table` must be nonnegative.")
+        self.tables.append(tuple(table))
+        return len(self.tables) - 1
+
+    def compute(self):
+        if self.cache is None:
+            self.results = fisher_exact_greater_batch(self.tables, self.round_digits)
+            return
+
+        # Only tables that are neither cached nor repeated within the chunk are computed
+        self.results = [None] * len(self.tables)
+        missing = {}
+        for i, table in enumerate(self.tables):
+            result = self.cache.get(table)
+            if result is None:
+                missing.setdefault(table, []).append(i)
+            else:
+                self.results[i] = result
+
+        computed = fisher_exact_greater_batch(list(missing), self.round_digits)
+        for (table, indices), result in zip(missing.items(), computed):
+            self.cache.put(table, result)
+            for i in indices:
+                self.results[i] = result
+
+        self.cache.misses += len(missing)
+        self.cache.hits += len(self.tables) - len(missing)
+
+    def result(self, handle):
+        if handle is None:
+            return self.NA
+        return self.results[handle]
+
+    def clear(self):
+        self.tables = []
+        self.results = []
@@ -16,9 +16,11 @@ printHelpAndExit() {
     echo "-b REGENIE_VARIANT_RESULTS : Regenie output"
     echo "-c REGENIE_GENE_RESULTS : Regenie output"
     echo "-d REGENIE_GENE_RESULTS_SNPLIST : Regenie output"
+    echo "-w WORKERS : number of processes used for the variant level results (default: number of CPUs)"
     exit "$1"
 }
-while getopts "v:s:g:a:r:b:c:d:" opt; do
+workers=$(nproc)
+while getopts "v:s:g:a:r:b:c:d:w:" opt; do
     case $opt in
         v) annotated_vcf="$OPTARG"
            annotated_vcf_tbi="$OPTARG.tbi"
@@ -30,6 +32,7 @@ while getopts "v:s:g:a:r:b:c:d:" opt; do
         b) regenie_variant_results=$OPTARG;;
         c) regenie_gene_results=$OPTARG;;
         d) regenie_gene_results_snplist=$OPTARG;;
+        w) workers=$OPTARG;;
         h) printHelpAndExit 0;;
         [?]) printHelpAndExit 1;;
         esac
@@ -109,33 +112,23 @@ convert-bed-to-bw -i coverage.bed \
 
 
 echo ""
-echo "== Create variant level result file and Higlass VCF =="
+echo "== Create variant level result file, Higlass VCF and its multilevel version =="
 
+# The multilevel version of the Higlass VCF (top variants per tile and consequence level at every zoom level,
+# ranked by fisher_ml10p_control) is aggregated while the Higlass VCF is written
 python "$SCRIPT_LOCATION"/create_variant_result_file.py -r "$regenie_variant_results" \
                                       -a "$annotated_vcf" \
                                       -s "$sample_info" \
                                       -o variant_level_results.txt.gz \
                                       -f "$af_threshold_higlass" \
-                                      -e higlass_variant_tests.gz || exit 1
-
-# higlass_variant_tests.gz is gzip compressed. Recompress here with bgzip
-gzip -cd higlass_variant_tests.gz | bgzip --threads 6 -c > higlass_variant_tests.vcf.gz || exit 1
-rm -f higlass_variant_tests.gz
-tabix -p vcf higlass_variant_tests.vcf.gz || exit 1
-
-echo ""
-echo "== Create multilevel version of the Higlass VCF =="
-# This needs "pip install cgap-higlass-data"
-# Skip sorting for now. It should already be sorted
-#cat higlass_variant_tests.vcf | awk '$1 ~ /^#/ {print $0;next} {print $0 | "sort -k1,1 -k2,2n"}' > higlass_variant_tests.sorted.vcf
-
-# Output will be compressed and indexed
-create-cohort-vcf -i higlass_variant_tests.vcf.gz \
-                  -o higlass_variant_tests.multires.vcf.gz \
-                  -c fisher_ml10p_control \
-                  -q True \
-                  -t True \
-                  -w True || exit 1
+                                      -e higlass_variant_tests.vcf.gz \
+                                      -m higlass_variant_tests.multires.vcf.gz \
+                                      -k fisher_ml10p_control \
+                                      --summary variant_level_summary.json \
+                                      -w "$workers" || exit 1
+# variant_level_results.txt.gz (tab separated, columns declared in the header), higlass_variant_tests.vcf.gz
+# and higlass_variant_tests.multires.vcf.gz are written bgzipped and tabix indexed
+# variant_level_summary.json has the top hits, Manhattan bins, QQ plot and lambda GC of every test
 
 
 echo ""
@@ -152,11 +145,8 @@ python "$SCRIPT_LOCATION"/create_higlass_gene_file.py -r "$regenie_gene_results"
                                    -g gene_annotations.tsv \
                                    -s "$regenie_gene_results_snplist" \
                                    -a "$aaf_bin" \
-                                   -o higlass_gene_tests.vcf || exit 1
-
-cat higlass_gene_tests.vcf | awk '$1 ~ /^#/ {print $0;next} {print $0 | "sort -k1,1 -k2,2n"}' > higlass_gene_tests.sorted.vcf || exit 1
-bgzip -c higlass_gene_tests.sorted.vcf > higlass_gene_tests.sorted.vcf.gz || exit 1
-tabix -p vcf higlass_gene_tests.sorted.vcf.gz || exit 1
+                                   -o higlass_gene_tests.sorted.vcf.gz || exit 1
+# higlass_gene_tests.sorted.vcf.gz is written sorted, bgzipped and tabix indexed
 
 
 echo ""
@@ -0,0 +1,277 @@
+################################################
+#   Libraries
+################################################
+
+import heapq
+import tempfile
+from operator import itemgetter
+from bgzf import BgzfWriter, TabixIndex
+
+
+################################################
+#   Top level variables
+################################################
+
+# Higlass tile size of 1D tracks. Tiles of zoom level z span TILE_SIZE * 2**z bp of the genome
+TILE_SIZE = 1024
+TILE_SIZE_BITS = 10
+MAX_ZOOM_LEVEL = 23
+
+# Variants are ranked separately for every consequence level
+CONSEQUENCE_LEVELS = ["HIGH", "LOW", "MODERATE", "MODIFIER"]
+CONSEQUENCE_KEY = "level_most_severe_consequence"
+
+# Default number of variants per consequence level kept in a tile
+MAX_VARIANTS_PER_TILE = 50
+
+# Chromosomes of hg38 in the order of the Higlass genome coordinates (negspy chromInfo)
+HG38_CHROM_SIZES = [
+    ("chr1", 248956422), ("chr2", 242193529), ("chr3", 198295559), ("chr4", 190214555),
+    ("chr5", 181538259), ("chr6", 170805979), ("chr7", 159345973), ("chr8", 145138636),
+    ("chr9", 138394717), ("chr10", 133797422), ("chr11", 135086622), ("chr12", 133275309),
+    ("chr13", 114364328), ("chr14", 107043718), ("chr15", 101991189), ("chr16", 90338345),
+    ("chr17", 83257441), ("chr18", 80373285), ("chr19", 58617616), ("chr20", 64444167),
+    ("chr21", 46709983), ("chr22", 50818468), ("chrX", 156040895), ("chrY", 57227415),
+    ("chrM", 16569),
+]
+
+# Chromosomes of the multires file, create-cohort-vcf -w True skips the others (get_chroms of cgap-higlass-data)
+MULTIRES_CHROMS = [f"chr{i}" for i in range(1, 23)] + ["chrX", "chrY"]
+
+
+################################################
+#   Functions
+################################################
+
+def genome_offsets(chrom_sizes):
+    ''' {chrom: position of the chromosome start in genome coordinates} '''
+    offsets, offset = {}, 0
+    for chrom, size in chrom_sizes:
+        offsets[chrom] = offset
+        offset += size
+    return offsets
+
+
+def importance_value(value):
+    ''' ranking value of a variant, missing and NA values rank as 0 '''
+    if value is None or value == "" or value == "NA":
+        return 0.0
+    return float(value)
+
+
+def multires_output(out, key):
+    ''' output file of a ranking key, e.g. higlass_variant_tests.multires.regenie_ml10p.vcf.gz for higlass_variant_tests.multires.vcf.gz '''
+    for extension in (".vcf.gz", ".vcf"):
+        if out.endswith(extension):
+            return f"{out[:-len(extension)]}.{key}{extension}"
+    return f"{out}.{key}"
+
+
+################################################
+#   Classes
+################################################
+
+class Tile(object):
+    '''
+    Variants of a tile that can still be selected. Every consequence level has a heap
+    of its top variants, variants of other consequences are only kept while the tile
+    has fewer than the maximum number of variants
+    '''
+
+    __slots__ = ("index", "count", "heaps", "others")
+
+    def __init__(self, index):
+        self.index = index
+        self.count = 0
+        self.heaps = {}
+        self.others = []
+
+    def add(self, entry, consequence, max_variants):
+        ''' adds (importance, -sequence number, ...) of a variant, returns False if it can not be selected '''
+        if consequence not in CONSEQUENCE_LEVELS:
+            if self.count >= max_variants:
+                self.others = []
+                return False
+            self.others.append(entry)
+            return True
+        heap = self.heaps.get(consequence)
+        if heap is None:
+            self.heaps[consequence] = [entry]
+        elif len(heap) < max_variants:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        else:
+            return False
+        return True
+
+    def selected(self, max_variants):
+        ''' entries of the selected variants, in input order '''
+        entries = [entry for heap in self.heaps.values() for entry in heap]
+        if self.count < max_variants:
+            entries += self.others
+        entries.sort(key=itemgetter(1), reverse=True)
+        return entries
+
+
+class MultiresTrack(object):
+    '''
+    Builds the multi-resolution version of the Higlass variant VCF while its records
+    are written, the same selection as create-cohort-vcf of cgap-higlass-data.
+
+    Every chromosome of MULTIRES_CHROMS is aggregated on its own, variants of other
+    chromosomes are not written. Zoom level 0 has all variants. Zoom level z > 0 splits
+    the genome into tiles of TILE_SIZE * 2**z bp of hg38 genome coordinates, a tile has
+    the variants of one chromosome: tiles with fewer than max_variants variants keep all
+    of them, other tiles keep the max_variants variants with the highest importance_key
+    of every consequence level. Variants are written with CHROM <chrom>_<zoom level>, by
+    zoom level and tile, in input order within a tile. Variants with the same importance
+    are selected in input order. IDs are kept, create-cohort-vcf numbers the variants.
+
+    Only the open tile of every zoom level is kept in memory. The records of a chromosome
+    have to be added together and sorted by position. A tile is written to a temporary file
+    of its zoom level as soon as the records move past it, all tiles are written when the
+    chromosome changes. A variant that is not selected in a tile can not be selected in
+    the larger tiles, so it is only counted there.
+    '''
+
+    def __init__(self, file_name, importance_key, max_variants=MAX_VARIANTS_PER_TILE, chrom_sizes=HG38_CHROM_SIZES):
+        self.file_name = file_name
+        self.importance_key = importance_key
+        self.max_variants = max_variants
+        self.offsets = {chrom: offset for chrom, offset in genome_offsets(chrom_sizes).items() if chrom in MULTIRES_CHROMS}
+        self.writer = BgzfWriter(file_name, TabixIndex())
+        # Open tile and selected records of zoom levels 1 to MAX_ZOOM_LEVEL - 1, index 0 is unused
+        self.tiles = [None] * MAX_ZOOM_LEVEL
+        self.levels = [None] + [tempfile.TemporaryFile("w+") for _ in range(1, MAX_ZOOM_LEVEL)]
+        self.num_variants = 0
+        self.chrom = None
+        self.last_pos = -1
+        self.done_chroms = set()
+        self.skipped_chroms = set()
+        self.unknown_consequences = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        ''' writes header lines '''
+        self.writer.write(text)
+
+    def add(self, chrom, pos, rest, info):
+        '''
+        adds a record. rest is the line after CHROM, info is {tag: value} of its INFO field
+        '''
+        if chrom != self.chrom:
+            if chrom not in self.offsets:
+                self.skipped_chroms.add(chrom)
+                return
+            self._write_tiles()
+            if chrom in self.done_chroms:
+                raise ValueError(f"{self.file_name}: records of {chrom} are not together, {chrom}:{pos} is out of order")
+            self.done_chroms.add(chrom)
+            self.chrom, self.last_pos = chrom, -1
+        if pos < self.last_pos:
+            raise ValueError(f"{self.file_name}: records are not sorted by position, {chrom}:{pos} is out of order")
+        self.last_pos = pos
+
+        self.writer.write_record(f"{chrom}_0{rest}")
+        genome_pos = self.offsets[chrom] + pos
+
+        consequence = info.get(CONSEQUENCE_KEY)
+        if consequence not in CONSEQUENCE_LEVELS:
+            self.unknown_consequences += 1
+        entry = (importance_value(info.get(self.importance_key)), -self.num_variants, rest)
+        self.num_variants += 1
+
+        tiles, max_variants = self.tiles, self.max_variants
+        for zoom_level in range(1, MAX_ZOOM_LEVEL):
+            tile_index = genome_pos >> (TILE_SIZE_BITS + zoom_level)
+            tile = tiles[zoom_level]
+            if tile is None or tile.index != tile_index:
+                self._write_tile(zoom_level)
+                tile = tiles[zoom_level] = Tile(tile_index)
+            tile.count += 1
+            if not tile.add(entry, consequence, max_variants):
+                # The tiles of the higher zoom levels are the same as for the previous record
+                for zoom_level_ in range(zoom_level + 1, MAX_ZOOM_LEVEL):
+                    tiles[zoom_level_].count += 1
+                break
+
+    def _write_tile(self, zoom_level):
+        tile = self.tiles[zoom_level]
+        if tile is None:
+            return
+        level, chrom = self.levels[zoom_level], self.chrom
+        for _, _, rest in tile.selected(self.max_variants):
+            level.write(f"{chrom}_{zoom_level}{rest}")
+        self.tiles[zoom_level] = None
+
+    def _write_tiles(self):
+        for zoom_level in range(1, MAX_ZOOM_LEVEL):
+            self._write_tile(zoom_level)
+
+    def close(self):
+        if self.writer.closed:
+            return
+        try:
+            self._write_tiles()
+            for zoom_level in range(1, MAX_ZOOM_LEVEL):
+                level = self.levels[zoom_level]
+                level.seek(0)
+                for line in level:
+                    self.writer.write_record(line)
+        finally:
+            for level in self.levels[1:]:
+                level.close()
+            self.writer.close()
+        if self.skipped_chroms:
+            print(f"Variants of {', '.join(sorted(self.skipped_chroms))} are not written to {self.file_name}.")
+        if self.unknown_consequences:
+            print(f"WARNING: {self.unknown_consequences} variants without a consequence level ({', '.join(CONSEQUENCE_LEVELS)}) in {self.file_name}.")
+
+
+class MultiresWriter(object):
+    '''
+    Writer of the Higlass variant VCF that feeds every record to MultiresTracks
+    (one per ranking key) while it is written. The records are parsed once for all tracks
+    '''
+
+    def __init__(self, writer, tracks):
+        self.writer = writer
+        self.tracks = tracks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        ''' writes header lines '''
+        self.writer.write(text)
+        for track in self.tracks:
+            track.write(text)
+
+    def write_record(self, line):
+        self.writer.write_record(line)
+        fields = line.rstrip("\n").split("\t", 8)
+        chrom, pos = fields[0], int(fields[1])
+        info = dict(item.partition("=")[::2] for item in fields[7].split(";"))
+        rest = line[len(chrom):]
+        for track in self.tracks:
+            track.add(chrom, pos, rest, info)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write_record(line)
+
+    def close(self):
+        try:
+            self.writer.close()
+        finally:
+            for track in self.tracks:
+                track.close()
@@ -0,0 +1,217 @@
+################################################
+#   Libraries
+################################################
+
+import heapq
+import json
+import math
+from scipy.stats import chi2
+
+
+################################################
+#   Top level variables
+################################################
+
+# Tests of the variant level results that are summarized, {name: result field with -log10(p)}
+SUMMARY_TESTS = {
+    "regenie": "regenie_ml10p",
+    "fisher_control": "fisher_ml10p_control",
+    "fisher_gnomADg": "fisher_ml10p_gnomADg",
+    "fisher_gnomADe2": "fisher_ml10p_gnomADe2",
+}
+
+# Number of variants with the lowest p-values kept per test
+TOP_HITS = 100
+
+# Width of the Manhattan plot bins in bp
+MANHATTAN_BIN_SIZE = 1000000
+
+# -log10(p) values are counted in bins of 1 / SKETCH_RESOLUTION for the quantiles (QQ plot, lambda GC)
+SKETCH_RESOLUTION = 1000
+
+# Median of the chi-squared distribution with 1 degree of freedom
+CHI2_MEDIAN = chi2.ppf(0.5, 1)
+
+# Digits of the floats in the summary file
+SUMMARY_DIGITS = 4
+
+# Note on lambda GC in the summary file
+LAMBDA_GC_NOTE = "lambda_gc is null when the median p-value is 1 (median -log10(p) in the lowest bin), e.g. for the one-sided Fisher tests"
+
+
+################################################
+#   Classes
+################################################
+
+class TestSummary(object):
+    '''
+    Bounded summary of the -log10(p) values of a test:
+    top hits (heap of the top_hits highest values), the maximum per chromosome and
+    bin of bin_size bp (Manhattan plot) and a histogram of the values with
+    1 / resolution wide bins (quantile sketch for the QQ plot and lambda GC)
+    '''
+
+    def __init__(self, top_hits=TOP_HITS, bin_size=MANHATTAN_BIN_SIZE, resolution=SKETCH_RESOLUTION):
+        self.top_hits = top_hits
+        self.bin_size = bin_size
+        self.resolution = resolution
+        self.num_values = 0
+        self.num_missing = 0
+        self.hits = []          # heap of (ml10p, id, chrom, pos)
+        self.manhattan = {}     # {chrom: {bin: max ml10p}}
+        self.histogram = {}     # {floor(ml10p * resolution): count}
+
+    def add(self, ml10p, chrom, pos, id):
+        if not math.isfinite(ml10p):
+            self.num_missing += 1
+            return
+        self.num_values += 1
+
+        hit = (ml10p, id, chrom, pos)
+        if len(self.hits) < self.top_hits:
+            heapq.heappush(self.hits, hit)
+        elif hit > self.hits[0]:
+            heapq.heapreplace(self.hits, hit)
+
+        bins = self.manhattan.get(chrom)
+        if bins is None:
+            bins = self.manhattan[chrom] = {}
+        bin_ = pos // self.bin_size
+        if ml10p > bins.get(bin_, -math.inf):
+            bins[bin_] = ml10p
+
+        key = math.floor(ml10p * self.resolution)
+        self.histogram[key] = self.histogram.get(key, 0) + 1
+
+    def merge(self, other):
+        ''' adds the values of another TestSummary of the same test, e.g. of another region '''
+        self.num_values += other.num_values
+        self.num_missing += other.num_missing
+        for hit in other.hits:
+            if len(self.hits) < self.top_hits:
+                heapq.heappush(self.hits, hit)
+            elif hit > self.hits[0]:
+                heapq.heapreplace(self.hits, hit)
+        for chrom, other_bins in other.manhattan.items():
+            bins = self.manhattan.setdefault(chrom, {})
+            for bin_, ml10p in other_bins.items():
+                if ml10p > bins.get(bin_, -math.inf):
+                    bins[bin_] = ml10p
+        for key, count in other.histogram.items():
+            self.histogram[key] = self.histogram.get(key, 0) + count
+
+    def quantile(self, q):
+        ''' -log10(p) at quantile q of the p-values (0 is the lowest p-value), None without values '''
+        if not self.num_values:
+            return None
+        # p-values in ascending order are -log10(p) in descending order
+        rank = q * self.num_values
+        cumulative = 0
+        for key in sorted(self.histogram, reverse=True):
+            cumulative += self.histogram[key]
+            if cumulative >= rank:
+                return (key + 0.5) / self.resolution
+        return (min(self.histogram) + 0.5) / self.resolution
+
+    def lambda_gc(self):
+        '''
+        genomic inflation factor, median chi-squared statistic of the p-values over the expected median.
+        None without values and when the median -log10(p) is 0 (in the lowest bin of the histogram),
+        where it is not defined, e.g. for one-sided Fisher tests with most p-values of 1
+        '''
+        median_ml10p = self.quantile(0.5)
+        if median_ml10p is None or median_ml10p * self.resolution < 1:
+            return None
+        return float(chi2.isf(10 ** -median_ml10p, 1) / CHI2_MEDIAN)
+
+    def qq(self):
+        '''
+        expected and observed -log10(p) of the QQ plot, one point per histogram bin.
+        The expected value of a bin is the one of its middle rank
+        '''
+        expected, observed = [], []
+        rank = 0
+        for key in sorted(self.histogram, reverse=True):
+            count = self.histogram[key]
+            middle_rank = rank + (count + 1) / 2
+            expected.append(round(-math.log10((middle_rank - 0.5) / self.num_values), SUMMARY_DIGITS))
+            observed.append(round((key + 0.5) / self.resolution, SUMMARY_DIGITS))
+            rank += count
+        return {"expected": expected, "observed": observed}
+
+    def to_dict(self):
+        lambda_gc = self.lambda_gc()
+        return {
+            "num_values": self.num_values,
+            "num_missing": self.num_missing,
+            "lambda_gc": round(lambda_gc, SUMMARY_DIGITS) if lambda_gc is not None else None,
+            "top_hits": [
+                {"chrom": chrom, "pos": pos, "id": id, "ml10p": ml10p}
+                for ml10p, id, chrom, pos in sorted(self.hits, reverse=True)
+            ],
+            "manhattan": {
+                chrom: [[bin_ * self.bin_size, ml10p] for bin_, ml10p in sorted(bins.items())]
+                for chrom, bins in self.manhattan.items()
+            },
+            "qq": self.qq(),
+        }
+
+
+class ResultSummary(object):
+    '''
+    Manhattan/QQ summary of the variant level results, accumulated while the results are written.
+    Every test in SUMMARY_TESTS has a TestSummary, the memory does not depend on the number
+    of variants. Summaries of regions processed by different workers are combined with merge.
+
+    Example:
+
+        summary = ResultSummary()
+        for vi in variant_infos:
+            summary.add(vi)
+        summary.write("variant_level_summary.json")
+    '''
+
+    def __init__(self, top_hits=TOP_HITS, bin_size=MANHATTAN_BIN_SIZE, resolution=SKETCH_RESOLUTION):
+        self.top_hits = top_hits
+        self.tests = {name: TestSummary(top_hits, bin_size, resolution) for name in SUMMARY_TESTS}
+
+    def add(self, vi):
+        ''' adds a variant, vi is the dict of results of write_variant_results ('NA' for missing values) '''
+        chrom, pos, id = vi["chrom"], vi["pos"], vi["id"]
+        for name, field in SUMMARY_TESTS.items():
+            value = vi[field]
+            if value == "NA" or value == "":
+                self.tests[name].num_missing += 1
+            else:
+                self.tests[name].add(float(value), chrom, pos, id)
+
+    def merge(self, other):
+        for name, test in other.tests.items():
+            self.tests[name].merge(test)
+
+    def to_dict(self):
+        test = next(iter(self.tests.values()))
+        return {
+            "manhattan_bin_size": test.bin_size,
+            "sketch_resolution": test.resolution,
+            "lambda_gc_note": LAMBDA_GC_NOTE,
+            "tests": {name: dict(field=SUMMARY_TESTS[name], **test.to_dict()) for name, test in self.tests.items()},
+        }
+
+    def write(self, file_name):
+        with open(file_name, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    def stats(self):
+        ''' one line per test with the number of values and lambda GC '''
+        lines = []
+        for name, test in self.tests.items():
+            lambda_gc = test.lambda_gc()
+            if lambda_gc is not None:
+                lambda_gc = f"{lambda_gc:.4f}"
+            elif test.num_values:
+                lambda_gc = "NA (median p-value is 1)"
+            else:
+                lambda_gc = "NA"
+            lines.append(f"{name}: {test.num_values} p-values, {test.num_missing} missing, lambda GC {lambda_gc}")
+        return "\n".join(lines)
@@ -1,9 +1,16 @@
 from granite.lib.shared_functions import *
+from bgzf import read_tabix_contigs
 import json
+from collections import namedtuple
+from functools import lru_cache
+import sys
 import gzip
+import os
 
 VALID_GENOTYPES = ["./.", "0/0", "1/0", "0/1", "1/1" , "0|0", "1|0", "0|1", "1|1"]
 
+CARRIER_GENOTYPES = [gt for gt in VALID_GENOTYPES if gt not in ["./.", "0/0", "0|0"]]
+
 VEP_ORDER = {
     # HIGH
     'transcript_ablation': 1,
@@ -34,12 +41,86 @@ VEP_ORDER = {
     'MODIFIER': 23
 }
 
+# Maximum number of distinct consequence strings kept in the consequence ranking cache.
+# A whole genome has a few hundred of them
+CONSEQUENCE_CACHE_SIZE = 4096
+
+def read_sample_info(sample_info):
+    '''
+    Returns the sample info JSON string. sample_info is the JSON string or the path of a file with it,
+    large cohorts exceed the size limit of a command line argument
+    '''
+    if not sample_info.lstrip().startswith("[") and os.path.isfile(sample_info):
+        with open(sample_info) as f:
+            return f.read()
+    return sample_info
+
 def get_cases(sample_info):
     sample_info_dec = json.loads(sample_info)
     sample_info_cases = filter(lambda s: s["is_affected"], sample_info_dec)
     return list(map(lambda x: x["sample_id"], sample_info_cases))
 
+def carrier_indexes(samples, GT_idx=0):
+    '''
+    Returns the indexes, in order, of the sample columns with a genotype in CARRIER_GENOTYPES.
+    samples are the tab separated sample columns of a VCF line.
+
+    If GT is the first FORMAT field, the carrier genotypes are searched for at the start
+    of the columns, without splitting the line. Python code only runs for carriers, and
+    their indexes are counted from the tabs in front of them
+    '''
+    if GT_idx != 0:
+        return [
+            i for i, sample_col in enumerate(samples.split("\t"))
+            if sample_col.split(":")[GT_idx] in CARRIER_GENOTYPES
+        ]
+    columns = "\t" + samples
+    n = len(columns)
+    positions = []
+    for gt in CARRIER_GENOTYPES:
+        pattern = "\t" + gt
+        pos = columns.find(pattern)
+        while pos >= 0:
+            end = pos + len(pattern)
+            # 0/1 but not 0/10
+            if end == n or columns[end] == ":" or columns[end] == "\t":
+                positions.append(pos)
+            pos = columns.find(pattern, end)
+    positions.sort()
+    idxs, idx, last = [], 0, 0
+    for pos in positions:
+        idx += columns.count("\t", last, pos)
+        idxs.append(idx)
+        last = pos
+    return idxs
+
 def get_worst_consequence(consequence, sep='&'):
+    ''' '''
+    if sep == '&':
+        return rank_consequence(consequence)[1]
+    #end if
+    return _get_worst_consequence(consequence, sep)
+#end def
+
+@lru_cache(maxsize=CONSEQUENCE_CACHE_SIZE)
+def rank_consequence(consequence):
+    '''
+    Returns (rank, worst consequence) of a '&'-joined VEP consequence string.
+    Results are cached and the consequence terms interned,
+    so every distinct string is only split and sorted once
+    '''
+    worst_cnsqce = sys.intern(_get_worst_consequence(consequence))
+    return VEP_ORDER.get(worst_cnsqce, VEP_ORDER['MODIFIER']), worst_cnsqce
+#end def
+
+def consequence_cache_stats():
+    info = rank_consequence.cache_info()
+    total = info.hits + info.misses
+    hit_rate = info.hits / total if total else 0
+    return f"Consequence cache: {info.hits} hits, {info.misses} misses ({hit_rate:.1%} hit rate), {info.currsize} consequences cached"
+#end def
+
+def _get_worst_consequence(consequence, sep='&'):
     ''' '''
     consequence_tup = []
     for cnsqce in consequence.split(sep):
@@ -61,11 +142,8 @@ def get_worst_transcript(VEP_val, CNONICL_idx, CONSEQUENCE_idx, sep='&'):
     # Assign worst impact to transcripts
     for trscrpt in trscrpt_list:
         trscrpt_cnsqce = trscrpt.split('|')[CONSEQUENCE_idx]
-        worst_cnsqce = get_worst_consequence(trscrpt_cnsqce)
-        try: worst_trscrpt_tup.append((VEP_ORDER[worst_cnsqce], trscrpt))
-        except Exception:
-            worst_trscrpt_tup.append((VEP_ORDER['MODIFIER'], trscrpt))
-        #end try
+        worst_impact, _ = rank_consequence(trscrpt_cnsqce)
+        worst_trscrpt_tup.append((worst_impact, trscrpt))
     #end for
     sorted_worst_trscrpt_tup = sorted(worst_trscrpt_tup, key=lambda x_y: x_y[0])
     worst_impact = sorted_worst_trscrpt_tup[0][0]
@@ -86,6 +164,90 @@ def get_worst_transcript(VEP_val, CNONICL_idx, CONSEQUENCE_idx, sep='&'):
     return worst_trscrpt_list[0]
 #end def
 
+class CsqParser(object):
+    '''
+    Single pass decoder for the VEP annotation (CSQ) of a variant.
+
+    Each transcript is split once. While the transcripts are read, the worst
+    one is selected the same way get_worst_transcript does (worst consequence,
+    canonical first among equally bad ones). parse() returns a Transcript tuple
+    with the fields registered in `fields` ({name: VEP field}) for that transcript
+    and its worst consequence.
+
+    dbNSFP fields listed in `dbnsfp_fields` are resolved for the transcript
+    as in clean_dbnsfp. Fields in `first_transcript_fields` are taken from the
+    first transcript instead (e.g. SpliceAI, which has the same scores for all transcripts).
+    '''
+
+    CANONICAL = ('YES', '1')
+
+    def __init__(self, header, fields, dbnsfp_fields=(), first_transcript_fields=None, VEPtag='CSQ', sep='&'):
+        self.VEPtag = VEPtag
+        self.sep = sep
+        first_transcript_fields = first_transcript_fields or {}
+        self.idxs = [header.get_tag_field_idx(VEPtag, field) for field in fields.values()]
+        self.first_idxs = [header.get_tag_field_idx(VEPtag, field) for field in first_transcript_fields.values()]
+        self.Transcript = namedtuple('Transcript', list(fields) + ['worst_consequence'] + list(first_transcript_fields))
+
+        self.idx_consequence = header.get_tag_field_idx(VEPtag, 'Consequence')
+        self.idx_canonical = header.get_tag_field_idx(VEPtag, 'CANONICAL')
+
+        # Positions in the Transcript tuple of the registered dbNSFP fields
+        dbnsfp_idxs = set(header.get_tag_field_idx(VEPtag, field) for field in dbnsfp_fields)
+        self.dbnsfp_positions = [i for i, idx in enumerate(self.idxs) if idx in dbnsfp_idxs]
+        if self.dbnsfp_positions:
+            self.idx_dbnsfp_ENST = header.get_tag_field_idx(VEPtag, 'Ensembl_transcriptid')
+            self.idx_ENST = header.get_tag_field_idx(VEPtag, 'Feature')
+        #end if
+    #end def
+
+    def parse(self, VEP_val):
+        ''' returns the worst transcript of VEP_val as a Transcript tuple '''
+        idx_consequence, idx_canonical = self.idx_consequence, self.idx_canonical
+        worst_rank = worst_split = worst_cnsqce = None
+        worst_is_canonical = False
+        first_split = None
+        for trscrpt in VEP_val.split(','):
+            trscrpt_split = trscrpt.split('|')
+            if first_split is None:
+                first_split = trscrpt_split
+            #end if
+            rank, cnsqce = rank_consequence(trscrpt_split[idx_consequence])
+            if worst_rank is None or rank < worst_rank:
+                worst_rank, worst_split, worst_cnsqce = rank, trscrpt_split, cnsqce
+                worst_is_canonical = trscrpt_split[idx_canonical] in self.CANONICAL
+            elif rank == worst_rank and not worst_is_canonical \
+                and trscrpt_split[idx_canonical] in self.CANONICAL:
+                worst_split, worst_cnsqce, worst_is_canonical = trscrpt_split, cnsqce, True
+            #end if
+        #end for
+
+        values = [worst_split[idx] for idx in self.idxs]
+        if self.dbnsfp_positions:
+            self._resolve_dbnsfp(worst_split, values)
+        #end if
+        values.append(worst_cnsqce)
+        values.extend(first_split[idx] for idx in self.first_idxs)
+        return self.Transcript._make(values)
+    #end def
+
+    def _resolve_dbnsfp(self, trscrpt_split, values):
+        ''' assigns dbNSFP values to the transcript, see clean_dbnsfp '''
+        dbnsfp_ENST = trscrpt_split[self.idx_dbnsfp_ENST].split(self.sep)
+        try: dbnsfp_idx = dbnsfp_ENST.index(trscrpt_split[self.idx_ENST])
+        except ValueError: dbnsfp_idx = -1
+        #end try
+        for i in self.dbnsfp_positions:
+            if dbnsfp_idx >= 0:
+                val_ = values[i].split(self.sep)[dbnsfp_idx]
+                values[i] = '' if val_ == '.' else val_
+            else:
+                values[i] = ''
+            #end if
+        #end for
+    #end def
+#end class
+
 # Taken from cgap-scripts/portal_reformat_vcf
 def get_maxds(vnt_obj, SpAItag_list, SpAI_idx_list):
     ''' '''
@@ -94,16 +256,24 @@ def get_maxds(vnt_obj, SpAItag_list, SpAI_idx_list):
     # expected the same scores for all transcripts
     SpAI_vals = []
     for i, SpAItag in enumerate(SpAItag_list):
-        SpAI_val = get_tag_idx(vnt_obj, SpAItag, SpAI_idx_list[i])
+        SpAI_vals.append(get_tag_idx(vnt_obj, SpAItag, SpAI_idx_list[i]))
+    #end for
+    return get_maxds_values(SpAI_vals)
+#end def
+
+def get_maxds_values(SpAI_vals):
+    ''' max of the SpliceAI scores or None if any of them is missing '''
+    SpAI_scores = []
+    for SpAI_val in SpAI_vals:
         # if SpliceAI is with VEP and is at the end of Format
         # need to remove , that separate next transcript
-        try: SpAI_vals.append(float(SpAI_val.split(',')[0]))
+        try: SpAI_scores.append(float(SpAI_val.split(',')[0]))
         except Exception:
             return None
         #end try
     #end for
-    if SpAI_vals:
-        return max(SpAI_vals)
+    if SpAI_scores:
+        return max(SpAI_scores)
     #end if
     return None
 #end def
@@ -150,90 +320,173 @@ def clean_dbnsfp(vnt_obj, VEPtag, dbNSFP_fields, dbnsfp_ENST_idx, ENST_idx, sep=
     return ','.join(trscrpt_clean)
 #end def
 
-def get_variant_result_file_header():
-    header = '# CHROM: chromosome\n'
-    header += '# GENPOS: position with in the chromosome\n'
-    header += '# ID: variant ID\n'
-    header += '# ALLELE0: reference allele\n'
-    header += '# ALLELE1: alternative allele\n'
-    header += '# R_TEST: test performed by Regenie (additive/dominant/recessive)\n'
-    header += '# R_BETA: estimated effect sizes (Regenie)\n'
-    header += '# R_SE: standard error of the Regenie test\n'
-    header += '# R_CHISQ: chi-square test statistics of the Regenie test\n'
-    header += '# R_LOG10P: -log10(p) of the Regenie test\n'
-    header += '# CASE_AF: case allele frequency\n'
-    header += '# CASE_N: number of affected samples\n'
-    header += '# CONTROL_AF: control allele frequency\n'
-    header += '# CONTROL_N: number of control samples\n'
-    header += '# F_LOG10P_CONTROL: -log10(p) of a Fisher exact test with cases vs. control\n'
-    header += '# F_OR_CONTROL: odds ratio of a Fisher exact test with cases vs. control\n'
-    header += '# F_LOG10P_GNOMADG: -log10(p) of a Fisher exact test when gnomAD 3 is used as control group\n'
-    header += '# F_OR_GNOMADG: odds ratio of a Fisher exact test when gnomAD 3 is used as control group\n'
-    header += '# F_LOG10P_GNOMADE2: -log10(p) of a Fisher exact test when gnomAD 2 is used as control group\n'
-    header += '# F_OR_GNOMADE2: odds ratio of a Fisher exact test when gnomAD 2 is used as control group\n'
-    header += '# CADD_RAW_RS: CADD rankscore\n'
-    header += '# CADD_PHRED: CADD Phred score\n'
-    header += '# POLYPHEN_PRED: PolyPhen 2 prediction\n'
-    header += '# POLYPHEN_RANKSCORE: PolyPhen 2 rankscore\n'
-    header += '# POLYPHEN_SCORE: PolyPhen 2 score\n'
-    header += '# GERP_SCORE: Gerp++ score\n'
-    header += '# GERP_RANKSCORE: Gerp++ rankscore\n'
-    header += '# SIFT_RANKSCORE: SIFT rankscore\n'
-    header += '# SIFT_PRED: SIFT prediction\n'
-    header += '# SIFT_SCORE: SIFT score\n'
-    header += '# SPLICEAI_MAX_SCORE: SpliceAI predicts whether a variant causes a splice acceptor gain or loss, or a splice donor gain or loss. The score shown here is the max score of these four scores\n'
-    header += 'CHROM GENPOS ID ALLELE0 ALLELE1 R_TEST R_BETA R_SE R_CHISQ R_LOG10P CASE_AF CASE_N CONTROL_AF CONTROL_N F_LOG10P_CONTROL F_OR_CONTROL F_LOG10P_GNOMADG F_OR_GNOMADG F_LOG10P_GNOMADE2 F_OR_GNOMADE2 CADD_RAW_RS CADD_PHRED POLYPHEN_PRED POLYPHEN_RANKSCORE POLYPHEN_SCORE GERP_SCORE GERP_RANKSCORE SIFT_RANKSCORE SIFT_PRED SIFT_SCORE SPLICEAI_MAX_SCORE\n'
-    return header
-
 def get_variant_result_higlass_file_header():
     header = '##fileformat=VCFv4.3\n'
     header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
     return header
 
+# Regenie variant output file format
+# Example line
+# CHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ INFO N TEST BETA SE CHISQ LOG10P EXTRA
+# 1 13613 chr1_13613_T_A T A 0.0514706 1 68 ADD 0.191978 0.695341 0.0762264 0.106528 NA
+REGENIE_VARIANT_FIELDS = {
+    "CHROM": 0,
+    "GENPOS": 1,
+    "ID": 2,
+    "ALLELE0": 3,
+    "ALLELE1": 4,
+    "A1FREQ": 5,
+    "INFO": 6,
+    "N": 7,
+    "TEST": 8,
+    "BETA": 9,
+    "SE": 10,
+    "CHISQ": 11,
+    "LOG10P": 12,
+    "EXTRA": 13,
+}
+
+def read_regenie_results(regenie_output):
+    '''
+    Generator over the Regenie variant output.
+    Yields (chrom, pos, id, result) where chrom is the VCF chromosome
+    taken from the variant ID (CHROM_POS_REF_ALT)
+    '''
+    r_map = REGENIE_VARIANT_FIELDS
+    with gzip.open(regenie_output, 'rt') as f_in:
+        for line in f_in:
+            if line.startswith("##") or line.startswith("CHROM"):
+                continue
+
+            result = line.strip().split()
+            id = result[r_map["ID"]]
+            yield id.rsplit("_", 3)[0], int(result[r_map["GENPOS"]]), id, {
+                "regenie_ml10p": result[r_map["LOG10P"]],
+                "regenie_beta": result[r_map["BETA"]],
+                "regenie_chisq": result[r_map["CHISQ"]],
+                "regenie_se": result[r_map["SE"]],
+                "regenie_test": result[r_map["TEST"]],
+            }
+
 def parse_regenie_results(regenie_output):
-    # Extract Regenie results
+    ''' Loads the Regenie results into a dict keyed by variant ID '''
     regenie_results = {}
-    # Regenie output file format
-    # Example line
-    # CHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ INFO N TEST BETA SE CHISQ LOG10P EXTRA
-    # 1 13613 chr1_13613_T_A T A 0.0514706 1 68 ADD 0.191978 0.695341 0.0762264 0.106528 NA
-    r_map = {
-        "CHROM": 0,
-        "GENPOS": 1,
-        "ID": 2,
-        "ALLELE0": 3,
-        "ALLELE1": 4,
-        "A1FREQ": 5,
-        "INFO": 6,
-        "N": 7,
-        "TEST": 8,
-        "BETA": 9,
-        "SE": 10,
-        "CHISQ": 11,
-        "LOG10P": 12,
-        "EXTRA": 13,
-    }
+    for _, _, id, result in read_regenie_results(regenie_output):
+        regenie_results[id] = result
+    return regenie_results
+
+def regenie_results_sorted(regenie_output, contigs):
+    ''' checks that the Regenie results are in the order of the VCF contigs and sorted by position '''
+    contig_rank = {contig: i for i, contig in enumerate(contigs)}
+    last_key = (-1, -1)
+    for chrom, pos, _, _ in read_regenie_results(regenie_output):
+        if chrom not in contig_rank:
+            return False
+        key = (contig_rank[chrom], pos)
+        if key < last_key:
+            return False
+        last_key = key
+    return True
+
+class RegenieResultsDict(object):
+    ''' Regenie results loaded into memory. Works for any order of the Regenie output '''
+
+    def __init__(self, regenie_output):
+        self.results = parse_regenie_results(regenie_output)
+
+    def get(self, chrom, pos, id):
+        return self.results.get(id)
+
+class RegenieMergeJoin(object):
+    '''
+    Streams coordinate-sorted Regenie results alongside the VCF records.
+    get() has to be called in VCF order. Regenie records at the current
+    position are kept in a small lookahead buffer to resolve variants
+    that share a position, so memory does not depend on the number of variants.
+    The buffer is kept until the VCF moves past the position, so every VCF record
+    with the same ID gets the result. As with RegenieResultsDict, the last Regenie
+    record of an ID wins.
+    '''
+
+    def __init__(self, regenie_output, contigs):
+        self.contig_rank = {contig: i for i, contig in enumerate(contigs)}
+        self.records = read_regenie_results(regenie_output)
+        self.buffer_key = None
+        self.buffer = {} # {id: result} of the records at buffer_key
+        self.matched = set() # IDs of the buffer that matched a VCF record
+        self.next_record = self._read_record()
+        self.num_unmatched = 0
+
+    def _read_record(self):
+        for chrom, pos, id, result in self.records:
+            return (self.contig_rank[chrom], pos), id, result
+        return None
+
+    def get(self, chrom, pos, id):
+        ''' returns the Regenie result of the variant or None '''
+        key = (self.contig_rank[chrom], pos)
+
+        # Records before the current position have no matching VCF record
+        if self.buffer_key is not None and self.buffer_key < key:
+            self.num_unmatched += len(self.buffer.keys() - self.matched)
+            self.buffer_key, self.buffer, self.matched = None, {}, set()
+
+        while self.next_record is not None and self.next_record[0] <= key:
+            record_key, record_id, result = self.next_record
+            if record_key < key:
+                self.num_unmatched += 1
+            else:
+                self.buffer_key = key
+                self.buffer[record_id] = result
+            self.next_record = self._read_record()
+
+        result = self.buffer.get(id)
+        if result is not None:
+            self.matched.add(id)
+        return result
+
+def split_regenie_results(regenie_output, shard_of, shard_files):
+    '''
+    Writes the Regenie results of every shard of the VCF to its own gzipped file.
+    shard_of(chrom, pos) returns the index of the shard of a variant or None.
+    The order of the results is kept. Returns the number of results without a shard
+    '''
+    r_map = REGENIE_VARIANT_FIELDS
+    f_outs = [gzip.open(shard_file, 'wt', compresslevel=1) for shard_file in shard_files]
+    num_unassigned = 0
     with gzip.open(regenie_output, 'rt') as f_in:
         for line in f_in:
             if line.startswith("##") or line.startswith("CHROM"):
+                for f_out in f_outs:
+                    f_out.write(line)
                 continue
 
-            # Example line
-            # CHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ INFO N TEST BETA SE CHISQ LOG10P EXTRA
-            # 1 13613 chr1_13613_T_A T A 0.0514706 1 68 ADD 0.191978 0.695341 0.0762264 0.106528 NA
+            result = line.split()
+            shard = shard_of(result[r_map["ID"]].rsplit("_", 3)[0], int(result[r_map["GENPOS"]]))
+            if shard is None:
+                num_unassigned += 1
+            else:
+                f_outs[shard].write(line)
+    for f_out in f_outs:
+        f_out.close()
+    return num_unassigned
 
-            result = line.strip().split()
-            id = result[r_map["ID"]]
-            r_beta = result[r_map["BETA"]]
-            r_se = result[r_map["SE"]]
-            r_chisq = result[r_map["CHISQ"]]
-            r_log10p = result[r_map["LOG10P"]]
-            r_test = result[r_map["TEST"]]
-
-            regenie_results[id] = {}
-            regenie_results[id]["regenie_ml10p"] = r_log10p
-            regenie_results[id]["regenie_beta"] = r_beta
-            regenie_results[id]["regenie_chisq"] = r_chisq
-            regenie_results[id]["regenie_se"] = r_se
-            regenie_results[id]["regenie_test"] = r_test
-    return regenie_results
\ No newline at end of file
+def regenie_results_are_sorted(regenie_output, annotated_vcf):
+    ''' checks whether the Regenie output is sorted like the (tabix indexed) annotated VCF '''
+    index_file = annotated_vcf + ".tbi"
+    if not os.path.exists(index_file):
+        return False
+    return regenie_results_sorted(regenie_output, read_tabix_contigs(index_file))
+
+def get_regenie_results(regenie_output, annotated_vcf):
+    '''
+    Returns an object to look up Regenie results with get(chrom, pos, id).
+    If the Regenie output is sorted like the (tabix indexed) annotated VCF,
+    the results are joined with the VCF records in a single streaming pass.
+    Otherwise they are loaded into memory.
+    '''
+    if regenie_results_are_sorted(regenie_output, annotated_vcf):
+        print("Regenie results are sorted. Streaming them alongside the VCF.")
+        return RegenieMergeJoin(regenie_output, read_tabix_contigs(annotated_vcf + ".tbi"))
+    print("WARNING: Regenie results are not sorted like the annotated VCF. Loading them into memory.")
+    return RegenieResultsDict(regenie_output)
@@ -0,0 +1,214 @@
+################################################
+#   Libraries
+################################################
+
+import csv
+import re
+from collections import namedtuple
+from bgzf import BgzfReader, TabixIndex, TBI_FORMAT_GENERIC
+
+
+################################################
+#   Top level variables
+################################################
+
+# Value of missing results
+NA = "NA"
+
+# Columns of the variant level result file: (name, type, description).
+# They are declared in the header as ##COLUMN=<ID=name,Type=type,Description="description">
+VARIANT_RESULT_COLUMNS = [
+    ("CHROM", "String", "chromosome"),
+    ("GENPOS", "Integer", "position with in the chromosome"),
+    ("ID", "String", "variant ID"),
+    ("ALLELE0", "String", "reference allele"),
+    ("ALLELE1", "String", "alternative allele"),
+    ("R_TEST", "String", "test performed by Regenie (additive/dominant/recessive)"),
+    ("R_BETA", "Float", "estimated effect sizes (Regenie)"),
+    ("R_SE", "Float", "standard error of the Regenie test"),
+    ("R_CHISQ", "Float", "chi-square test statistics of the Regenie test"),
+    ("R_LOG10P", "Float", "-log10(p) of the Regenie test"),
+    ("CASE_AF", "Float", "case allele frequency"),
+    ("CASE_N", "Integer", "number of affected samples"),
+    ("CONTROL_AF", "Float", "control allele frequency"),
+    ("CONTROL_N", "Integer", "number of control samples"),
+    ("F_LOG10P_CONTROL", "Float", "-log10(p) of a Fisher exact test with cases vs. control"),
+    ("F_OR_CONTROL", "Float", "odds ratio of a Fisher exact test with cases vs. control"),
+    ("F_LOG10P_GNOMADG", "Float", "-log10(p) of a Fisher exact test when gnomAD 3 is used as control group"),
+    ("F_OR_GNOMADG", "Float", "odds ratio of a Fisher exact test when gnomAD 3 is used as control group"),
+    ("F_LOG10P_GNOMADE2", "Float", "-log10(p) of a Fisher exact test when gnomAD 2 is used as control group"),
+    ("F_OR_GNOMADE2", "Float", "odds ratio of a Fisher exact test when gnomAD 2 is used as control group"),
+    ("CADD_RAW_RS", "Float", "CADD rankscore"),
+    ("CADD_PHRED", "Float", "CADD Phred score"),
+    ("POLYPHEN_PRED", "String", "PolyPhen 2 prediction"),
+    ("POLYPHEN_RANKSCORE", "Float", "PolyPhen 2 rankscore"),
+    ("POLYPHEN_SCORE", "Float", "PolyPhen 2 score"),
+    ("GERP_SCORE", "Float", "Gerp++ score"),
+    ("GERP_RANKSCORE", "Float", "Gerp++ rankscore"),
+    ("SIFT_RANKSCORE", "Float", "SIFT rankscore"),
+    ("SIFT_PRED", "String", "SIFT prediction"),
+    ("SIFT_SCORE", "Float", "SIFT score"),
+    ("SPLICEAI_MAX_SCORE", "Float", "SpliceAI predicts whether a variant causes a splice acceptor gain or loss, or a splice donor gain or loss. The score shown here is the max score of these four scores"),
+]
+
+COLUMN_TYPES = {"String": str, "Integer": int, "Float": float}
+
+# -log10(p) columns of the tests, min_ml10p of a query applies to these by default
+ML10P_COLUMNS = ["R_LOG10P", "F_LOG10P_CONTROL", "F_LOG10P_GNOMADG", "F_LOG10P_GNOMADE2"]
+
+COLUMN_HEADER_RE = re.compile(r'^##COLUMN=<ID=([^,>]+),Type=([^,>]+),Description="(.*)">$')
+REGION_RE = re.compile(r"^([^:]+)(?::([\d,]+)(?:-([\d,]+))?)?$")
+
+
+################################################
+#   Functions
+################################################
+
+def variant_result_header():
+    ''' header of the variant level result file, with the declared columns and the column names '''
+    header = "".join(f'##COLUMN=<ID={name},Type={type_},Description="{description}">\n' for name, type_, description in VARIANT_RESULT_COLUMNS)
+    header += "#" + "\t".join(name for name, _, _ in VARIANT_RESULT_COLUMNS) + "\n"
+    return header
+
+
+def variant_result_index():
+    ''' TabixIndex of the variant level result file (tabix -s 1 -b 2 -e 2) '''
+    return TabixIndex(TBI_FORMAT_GENERIC, col_seq=1, col_beg=2, col_end=2)
+
+
+def parse_columns(header):
+    ''' [(name, type, description)] declared in the header of a variant level result file '''
+    columns = []
+    for line in header.splitlines():
+        match = COLUMN_HEADER_RE.match(line)
+        if match:
+            columns.append(match.groups())
+    if not columns:
+        raise ValueError("No ##COLUMN declarations in the header of the variant level result file")
+    return columns
+
+
+def parse_region(region):
+    '''
+    (chrom, start, end) of chr1, chr1:1000 or chr1:1000-2000 (1-based, inclusive, end None
+    for the end of chrom). Tuples (chrom, start, end) are returned as they are
+    '''
+    if isinstance(region, (tuple, list)):
+        chrom, start, end = region
+        return chrom, start or 1, end
+    match = REGION_RE.match(region.strip())
+    if match is None:
+        raise ValueError(f"{region} is not a region, e.g. chr1:1000-2000")
+    chrom, start, end = match.groups()
+    start = int(start.replace(",", "")) if start else 1
+    end = int(end.replace(",", "")) if end else None
+    if end is not None and end < start:
+        raise ValueError(f"{region} ends before it starts")
+    return chrom, start, end
+
+
+def read_gene_regions(gene_info):
+    '''
+    {gene ID or symbol: (chrom, start, end)} from the gene annotation file from portal
+    (header: ens_id	chr	start	end	strand	gene)
+    '''
+    gene_regions = {}
+    with open(gene_info, 'r') as f:
+        for info in csv.reader(f, delimiter="\t"):
+            if not info or info[0] == "ens_id":
+                continue
+            chrom = info[1] if info[1].startswith("chr") else "chr" + info[1]
+            region = (chrom, int(info[2]), int(info[3]))
+            gene_regions[info[0]] = region
+            gene_regions.setdefault(info[5], region)
+    return gene_regions
+
+
+def query_results(file_name, region=None, gene=None, gene_info=None, min_ml10p=None, ml10p_columns=ML10P_COLUMNS):
+    '''
+    Generator over the variants of a variant level result file as typed tuples (see VariantResults).
+    Only the blocks of region or gene are read through the tabix index, the whole file without either.
+    gene is a gene ID or symbol of the gene annotation file gene_info.
+    With min_ml10p, only variants with a -log10(p) of at least min_ml10p in one of ml10p_columns are returned
+
+    Example:
+
+        for variant in query_results("variant_level_results.txt.gz", gene="PCSK9", gene_info="gene_annotations.tsv", min_ml10p=2):
+            print(variant.ID, variant.R_LOG10P, variant.F_LOG10P_CONTROL)
+    '''
+    if region is not None and gene is not None:
+        raise ValueError("Either a region or a gene can be queried, not both")
+    if gene is not None:
+        if gene_info is None:
+            raise ValueError("gene_info is required to query a gene")
+        gene_regions = read_gene_regions(gene_info)
+        if gene not in gene_regions:
+            raise ValueError(f"{gene} not found in {gene_info}")
+        region = gene_regions[gene]
+
+    with VariantResults(file_name) as results:
+        yield from results.fetch(region, min_ml10p, ml10p_columns)
+
+
+################################################
+#   Classes
+################################################
+
+class VariantResults(object):
+    '''
+    Reads a variant level result file (BGZF compressed, tab separated, tabix indexed).
+    The columns and their types are read from the ##COLUMN declarations of the header.
+    Rows are returned as VariantResult named tuples with str, int and float values and
+    None for NA. Only the rows that pass the filters of a query are decoded.
+    '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.reader = BgzfReader(file_name)
+        self.index = TabixIndex.read(file_name + ".tbi")
+        header, self.first_offset = self.reader.header()
+        self.columns = parse_columns(header)
+        self.names = [name for name, _, _ in self.columns]
+        self.converters = [COLUMN_TYPES.get(type_, str) for _, type_, _ in self.columns]
+        self.VariantResult = namedtuple("VariantResult", self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def decode(self, fields):
+        ''' VariantResult of the fields of a row '''
+        try:
+            return self.VariantResult._make([
+                None if value == NA else convert(value)
+                for value, convert in zip(fields, self.converters)
+            ])
+        except (ValueError, TypeError):
+            row = "\t".join(fields)
+            raise ValueError(f"{self.file_name}: row does not match the declared columns\n{row}")
+
+    def lines(self, region=None):
+        ''' generator over the data lines of region (see parse_region), of the whole file for None '''
+        if region is None:
+            if self.first_offset is None:
+                return
+            for line in self.reader.lines(self.first_offset):
+                if not line.startswith("#") and line.strip():
+                    yield line
+            return
+        chrom, start, end = parse_region(region)
+        yield from self.reader.fetch(self.index, chrom, start, end)
+
+    def fetch(self, region=None, min_ml10p=None, ml10p_columns=ML10P_COLUMNS):
+        ''' generator over the VariantResults of region that pass min_ml10p in one of ml10p_columns '''
+        ml10p_idxs = [self.names.index(name) for name in ml10p_columns] if min_ml10p is not None else []
+        for line in self.lines(region):
+            fields = line.rstrip("\n").split("\t")
+            if ml10p_idxs and not any(fields[idx] != NA and float(fields[idx]) >= min_ml10p for idx in ml10p_idxs):
+                continue
+            yield self.decode(fields)
+
+    def close(self):
+        self.reader.close()
@@ -1,27 +1,41 @@
 import click
 from granite.lib import vcf_parser
-from utils import get_worst_consequence, get_worst_transcript
+from utils import CsqParser, consequence_cache_stats
+from profiler import get_profiler
+from mask_engine import DEFAULT_MASKS, MaskEngine
 
 @click.command()
 @click.help_option("--help", "-h")
 @click.option("-a", "--annotated-vcf", required=True, type=str, help="VEP annotated VCF (gzipped), filteres and with IDs")
-@click.option("-c", "--high-cadd-threshold", required=True, type=float, help="High CADD threshold")
-def main(annotated_vcf, high_cadd_threshold):
+@click.option("-c", "--high-cadd-threshold", required=True, type=float, multiple=True, help="High CADD threshold. Can be given more than once, the files are then written for every threshold")
+@click.option("-m", "--mask", required=False, type=str, multiple=True, help=f"Mask as NAME=EXPRESSION, where EXPRESSION combines the categories missense, high_cadd, nonsense and essential_splice with &, | and ~. Can be given more than once. Default: {'; '.join(DEFAULT_MASKS)}")
+@click.option("-o", "--output-prefix", required=False, type=str, default="regenie_input", show_default=True, help="Prefix of the annotation, set list and mask files")
+@click.option("--debug", is_flag=True, default=False, help="Print cache statistics")
+@click.option("--profile", required=False, type=str, default=None, help="Write wall time, calls and throughput of every phase of the script to this JSON file")
+@click.option("--cprofile", required=False, type=str, default=None, help="Write cProfile stats (pstats) to this file")
+def main(annotated_vcf, high_cadd_threshold, mask, output_prefix, debug, profile, cprofile):
     """This script takes an annotated VCF file as input and created the annotations and mask files needed by regenie
 
+    The categories of every variant are encoded once (see mask_engine.py), and the masks are
+    evaluated for all CADD thresholds in the same pass. With a single threshold, the files are
+    <prefix>.annotation, <prefix>.set_list and <prefix>.masks. With several thresholds, the
+    annotation and mask files of each one are <prefix>.cadd_<threshold>.annotation and
+    <prefix>.cadd_<threshold>.masks, and the set list is shared.
+
     Example usage: 
 
-    python create_phenotype.py -a /path/to/annotated_vcf.vcf.gz -c 20
+    python create_mask_files.py -a /path/to/annotated_vcf.vcf.gz -c 20
+
+    python create_mask_files.py -a /path/to/annotated_vcf.vcf.gz -c 15 -c 20 -c 25 -m "mask_lof=nonsense | essential_splice" -m "mask_missense_cadd=missense & high_cadd"
 
     """
 
     VEP_TAG = 'CSQ'
 
+    profiler = get_profiler(profile, cprofile)
+
     vcf_obj = vcf_parser.Vcf(annotated_vcf)
-    idx_gene = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Gene')
-    idx_consequence = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'Consequence')
-    idx_canonical = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'CANONICAL')
-    idx_cadd_phred = vcf_obj.header.get_tag_field_idx(VEP_TAG, 'CADD_PHRED')
+    csq_parser = CsqParser(vcf_obj.header, {"gene": 'Gene', "cadd_phred": 'CADD_PHRED'}, VEPtag=VEP_TAG)
 
 
     """
@@ -41,79 +55,70 @@ def main(annotated_vcf, high_cadd_threshold):
     Variants are assigned the following categories:
     missense
     high_cadd
-    rare
-    They are combined into approriate masks below
+    nonsense
+    essential_splice
+    They are combined into the masks below
     """
-    with open("regenie_input.annotation", "w") as output_file:
-        all_categories = []
-        for record in vcf_obj.parse_variants():
-            id = record.ID
-            vep_tag_value = record.get_tag_value(VEP_TAG)
-            worst_transcript = get_worst_transcript(vep_tag_value, idx_canonical, idx_consequence)
-            worst_transcript_ = worst_transcript.split('|')
-            worst_consequence = get_worst_consequence(worst_transcript_[idx_consequence])
-            gene_symbol = worst_transcript_[idx_gene]
-            if not gene_symbol: #skip intergeneic variants
-                continue
-            is_missense = worst_consequence == "missense_variant"
-            is_nonsense = worst_consequence == "stop_gained"
-            is_essential_splice = (worst_consequence == "splice_acceptor_variant") or (worst_consequence == "splice_donor_variant")
-            cadd_phred = float(worst_transcript_[idx_cadd_phred]) if worst_transcript_[idx_cadd_phred] else False
-            is_high_cadd = cadd_phred >= high_cadd_threshold
-            af = float(record.get_tag_value("AF"))
-
-
-            categories = []
-            if is_missense:
-                categories.append("missense")
-            if is_high_cadd:
-                categories.append("high_cadd")
-            if is_nonsense:
-                categories.append("nonsense")
-            if is_essential_splice:
-                categories.append("essential_splice")
-
-
-            if len(categories) > 0:
-                category = "_".join(categories)
-                all_categories.append(category)
-                output_file.write(f'{id} {gene_symbol} {category}\n')
-            else: 
-                # The None category is not present in the mask file and is
-                # therefore ignored downstream
-                output_file.write(f'{id} {gene_symbol} None\n')
-
-            if gene_symbol not in set_list_data:
-                set_list_data[gene_symbol] = {
-                    "chr": record.CHROM,
-                    "pos": str(record.POS),
-                    "variants": [id]
-                }
-            else:
-                set_list_data[gene_symbol]["variants"].append(id)
+    try:
+        mask_engine = MaskEngine(high_cadd_threshold, mask or DEFAULT_MASKS)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if len(high_cadd_threshold) == 1:
+        config_prefixes = [output_prefix]
+    else:
+        config_prefixes = [f"{output_prefix}.cadd_{threshold:g}" for threshold in high_cadd_threshold]
+    output_files = [open(f"{prefix}.annotation", "w") for prefix in config_prefixes]
+
+    for record in profiler.iterate("read_vcf", vcf_obj.parse_variants()):
+        profiler.count("variants")
+        t = profiler.start()
+        id = record.ID
+        vep_tag_value = record.get_tag_value(VEP_TAG)
+        worst_transcript = csq_parser.parse(vep_tag_value)
+        worst_consequence = worst_transcript.worst_consequence
+        gene_symbol = worst_transcript.gene
+        t = profiler.lap("parse_csq", t)
+        if not gene_symbol: #skip intergeneic variants
+            continue
+        cadd_phred = float(worst_transcript.cadd_phred) if worst_transcript.cadd_phred else 0.0
+        categories = mask_engine.categories_of(mask_engine.encode(worst_consequence, cadd_phred))
+
+        # The None category is not present in the mask file and is
+        # therefore ignored downstream
+        for output_file, category in zip(output_files, categories):
+            output_file.write(f'{id} {gene_symbol} {category}\n')
+
+        if gene_symbol not in set_list_data:
+            set_list_data[gene_symbol] = {
+                "chr": record.CHROM,
+                "pos": str(record.POS),
+                "variants": [id]
+            }
+        else:
+            set_list_data[gene_symbol]["variants"].append(id)
+        profiler.lap("categorize", t)
+
+    for output_file in output_files:
+        output_file.close()
 
 
     # Create the set list file from  set_list_data
-    with open("regenie_input.set_list", "w") as output_file:
+    t = profiler.start()
+    with open(f"{output_prefix}.set_list", "w") as output_file:
         for gene in set_list_data.keys():
             data = set_list_data[gene]
             variants_str = ','.join(data["variants"])
             output_file.write(f'{gene} {data["chr"]} {data["pos"]} {variants_str}\n')
 
-    # remove duplicate values
-    all_categories = list(set(all_categories))
-    all_categories.sort()
-
-    # Create the mask file - currently hardcoded
-    with open("regenie_input.masks", "w") as output_file:
-        missense_categories = [cat for cat in all_categories if "missense" in cat]
-        output_file.write(f'mask_missense {",".join(missense_categories)}\n')
-        high_cadd_categories = [cat for cat in all_categories if "high_cadd" in cat]
-        output_file.write(f'mask_cadd {",".join(high_cadd_categories)}\n')
-        missense_cadd_categories = [cat for cat in all_categories if "missense" in cat and "high_cadd" in cat]
-        output_file.write(f'mask_missense_cadd {",".join(missense_cadd_categories)}\n')
-        nonsense_splice_categories = [cat for cat in all_categories if "nonsense" in cat or "essential_splice" in cat]
-        output_file.write(f'mask_nonsense_splice {",".join(nonsense_splice_categories)}\n')
+    # Create the mask files
+    for config, prefix in enumerate(config_prefixes):
+        with open(f"{prefix}.masks", "w") as output_file:
+            output_file.writelines(mask_engine.mask_lines(config))
+    profiler.lap("write_set_list_and_masks", t)
+
+    if debug:
+        print(consequence_cache_stats())
+    profiler.write()
 
 
 if __name__ == "__main__":
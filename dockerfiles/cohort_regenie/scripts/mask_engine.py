@@ -0,0 +1,149 @@
+################################################
+#   Libraries
+################################################
+
+import ast
+
+
+################################################
+#   Top level variables
+################################################
+
+# Category bits of a variant, followed by one bit per CADD threshold
+MISSENSE = 1 << 0
+NONSENSE = 1 << 1
+ESSENTIAL_SPLICE = 1 << 2
+CADD_SHIFT = 3
+
+CONSEQUENCE_BITS = {
+    "missense_variant": MISSENSE,
+    "stop_gained": NONSENSE,
+    "splice_acceptor_variant": ESSENTIAL_SPLICE,
+    "splice_donor_variant": ESSENTIAL_SPLICE,
+}
+
+# Categories in the order they are joined into the Regenie annotation category (e.g. missense_high_cadd).
+# high_cadd is the CADD bit of the threshold of a configuration
+CATEGORY_ORDER = ["missense", "high_cadd", "nonsense", "essential_splice"]
+
+# Masks written by default, as NAME=EXPRESSION
+DEFAULT_MASKS = [
+    "mask_missense=missense",
+    "mask_cadd=high_cadd",
+    "mask_missense_cadd=missense & high_cadd",
+    "mask_nonsense_splice=nonsense | essential_splice",
+]
+
+
+################################################
+#   Functions
+################################################
+
+def compile_expression(expression, category_bits):
+    '''
+    Compiles a mask expression into a function of the category bits of a variant.
+    Expressions combine category names with & (and), | (or), ~ (not) and parentheses,
+    e.g. "missense & high_cadd | nonsense". category_bits is {name: bit}
+    '''
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        raise ValueError(f"Mask expression {expression} is not valid")
+
+    def build(node):
+        if isinstance(node, ast.Name):
+            if node.id not in category_bits:
+                raise ValueError(f"Unknown category {node.id} in mask expression {expression}, "
+                                 f"expected one of {', '.join(CATEGORY_ORDER)}")
+            bit = category_bits[node.id]
+            return lambda bits: bits & bit != 0
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            left, right = build(node.left), build(node.right)
+            if isinstance(node.op, ast.BitAnd):
+                return lambda bits: left(bits) and right(bits)
+            return lambda bits: left(bits) or right(bits)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+            operand = build(node.operand)
+            return lambda bits: not operand(bits)
+        raise ValueError(f"Mask expression {expression} is not valid, categories are combined with &, | and ~")
+
+    return build(tree.body)
+
+
+def parse_mask(mask):
+    ''' splits NAME=EXPRESSION '''
+    name, is_expression, expression = mask.partition("=")
+    if not is_expression or not name.strip() or not expression.strip():
+        raise ValueError(f"Mask {mask} is not NAME=EXPRESSION")
+    return name.strip(), expression
+
+
+################################################
+#   Classes
+################################################
+
+class MaskEngine(object):
+    '''
+    Assigns Regenie annotation categories and masks for several CADD thresholds at once.
+
+    Every variant is encoded once as a bitset of its categories (encode), with a CADD
+    bit per threshold. Each threshold is a configuration with its own high_cadd bit:
+    categories_of(bits) returns the annotation category of the variant in every configuration.
+    The masks (NAME=EXPRESSION, see compile_expression) are evaluated on the distinct
+    bitsets only, when the mask files are written (mask_lines).
+    '''
+
+    def __init__(self, cadd_thresholds, masks=DEFAULT_MASKS):
+        if len(set(cadd_thresholds)) != len(cadd_thresholds):
+            raise ValueError(f"CADD thresholds are not unique: {cadd_thresholds}")
+        self.cadd_thresholds = list(cadd_thresholds)
+        self.cadd_bits = [1 << (CADD_SHIFT + i) for i in range(len(self.cadd_thresholds))]
+        # {name: bit} of the categories of every configuration
+        self.category_bits = [
+            {"missense": MISSENSE, "high_cadd": cadd_bit, "nonsense": NONSENSE, "essential_splice": ESSENTIAL_SPLICE}
+            for cadd_bit in self.cadd_bits
+        ]
+        self.masks = [parse_mask(mask) for mask in masks]
+        names = [name for name, _ in self.masks]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Mask names are not unique: {', '.join(names)}")
+        self.mask_functions = [
+            [(name, compile_expression(expression, category_bits)) for name, expression in self.masks]
+            for category_bits in self.category_bits
+        ]
+        # {bits: (category of every configuration)}, also the distinct bitsets seen
+        self.categories = {}
+
+    def encode(self, worst_consequence, cadd_phred):
+        ''' category bits of a variant. cadd_phred is 0 if the variant has no CADD score '''
+        bits = CONSEQUENCE_BITS.get(worst_consequence, 0)
+        for threshold, cadd_bit in zip(self.cadd_thresholds, self.cadd_bits):
+            if cadd_phred >= threshold:
+                bits |= cadd_bit
+        return bits
+
+    def categories_of(self, bits):
+        ''' tuple with the annotation category of every configuration, None if the variant has none '''
+        categories = self.categories.get(bits)
+        if categories is None:
+            categories = tuple(
+                "_".join(name for name in CATEGORY_ORDER if bits & category_bits[name]) or None
+                for category_bits in self.category_bits
+            )
+            self.categories[bits] = categories
+        return categories
+
+    def mask_lines(self, config):
+        '''
+        lines of the Regenie mask file of a configuration (index of its CADD threshold).
+        A mask lists the sorted categories seen in the variants that match its expression
+        '''
+        masks = {name: set() for name, _ in self.masks}
+        for bits, categories in self.categories.items():
+            category = categories[config]
+            if category is None:
+                continue
+            for name, function in self.mask_functions[config]:
+                if function(bits):
+                    masks[name].add(category)
+        return [f'{name} {",".join(sorted(masks[name]))}\n' for name, _ in self.masks]
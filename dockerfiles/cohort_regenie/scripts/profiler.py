@@ -0,0 +1,235 @@
+################################################
+#   Libraries
+################################################
+
+import cProfile
+import json
+import time
+
+
+################################################
+#   Top level variables
+################################################
+
+# Number of records per throughput measurement in scripts without chunks of their own
+PROFILE_CHUNK_SIZE = 100000
+
+
+################################################
+#   Classes
+################################################
+
+class PhaseProfiler(object):
+    '''
+    Records cumulative wall time, number of calls and number of processed items
+    of named phases of a script, as well as the throughput of every chunk.
+
+    Hot loops time consecutive phases with chained timestamps:
+        t = profiler.start()
+        ...
+        t = profiler.lap("parse_csq", t)
+        ...
+        t = profiler.lap("count_genotypes", t)
+    Larger blocks can use `with profiler.phase(name):`.
+
+    If cprofile_file is set, the whole run is profiled with cProfile as well
+    and the pstats file is written by write().
+    '''
+
+    enabled = True
+
+    def __init__(self, profile_file=None, cprofile_file=None):
+        self.profile_file = profile_file
+        self.cprofile_file = cprofile_file
+        self.phases = {}  # name: [seconds, calls, items]
+        self.chunks = {}  # name: [[items, seconds], ...]
+        self.chunk_starts = {}
+        self.counts = {}  # name: items of the current chunk
+        self.merged = False  # stats of other processes were merged
+        self.start_time = time.perf_counter()
+        self.cprofile = None
+        if cprofile_file:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def start(self):
+        return time.perf_counter()
+
+    def lap(self, name, start, items=1):
+        ''' adds the time since start to phase name and returns the current time '''
+        now = time.perf_counter()
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0.0, 0, 0]
+        phase[0] += now - start
+        phase[1] += 1
+        phase[2] += items
+        return now
+
+    def phase(self, name, items=1):
+        return _Phase(self, name, items)
+
+    def iterate(self, name, iterable):
+        ''' yields from iterable and adds the time spent waiting for every item to phase name '''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.lap(name, start, 0)
+                return
+            self.lap(name, start)
+            yield item
+
+    def chunk(self, name, items):
+        ''' marks the end of a chunk of items. Its throughput is measured since the end of the previous one '''
+        now = time.perf_counter()
+        start = self.chunk_starts.get(name, self.start_time)
+        self.chunks.setdefault(name, []).append([items, now - start])
+        self.chunk_starts[name] = now
+
+    def count(self, name, chunk_size=PROFILE_CHUNK_SIZE):
+        ''' counts one item of name and marks the end of a chunk every chunk_size items '''
+        items = self.counts.get(name, 0) + 1
+        if items == chunk_size:
+            self.chunk(name, items)
+            items = 0
+        self.counts[name] = items
+
+    def pop_stats(self):
+        '''
+        returns the recorded phases and chunks (e.g. of a worker process) and resets them.
+        The next chunks are measured from now
+        '''
+        stats = {"phases": self.phases, "chunks": self.chunks}
+        self.phases, self.chunks = {}, {}
+        now = time.perf_counter()
+        for name in self.chunk_starts:
+            self.chunk_starts[name] = now
+        return stats
+
+    def merge(self, stats):
+        ''' adds stats returned by pop_stats of another profiler '''
+        self.merged = True
+        for name, (seconds, calls, items) in stats["phases"].items():
+            phase = self.phases.setdefault(name, [0.0, 0, 0])
+            phase[0] += seconds
+            phase[1] += calls
+            phase[2] += items
+        for name, chunks in stats["chunks"].items():
+            self.chunks.setdefault(name, []).extend(chunks)
+
+    def summary(self):
+        '''
+        JSON summary of the phases and chunks. With merged stats of other processes, the seconds
+        of a phase are summed over the processes and are not a share of the wall time of the run,
+        so percent_of_total is left out
+        '''
+        total = time.perf_counter() - self.start_time
+        phases = {}
+        for name, (seconds, calls, items) in sorted(self.phases.items(), key=lambda x: -x[1][0]):
+            phases[name] = {
+                "seconds": round(seconds, 6),
+                "calls": calls,
+                "items": items,
+                "items_per_second": round(items / seconds, 2) if seconds else None,
+            }
+            if not self.merged:
+                phases[name]["percent_of_total"] = round(100 * seconds / total, 2) if total else None
+        chunks = {}
+        for name, name_chunks in self.chunks.items():
+            chunks[name] = [
+                {
+                    "chunk": i,
+                    "items": items,
+                    "seconds": round(seconds, 6),
+                    "items_per_second": round(items / seconds, 2) if seconds else None,
+                }
+                for i, (items, seconds) in enumerate(name_chunks)
+            ]
+        return {"total_seconds": round(total, 6), "merged_processes": self.merged, "phases": phases, "chunks": chunks}
+
+    def write(self):
+        ''' writes the JSON summary and the cProfile stats, if requested '''
+        for name, items in self.counts.items():
+            if items:
+                self.chunk(name, items)
+        self.counts = {}
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_file)
+            print(f"cProfile stats written to {self.cprofile_file}")
+        if self.profile_file:
+            with open(self.profile_file, "w") as f_out:
+                json.dump(self.summary(), f_out, indent=2)
+            print(f"Profile written to {self.profile_file}")
+
+
+class _Phase(object):
+
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.lap(self.name, self.start, self.items)
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullProfiler(object):
+    ''' Profiler used when profiling is disabled. Every method does (almost) nothing '''
+
+    enabled = False
+    _phase = _NullPhase()
+
+    def start(self):
+        return 0
+
+    def lap(self, name, start, items=1):
+        return 0
+
+    def phase(self, name, items=1):
+        return self._phase
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def chunk(self, name, items):
+        pass
+
+    def count(self, name, chunk_size=PROFILE_CHUNK_SIZE):
+        pass
+
+    def pop_stats(self):
+        return None
+
+    def merge(self, stats):
+        pass
+
+    def write(self):
+        pass
+
+
+################################################
+#   Functions
+################################################
+
+def get_profiler(profile_file=None, cprofile_file=None):
+    ''' returns a PhaseProfiler if any output is requested, a NullProfiler otherwise '''
+    if profile_file or cprofile_file:
+        return PhaseProfiler(profile_file, cprofile_file)
+    return NullProfiler()
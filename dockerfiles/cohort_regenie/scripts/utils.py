@@ -1,5 +1,8 @@
 from granite.lib.shared_functions import *
 import json
+from collections import namedtuple
+from functools import lru_cache
+import sys
 
 VALID_GENOTYPES = ["./.", "0/0", "1/0", "0/1", "1/1" , "0|0", "1|0", "0|1", "1|1"]
 
@@ -33,12 +36,42 @@ VEP_ORDER = {
     'MODIFIER': 23
 }
 
+# Maximum number of distinct consequence strings kept in the consequence ranking cache.
+# A whole genome has a few hundred of them
+CONSEQUENCE_CACHE_SIZE = 4096
+
 def get_cases(sample_info):
     sample_info_dec = json.loads(sample_info)
     sample_info_cases = filter(lambda s: s["is_affected"], sample_info_dec)
     return list(map(lambda x: x["sample_id"], sample_info_cases))
 
 def get_worst_consequence(consequence, sep='&'):
+    ''' '''
+    if sep == '&':
+        return rank_consequence(consequence)[1]
+    #end if
+    return _get_worst_consequence(consequence, sep)
+#end def
+
+@lru_cache(maxsize=CONSEQUENCE_CACHE_SIZE)
+def rank_consequence(consequence):
+    '''
+    Returns (rank, worst consequence) of a '&'-joined VEP consequence string.
+    Results are cached and the consequence terms interned,
+    so every distinct string is only split and sorted once
+    '''
+    worst_cnsqce = sys.intern(_get_worst_consequence(consequence))
+    return VEP_ORDER.get(worst_cnsqce, VEP_ORDER['MODIFIER']), worst_cnsqce
+#end def
+
+def consequence_cache_stats():
+    info = rank_consequence.cache_info()
+    total = info.hits + info.misses
+    hit_rate = info.hits / total if total else 0
+    return f"Consequence cache: {info.hits} hits, {info.misses} misses ({hit_rate:.1%} hit rate), {info.currsize} consequences cached"
+#end def
+
+def _get_worst_consequence(consequence, sep='&'):
     ''' '''
     consequence_tup = []
     for cnsqce in consequence.split(sep):
@@ -60,11 +93,8 @@ def get_worst_transcript(VEP_val, CNONICL_idx, CONSEQUENCE_idx, sep='&'):
     # Assign worst impact to transcripts
     for trscrpt in trscrpt_list:
         trscrpt_cnsqce = trscrpt.split('|')[CONSEQUENCE_idx]
-        worst_cnsqce = get_worst_consequence(trscrpt_cnsqce)
-        try: worst_trscrpt_tup.append((VEP_ORDER[worst_cnsqce], trscrpt))
-        except Exception:
-            worst_trscrpt_tup.append((VEP_ORDER['MODIFIER'], trscrpt))
-        #end try
+        worst_impact, _ = rank_consequence(trscrpt_cnsqce)
+        worst_trscrpt_tup.append((worst_impact, trscrpt))
     #end for
     sorted_worst_trscrpt_tup = sorted(worst_trscrpt_tup, key=lambda x_y: x_y[0])
     worst_impact = sorted_worst_trscrpt_tup[0][0]
@@ -85,4 +115,88 @@ def get_worst_transcript(VEP_val, CNONICL_idx, CONSEQUENCE_idx, sep='&'):
     return worst_trscrpt_list[0]
 #end def
 
+class CsqParser(object):
+    '''
+    Single pass decoder for the VEP annotation (CSQ) of a variant.
+
+    Each transcript is split once. While the transcripts are read, the worst
+    one is selected the same way get_worst_transcript does (worst consequence,
+    canonical first among equally bad ones). parse() returns a Transcript tuple
+    with the fields registered in `fields` ({name: VEP field}) for that transcript
+    and its worst consequence.
+
+    dbNSFP fields listed in `dbnsfp_fields` are resolved for the transcript
+    as in clean_dbnsfp. Fields in `first_transcript_fields` are taken from the
+    first transcript instead (e.g. SpliceAI, which has the same scores for all transcripts).
+    '''
+
+    CANONICAL = ('YES', '1')
+
+    def __init__(self, header, fields, dbnsfp_fields=(), first_transcript_fields=None, VEPtag='CSQ', sep='&'):
+        self.VEPtag = VEPtag
+        self.sep = sep
+        first_transcript_fields = first_transcript_fields or {}
+        self.idxs = [header.get_tag_field_idx(VEPtag, field) for field in fields.values()]
+        self.first_idxs = [header.get_tag_field_idx(VEPtag, field) for field in first_transcript_fields.values()]
+        self.Transcript = namedtuple('Transcript', list(fields) + ['worst_consequence'] + list(first_transcript_fields))
+
+        self.idx_consequence = header.get_tag_field_idx(VEPtag, 'Consequence')
+        self.idx_canonical = header.get_tag_field_idx(VEPtag, 'CANONICAL')
+
+        # Positions in the Transcript tuple of the registered dbNSFP fields
+        dbnsfp_idxs = set(header.get_tag_field_idx(VEPtag, field) for field in dbnsfp_fields)
+        self.dbnsfp_positions = [i for i, idx in enumerate(self.idxs) if idx in dbnsfp_idxs]
+        if self.dbnsfp_positions:
+            self.idx_dbnsfp_ENST = header.get_tag_field_idx(VEPtag, 'Ensembl_transcriptid')
+            self.idx_ENST = header.get_tag_field_idx(VEPtag, 'Feature')
+        #end if
+    #end def
+
+    def parse(self, VEP_val):
+        ''' returns the worst transcript of VEP_val as a Transcript tuple '''
+        idx_consequence, idx_canonical = self.idx_consequence, self.idx_canonical
+        worst_rank = worst_split = worst_cnsqce = None
+        worst_is_canonical = False
+        first_split = None
+        for trscrpt in VEP_val.split(','):
+            trscrpt_split = trscrpt.split('|')
+            if first_split is None:
+                first_split = trscrpt_split
+            #end if
+            rank, cnsqce = rank_consequence(trscrpt_split[idx_consequence])
+            if worst_rank is None or rank < worst_rank:
+                worst_rank, worst_split, worst_cnsqce = rank, trscrpt_split, cnsqce
+                worst_is_canonical = trscrpt_split[idx_canonical] in self.CANONICAL
+            elif rank == worst_rank and not worst_is_canonical \
+                and trscrpt_split[idx_canonical] in self.CANONICAL:
+                worst_split, worst_cnsqce, worst_is_canonical = trscrpt_split, cnsqce, True
+            #end if
+        #end for
+
+        values = [worst_split[idx] for idx in self.idxs]
+        if self.dbnsfp_positions:
+            self._resolve_dbnsfp(worst_split, values)
+        #end if
+        values.append(worst_cnsqce)
+        values.extend(first_split[idx] for idx in self.first_idxs)
+        return self.Transcript._make(values)
+    #end def
+
+    def _resolve_dbnsfp(self, trscrpt_split, values):
+        ''' assigns dbNSFP values to the transcript, see clean_dbnsfp '''
+        dbnsfp_ENST = trscrpt_split[self.idx_dbnsfp_ENST].split(self.sep)
+        try: dbnsfp_idx = dbnsfp_ENST.index(trscrpt_split[self.idx_ENST])
+        except ValueError: dbnsfp_idx = -1
+        #end try
+        for i in self.dbnsfp_positions:
+            if dbnsfp_idx >= 0:
+                val_ = values[i].split(self.sep)[dbnsfp_idx]
+                values[i] = '' if val_ == '.' else val_
+            else:
+                values[i] = ''
+            #end if
+        #end for
+    #end def
+#end class
+
 
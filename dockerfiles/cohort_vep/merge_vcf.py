@@ -0,0 +1,231 @@
+################################################
+#   Libraries
+################################################
+
+import click
+from bgzf import BgzfReader, BgzfWriter, TabixIndex
+from vcf_reader import VcfReader
+from vep_cache import DEFAULT_MAX_ENTRIES, AnnotationCache, variant_id
+
+
+################################################
+#   Top level variables
+################################################
+
+CACHE_BATCH_SIZE = 10000
+
+
+################################################
+#   Functions
+################################################
+
+def columns_line(header):
+    ''' the #CHROM line of a VCF header '''
+    lines = header.rstrip("\n").split("\n")
+    return lines[-1] if lines else ""
+
+
+def merge_vcfs(input_vcfs, out):
+    '''
+    Concatenates the records of the bgzipped input_vcfs, in the given order, into out
+    (bgzipped and tabix indexed), with the header of the first file.
+    Compressed blocks are copied as they are. Only the block in which the header of
+    each file ends is recompressed, from the first record on.
+    Returns the number of files with records
+    '''
+    num_merged = 0
+    with BgzfWriter(out, TabixIndex()) as f_out:
+        columns = None
+        for input_vcf in input_vcfs:
+            with BgzfReader(input_vcf) as reader:
+                header, data_offset = reader.header()
+                if columns is None:
+                    columns = columns_line(header)
+                    f_out.write(header)
+                elif columns_line(header) != columns:
+                    raise ValueError(f"The samples of {input_vcf} do not match the samples of {input_vcfs[0]}")
+                if data_offset is None:
+                    continue
+                for block_offset, block, data in reader.blocks(data_offset >> 16):
+                    if block_offset == data_offset >> 16 and data_offset & 0xffff:
+                        f_out.write_data(data[data_offset & 0xffff:])
+                    else:
+                        f_out.write_block(block, data)
+            # Files that do not end with a newline
+            if f_out.line_start is not None:
+                f_out.write_data(b"\n")
+            num_merged += 1
+    return num_merged
+
+
+def line_id(line):
+    ''' variant ID of a VCF data line '''
+    chrom, pos, _, ref, alt, _ = line.split("\t", 5)
+    return variant_id(chrom, pos, ref, alt)
+
+
+def csq_value(line):
+    ''' CSQ value in the INFO of a VCF data line, empty if there is none '''
+    info = line.split("\t", 8)[7]
+    for item in info.split(";"):
+        if item.startswith("CSQ="):
+            return item[4:]
+    return ""
+
+
+def add_csq(line, csq):
+    ''' adds CSQ to the INFO of a VCF data line, as VEP does '''
+    if not csq:
+        return line
+    fields = line.split("\t", 8)
+    fields[7] = f"CSQ={csq}" if fields[7] == "." else f"{fields[7]};CSQ={csq}"
+    return "\t".join(fields)
+
+
+def vep_records(vep_vcfs):
+    ''' generator over the data lines of the VEP outputs, in order '''
+    for vep_vcf in vep_vcfs:
+        for line in VcfReader.read_vcf(vep_vcf):
+            if line[0] != "#":
+                yield line
+
+
+def merge_with_cache(input_vcf, vep_vcfs, out, cache_file, cache_version, max_entries):
+    '''
+    Writes the records of input_vcf to out (bgzipped and tabix indexed) with their VEP
+    annotation, taken from the annotation cache or, for the variants that were not cached
+    when split_vcf.py --cache ran, from the VEP outputs. The annotations of the VEP outputs
+    are added to the cache, which is then reduced to max_entries.
+    '''
+    header = VcfReader(input_vcf).header
+    header_key = f"vep_header:{cache_version}"
+    with AnnotationCache(cache_file, cache_version) as cache, \
+         BgzfWriter(out, TabixIndex()) as f_out:
+        # VEP adds its header lines (CSQ definition, versions) to the header of the input
+        if vep_vcfs:
+            with BgzfReader(vep_vcfs[0]) as reader:
+                vep_header, _ = reader.header()
+            input_lines = set(header.definitions.splitlines())
+            vep_lines = "".join(
+                line + "\n" for line in vep_header.splitlines()
+                if line not in input_lines and not line.startswith("#CHROM")
+            )
+            cache.set_meta(header_key, vep_lines)
+        else:
+            vep_lines = cache.get_meta(header_key)
+            if vep_lines is None:
+                raise ValueError(f"No VEP output and no VEP header for version {cache_version} in {cache_file}")
+        f_out.write(header.definitions + vep_lines + header.columns)
+
+        fresh = vep_records(vep_vcfs)
+        num_cached, num_fresh = 0, 0
+
+        def write_batch(lines):
+            nonlocal num_cached, num_fresh
+            ids = [line_id(line) for line in lines]
+            cached = cache.get_many(ids)
+            annotated = []
+            for line, id in zip(lines, ids):
+                csq = cached.get(id)
+                if csq is not None:
+                    f_out.write_record(add_csq(line, csq))
+                    num_cached += 1
+                    continue
+                vep_line = next(fresh, None)
+                if vep_line is None or line_id(vep_line) != id:
+                    raise ValueError(f"{id} is neither in the annotation cache nor the next record of the VEP outputs")
+                f_out.write_record(vep_line)
+                annotated.append((id, csq_value(vep_line)))
+                num_fresh += 1
+            cache.put_many(annotated)
+
+        lines = []
+        for line in VcfReader.read_vcf(input_vcf):
+            if line[0] == "#":
+                continue
+            lines.append(line)
+            if len(lines) == CACHE_BATCH_SIZE:
+                write_batch(lines)
+                lines = []
+        write_batch(lines)
+        if next(fresh, None) is not None:
+            raise ValueError("The VEP outputs have more records than the variants of the input that are not cached")
+
+        cache.store_pending()
+        evicted = cache.evict(max_entries)
+        print(f"{num_cached} variants from the annotation cache, {num_fresh} annotated by VEP "
+              f"({100 * num_cached / max(1, num_cached + num_fresh):.1f}% hit rate)")
+        print(f"Annotation cache: {cache.stored} stored, {evicted} evicted, {cache.num_entries()} entries")
+
+
+@click.command()
+@click.help_option("--help", "-h")
+@click.option(
+    "-o",
+    "--out",
+    required=True,
+    type=str,
+    help="Output VCF file (bgzipped and tabix indexed)",
+)
+@click.option(
+    "-i",
+    "--input-vcf",
+    required=False,
+    type=str,
+    default=None,
+    help="VCF that was split with split_vcf.py --cache. Required with --cache",
+)
+@click.option(
+    "--cache",
+    required=False,
+    type=str,
+    default=None,
+    help="SQLite annotation cache (see vep_cache.py). Cached annotations are added to the records of the input VCF "
+    "that are not in the VEP outputs, and the annotations of the VEP outputs are cached",
+)
+@click.option(
+    "--cache-version",
+    required=False,
+    type=str,
+    default="default",
+    show_default=True,
+    help="Version of VEP and its data sources, as given to split_vcf.py",
+)
+@click.option(
+    "--cache-max-entries",
+    required=False,
+    type=int,
+    default=DEFAULT_MAX_ENTRIES,
+    show_default=True,
+    help="Least recently used annotations above this number of entries are removed from the cache",
+)
+@click.argument("input_vcfs", nargs=-1, required=False)
+def main(out, input_vcf, cache, cache_version, cache_max_entries, input_vcfs):
+    """Concatenates bgzipped VCF files with the same samples (e.g. the VEP outputs of the chunks
+    written by split_vcf.py) into a single bgzipped and tabix indexed VCF, replacing bcftools concat
+    and tabix. The files have to be given in genomic order.
+
+    With --cache, the output has the records of the input VCF, in its order. Records that
+    split_vcf.py --cache found in the cache are annotated from it, all others are taken from
+    the VEP outputs, whose annotations are then added to the cache.
+
+    Example usage:
+
+    python merge_vcf.py -o combined.vep.vcf.gz VCFS/vep_chunk_plan_0.vep.vcf.gz VCFS/vep_chunk_plan_1.vep.vcf.gz
+
+    python merge_vcf.py -o combined.vep.vcf.gz -i input.vcf.gz --cache vep_annotation_cache.sqlite --cache-version 101_GRCh38 VCFS/vep_chunk_plan_0.vep.vcf.gz
+
+    """
+    if cache:
+        if not input_vcf:
+            raise click.UsageError("--input-vcf is required with --cache")
+        merge_with_cache(input_vcf, list(input_vcfs), out, cache, cache_version, cache_max_entries)
+        return
+    if not input_vcfs:
+        raise click.UsageError("No VCF files to merge")
+    num_merged = merge_vcfs(list(input_vcfs), out)
+    print(f"Merged {num_merged} files with records into {out}")
+
+
+if __name__ == "__main__":
+    main()
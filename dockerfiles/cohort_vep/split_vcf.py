@@ -3,8 +3,13 @@
 ################################################
 
 import click
-from granite.lib import vcf_parser
+import heapq
+import itertools
 import os
+from array import array
+from bgzf import BgzfReader, BgzfWriter, TabixIndex
+from vcf_reader import VcfReader
+from vep_cache import AnnotationCache, variant_id
 
 
 ################################################
@@ -15,6 +20,17 @@ import os
 CHUNK_SIZE = 500000
 CHUNK_PREFIX = "vep_chunk"
 
+# VEP cost model used by --plan-workers, in units of the cost of a SNV outside genes.
+# Indels take longer to annotate (HGVS, shifting) and variants in gene dense
+# windows overlap more transcripts
+INDEL_WEIGHT = 1.0
+GENE_WEIGHT = 1.0
+GENE_WINDOW = 1000000
+
+# Records of the input that are not in the annotation cache, with --cache
+NOVEL_VCF = "vep_novel_variants.vcf.gz"
+CACHE_BATCH_SIZE = 10000
+
 
 ################################################
 #   Functions
@@ -37,9 +53,96 @@ CHUNK_PREFIX = "vep_chunk"
     type=str,
     help="the output file name of the gzipped VCF after filtering",
 )
-def main(input_vcf, out):
-    
-    vcf_obj = vcf_parser.Vcf(input_vcf)
+@click.option(
+    "-r",
+    "--region",
+    required=False,
+    type=str,
+    default=None,
+    help="Chromosome to split out of the bgzipped and tabix indexed input VCF. "
+    "Compressed blocks are copied to the chunks as they are, only the blocks at chunk boundaries are recompressed",
+)
+@click.option(
+    "-w",
+    "--plan-workers",
+    required=False,
+    type=int,
+    default=None,
+    help="Split the whole bgzipped input into chunks of equal estimated VEP cost for this number of parallel VEP runs. "
+    "The chunk names are written most expensive first",
+)
+@click.option(
+    "-c",
+    "--chunks-per-worker",
+    required=False,
+    type=int,
+    default=2,
+    show_default=True,
+    help="Number of chunks per worker with --plan-workers",
+)
+@click.option(
+    "-g",
+    "--genes",
+    required=False,
+    type=str,
+    default=None,
+    help="BED file of genes used for the gene density in the VEP cost estimate of --plan-workers",
+)
+@click.option(
+    "--cache",
+    required=False,
+    type=str,
+    default=None,
+    help="SQLite annotation cache (see vep_cache.py). Only the variants that are not in the cache are split into chunks",
+)
+@click.option(
+    "--cache-version",
+    required=False,
+    type=str,
+    default="default",
+    show_default=True,
+    help="Version of VEP and its data sources. Cached annotations of other versions are not used",
+)
+def main(input_vcf, out, region, plan_workers, chunks_per_worker, genes, cache, cache_version):
+    """Splits a VCF into chunks of CHUNK_SIZE variants (bgzipped and tabix indexed)
+    and appends the chunk names to the out file.
+
+    With --region, the chromosome is read directly from the indexed input, replacing
+    bcftools view. The chunk names are the same as when the chromosome was written to
+    split_by_chr.<region>.vcf.gz by bcftools view first.
+
+    With --plan-workers, all chromosomes are split into chunks of equal estimated VEP cost
+    (number of variants, weighted for indels and gene density), so that the parallel VEP
+    runs finish at about the same time. The predicted makespan is printed.
+
+    With --cache, the variants that were annotated by a previous run with the same
+    --cache-version are left out of the chunks. merge_vcf.py --cache adds them back.
+
+    Example usage:
+
+    python split_vcf.py -i split_by_chr.chr1.vcf.gz -o vep_chunk_files.txt
+
+    python split_vcf.py -i input.vcf.gz -r chr1 -o vep_chunk_files.txt
+
+    python split_vcf.py -i input.vcf.gz -w 16 -c 2 -g genes.bed -o vep_chunk_files.txt
+
+    python split_vcf.py -i input.vcf.gz -w 16 --cache vep_annotation_cache.sqlite --cache-version 101_GRCh38 -o vep_chunk_files.txt
+
+    """
+    if cache:
+        input_vcf = write_novel_variants(input_vcf, cache, cache_version)
+
+    if region or plan_workers:
+        if plan_workers:
+            chunk_files = plan_split(input_vcf, plan_workers, chunks_per_worker, genes)
+        else:
+            chunk_files = split_region(input_vcf, region)
+        with open(out, "a") as f:
+            for line in chunk_files:
+                f.write(line + "\n")
+        return
+
+    vcf_obj = VcfReader(input_vcf)
 
     num_variants = 0
 
@@ -68,6 +171,203 @@ def main(input_vcf, out):
 
 
 
+def write_novel_variants(input_vcf, cache_file, cache_version):
+    ''' writes the records of input_vcf that are not in the annotation cache to NOVEL_VCF '''
+    vcf_obj = VcfReader(input_vcf)
+    with AnnotationCache(cache_file, cache_version) as cache, \
+         BgzfWriter(NOVEL_VCF, TabixIndex()) as f_out:
+        vcf_obj.write_header(f_out)
+
+        def write_batch(records):
+            cached = cache.get_many(variant_id(r.CHROM, r.POS, r.REF, r.ALT) for r in records)
+            for record in records:
+                if variant_id(record.CHROM, record.POS, record.REF, record.ALT) not in cached:
+                    f_out.write_record(record.to_string())
+
+        records = []
+        for record in vcf_obj.parse_variants():
+            records.append(record)
+            if len(records) == CACHE_BATCH_SIZE:
+                write_batch(records)
+                records = []
+        write_batch(records)
+        print(f"Annotation cache: {cache.hits} of {cache.hits + cache.misses} variants cached "
+              f"({100 * cache.hit_rate():.1f}% hit rate), {cache.misses} variants to annotate")
+    return NOVEL_VCF
+
+
+def split_region(input_vcf, region):
+    '''
+    Writes the records of region in chunks of CHUNK_SIZE records by copying the compressed
+    blocks of input_vcf (see copy_chunks). Returns the chunk names
+    '''
+    index = TabixIndex.read(f"{input_vcf}.tbi")
+    if region not in index.names:
+        return []
+    first_offset, last_offset, _ = index.meta[index.names.index(region)]
+    chunk_name = f"{CHUNK_PREFIX}_split_by_chr.{region}.vcf.gz"
+    chunks = ((f"{chunk_name}_{i}", CHUNK_SIZE) for i in itertools.count())
+    return copy_chunks(input_vcf, chunks, first_offset, last_offset)
+
+
+def copy_chunks(input_vcf, chunks, first_offset, last_offset=None):
+    '''
+    Writes the records of input_vcf between the virtual offsets first_offset and last_offset
+    (None for the end of the file) to consecutive chunks (bgzipped and tabix indexed).
+    chunks is an iterable of (chunk name, number of records) with room for all records.
+    Compressed blocks are copied as they are, blocks that contain a
+    chunk boundary or the start or end of the records are recompressed.
+    Returns the names of the chunks that were written
+    '''
+    chunks = iter(chunks)
+    chunk_files = []
+    f_out = None
+    num_records, chunk_size = 0, 0
+    last_block = last_offset >> 16 if last_offset is not None else None
+    with BgzfReader(input_vcf) as reader:
+        header, _ = reader.header()
+        for block_offset, block, data in reader.blocks(first_offset >> 16):
+            start = first_offset & 0xffff if block_offset == first_offset >> 16 else 0
+            end = last_offset & 0xffff if block_offset == last_block else len(data)
+            whole_block = start == 0 and end == len(data)
+            while start < end:
+                if f_out is None:
+                    chunk_file, chunk_size = next(chunks, (None, None))
+                    if chunk_file is None:
+                        raise ValueError(f"{input_vcf} has more records than the chunks")
+                    f_out = BgzfWriter(f"{chunk_file}.vcf.gz", TabixIndex())
+                    f_out.write(header)
+                    chunk_files.append(chunk_file)
+                    num_records = 0
+                num_lines = data.count(b"\n", start, end)
+                if num_records + num_lines < chunk_size:
+                    if whole_block:
+                        f_out.write_block(block, data)
+                    else:
+                        f_out.write_data(data[start:end])
+                    num_records += num_lines
+                    break
+                # The chunk is complete after the line that brings it to chunk_size records
+                cut = start
+                for _ in range(chunk_size - num_records):
+                    cut = data.index(b"\n", cut) + 1
+                f_out.write_data(data[start:cut])
+                f_out.close()
+                f_out = None
+                start = cut
+                whole_block = False
+            if last_block is not None and block_offset >= last_block:
+                break
+    if f_out is not None:
+        f_out.close()
+    return chunk_files
+
+
+def read_gene_density(genes_file):
+    '''
+    Returns {(chrom, window): number of genes overlapping the window of GENE_WINDOW bp},
+    relative to the mean over the windows with genes. genes_file is a BED-like file
+    with chrom, start and end in the first three columns
+    '''
+    genes_per_window = {}
+    with open(genes_file) as f:
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            chrom, start, end = line.split("\t")[:3]
+            for window in range(int(start) // GENE_WINDOW, int(end) // GENE_WINDOW + 1):
+                genes_per_window[(chrom, window)] = genes_per_window.get((chrom, window), 0) + 1
+    if not genes_per_window:
+        return {}
+    mean = sum(genes_per_window.values()) / len(genes_per_window)
+    return {window: count / mean for window, count in genes_per_window.items()}
+
+
+def record_costs(input_vcf, gene_density):
+    '''
+    Returns the estimated VEP cost of every record of input_vcf, in file order,
+    and the number of records of every chromosome as [(chrom, num_records)]
+    '''
+    costs = array("f")
+    chromosomes = []
+    for line in VcfReader.read_vcf(input_vcf):
+        if line[0] == "#":
+            continue
+        chrom, pos, _, ref, alt, _ = line.split("\t", 5)
+        cost = 1.0
+        if any(len(allele) != len(ref) for allele in alt.split(",")):
+            cost += INDEL_WEIGHT
+        if gene_density:
+            cost += GENE_WEIGHT * gene_density.get((chrom, int(pos) // GENE_WINDOW), 0.0)
+        costs.append(cost)
+        if not chromosomes or chromosomes[-1][0] != chrom:
+            chromosomes.append([chrom, 0])
+        chromosomes[-1][1] += 1
+    return costs, chromosomes
+
+
+def plan_chunks(costs, num_chunks):
+    '''
+    Cuts the records into about num_chunks consecutive chunks of equal total cost,
+    of at most CHUNK_SIZE records. Returns [(num_records, cost)]
+    '''
+    target = sum(costs) / num_chunks
+    chunks = []
+    num_records, chunk_cost, cumulative = 0, 0.0, 0.0
+    for cost in costs:
+        num_records += 1
+        chunk_cost += cost
+        cumulative += cost
+        # Boundaries are placed on multiples of the target so that rounding does not add up
+        if cumulative >= (len(chunks) + 1) * target or num_records >= CHUNK_SIZE:
+            chunks.append((num_records, chunk_cost))
+            num_records, chunk_cost = 0, 0.0
+    if num_records:
+        chunks.append((num_records, chunk_cost))
+    return chunks
+
+
+def makespan(chunk_costs, workers):
+    ''' cost of the busiest worker when the chunks are handed out in order to the first free worker, as xargs -P does '''
+    loads = [0.0] * workers
+    for cost in chunk_costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def plan_split(input_vcf, workers, chunks_per_worker, genes_file=None):
+    '''
+    Splits input_vcf into chunks of equal estimated VEP cost, workers * chunks_per_worker
+    in total, by copying the compressed blocks. Returns the chunk names, most expensive first
+    '''
+    gene_density = read_gene_density(genes_file) if genes_file else {}
+    costs, chromosomes = record_costs(input_vcf, gene_density)
+    if not costs:
+        return []
+    # More chunks per worker if the chunks would have more than CHUNK_SIZE variants
+    chunks_per_worker = max(chunks_per_worker, -(-len(costs) // (CHUNK_SIZE * workers)))
+    chunks = plan_chunks(costs, workers * chunks_per_worker)
+    # Chunks are numbered in file order, so that the VEP outputs can be merged in sort -V order
+    chunk_files = [f"{CHUNK_PREFIX}_plan_{i}" for i in range(len(chunks))]
+    with BgzfReader(input_vcf) as reader:
+        _, first_offset = reader.header()
+    copy_chunks(input_vcf, zip(chunk_files, (num_records for num_records, _ in chunks)), first_offset)
+
+    # Predicted makespan compared to the perfect split and to CHUNK_SIZE chunks per chromosome
+    planned = sorted(range(len(chunks)), key=lambda i: chunks[i][1], reverse=True)
+    planned_makespan = makespan([chunks[i][1] for i in planned], workers)
+    fixed_costs, start = [], 0
+    for _, num_records in chromosomes:
+        for chunk_start in range(start, start + num_records, CHUNK_SIZE):
+            fixed_costs.append(sum(costs[chunk_start:min(chunk_start + CHUNK_SIZE, start + num_records)]))
+        start += num_records
+    total = sum(cost for _, cost in chunks)
+    print(f"Planned {len(chunks)} chunks for {workers} workers, {len(costs)} variants, estimated cost {total:.0f}")
+    print(f"Predicted makespan: {planned_makespan:.0f} (perfect balance {total / workers:.0f}, "
+          f"{len(fixed_costs)} chunks of {CHUNK_SIZE} variants per chromosome {makespan(fixed_costs, workers):.0f})")
+    return [chunk_files[i] for i in planned]
+
+
 def compress_and_close_chunk(chunk:int, input_vcf, file_handle):
     if chunk < 0 or not file_handle or file_handle.closed:
         return
@@ -19,9 +19,11 @@ CADD_indel=${11}
 nthreads=${12}
 version=${13} # 101
 assembly=${14} # GRCh38
+annotation_cache=${15} # optional, annotation cache of a previous run
 
 # self variables
 directory=VCFS/
+cache_file=vep_annotation_cache.sqlite
 
 # rename with version
 dbnsfp=dbNSFP4.1a.gz
@@ -58,12 +60,22 @@ basic_vep="--sift b --polyphen b --symbol --canonical"
 options="--fasta $reference --assembly $assembly --use_given_ref --offline --cache_version $version --dir_cache . $basic_vep --force_overwrite --vcf --compress_output bgzip"
 
 
-# Split file by chromosome and then in chunk of 500k variants
+# annotation cache, annotations are reused only with the same VEP version and data sources
+cache_version="${version}_${assembly}"
+for data_source in $vep_tar_gz $dbnsfp_gz $spliceai_snv_gz $spliceai_indel_gz $gnomad_gz $gnomad_gz2 $CADD_snv $CADD_indel;
+  do
+    cache_version="${cache_version}_$(basename $data_source)"
+  done
+
+if [[ -n "$annotation_cache" ]]; then
+  cp $annotation_cache $cache_file || exit 1
+fi
+
+# Split the variants that are not in the annotation cache in chunks of equal estimated VEP cost,
+# most expensive first, so that the parallel VEP runs finish at about the same time
 echo "Splitting files"
-bcftools index -s $input_vcf | cut -f 1 > chromfile.txt
 vep_chunk_file="./vep_chunk_files.txt"
-command="bcftools view -O z --threads 8 -o split_by_chr.{}.vcf.gz $input_vcf {} || exit 1; python $SCRIPT_LOCATION/split_vcf.py -i split_by_chr.{}.vcf.gz -o $vep_chunk_file || exit 1; rm split_by_chr.{}.vcf.gz"
-cat chromfile.txt | xargs -P $nthreads -i bash -c "$command" || exit 1 
+python $SCRIPT_LOCATION/split_vcf.py -i $input_vcf -w $nthreads -o $vep_chunk_file --cache $cache_file --cache-version "$cache_version" || exit 1
 
 
 # runnning VEP in parallel
@@ -73,6 +85,7 @@ cat $vep_chunk_file | xargs -P $nthreads -i bash -c "$command" || exit 1
 
 # merging the results
 echo "Merging vcf.gz files"
+shopt -s nullglob
 array=(${directory}*.vep.vcf.gz)
 
 IFS=$'\n' sorted=($(sort -V <<<"${array[*]}"))
@@ -87,11 +100,9 @@ for filename in ${sorted[@]};
     files_sorted="$files_sorted$filename "
   done
 
-echo "Concatenating files: $files_sorted"
-bcftools concat -o combined.vep.vcf.gz --threads 24 -O z $files_sorted || exit 1
+echo "Concatenating and indexing files: $files_sorted"
+python $SCRIPT_LOCATION/merge_vcf.py -o combined.vep.vcf.gz -i $input_vcf --cache $cache_file --cache-version "$cache_version" $files_sorted || exit 1
 echo "Removing temporary files"
-rm -f $files_sorted
+rm -f $files_sorted vep_novel_variants.vcf.gz vep_novel_variants.vcf.gz.tbi
 # echo "Sorting and indexing combined file"
 # bcftools sort -o combined.vep.vcf.gz -O z combined.vep.unsorted.vcf.gz || exit 1
-echo "Indexing combined file"
-tabix -p vcf combined.vep.vcf.gz || exit 1
@@ -0,0 +1,142 @@
+################################################
+#   Libraries
+################################################
+
+import sqlite3
+import time
+
+
+################################################
+#   Top level variables
+################################################
+
+# Number of IDs looked up with a single query
+QUERY_BATCH_SIZE = 500
+
+DEFAULT_MAX_ENTRIES = 50000000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    csq TEXT NOT NULL,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (id, version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS annotations_last_used ON annotations (last_used);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+################################################
+#   Classes
+################################################
+
+class AnnotationCache(object):
+    '''
+    On-disk SQLite cache of the VEP annotation (CSQ value, empty if VEP did not add one)
+    of every variant, keyed by the variant ID (CHROM_POS_REF_ALT, see variant_id) and
+    a version string of VEP and its data sources.
+
+    New entries are staged until store_pending (or close) is called.
+    Entries remember when they were last stored or looked up. evict() removes the least
+    recently used entries, of any version, above a maximum number of entries.
+    '''
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute("CREATE TEMP TABLE pending (id TEXT PRIMARY KEY, csq TEXT NOT NULL)")
+        self.now = int(time.time())
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_many(self, ids):
+        ''' returns {id: csq} for the ids that are in the cache, and marks them as used '''
+        ids = list(ids)
+        found = {}
+        for start in range(0, len(ids), QUERY_BATCH_SIZE):
+            batch = ids[start:start + QUERY_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            found.update(self.connection.execute(
+                f"SELECT id, csq FROM annotations WHERE version = ? AND id IN ({placeholders})",
+                [self.version] + batch,
+            ))
+        if found:
+            self.connection.executemany(
+                "UPDATE annotations SET last_used = ? WHERE id = ? AND version = ?",
+                ((self.now, id, self.version) for id in found),
+            )
+        num_found = sum(id in found for id in ids)
+        self.hits += num_found
+        self.misses += len(ids) - num_found
+        return found
+
+    def put_many(self, items):
+        '''
+        stages (id, csq) pairs. They are added to the cache by store_pending, so that
+        get_many keeps returning what was cached before, e.g. for repeated IDs
+        '''
+        items = list(items)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pending (id, csq) VALUES (?, ?)", items
+        )
+        self.stored += len(items)
+
+    def store_pending(self):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO annotations (id, version, csq, last_used) "
+            "SELECT id, ?, csq, ? FROM pending", (self.version, self.now)
+        )
+        self.connection.execute("DELETE FROM pending")
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def num_entries(self):
+        return self.connection.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def evict(self, max_entries=DEFAULT_MAX_ENTRIES):
+        ''' removes the least recently used entries above max_entries, returns the number removed '''
+        excess = self.num_entries() - max_entries
+        if excess <= 0:
+            return 0
+        self.connection.execute(
+            "DELETE FROM annotations WHERE (id, version) IN "
+            "(SELECT id, version FROM annotations ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        return excess
+
+    def hit_rate(self):
+        looked_up = self.hits + self.misses
+        return self.hits / looked_up if looked_up else 0.0
+
+    def close(self):
+        self.store_pending()
+        self.connection.commit()
+        self.connection.close()
+
+
+################################################
+#   Functions
+################################################
+
+def variant_id(chrom, pos, ref, alt):
+    return f"{chrom}_{pos}_{ref}_{alt}"
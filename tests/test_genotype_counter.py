@@ -0,0 +1,81 @@
+import os
+import random
+import sys
+from collections import namedtuple
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "dockerfiles", "cohort_higlass", "scripts"))
+
+from create_variant_result_file import GenotypeCounter
+from utils import VALID_GENOTYPES
+
+
+Record = namedtuple("Record", ["ID", "FORMAT", "GENOTYPES"])
+
+
+def summarize_genotypes(sample_gts, variant_id):
+    '''
+    Reference: the per sample count that GenotypeCounter replaced.
+    Expects a dict of the form
+    {
+        "sample_1": "0/1",
+        "sample_2": "./1",
+    }
+    and calculates AC, AN and AF across all samples.
+    '''
+
+    s_AC = s_AN = 0
+
+    for sample in sample_gts:
+        gt = sample_gts[sample]
+
+        if gt not in VALID_GENOTYPES:
+            raise Exception(f"Unexpected genotype {gt} found for variant {variant_id}. Did you run bcftools norm multiallelics?")
+
+        # if genotye has not been called, move on
+        if gt == "./.":
+            continue
+
+        s_AN += 2 # add 2 to total count if there is a genotype called
+        s_AC += gt.count('1') # then count the alternative alleles
+
+    # with counting done, we need to calculate AF and store all 3 values in the result dict
+    s_AF = s_AC/s_AN if s_AC > 0 else 0
+
+    return {
+        "AC": s_AC,
+        "AN": s_AN,
+        "AF": s_AF,
+    }
+
+
+def record(id, format, genotypes, samples):
+    GT_idx = format.split(":").index("GT")
+    columns = {}
+    for sample, gt in zip(samples, genotypes):
+        fields = ["10", "5,5", "99"]
+        fields.insert(GT_idx, gt)
+        columns[sample] = ":".join(fields[:len(format.split(":"))])
+    return Record(id, format, columns)
+
+
+@pytest.mark.parametrize("format", ["GT:AD:DP:GQ", "AD:GT:DP:GQ"])
+def test_genotype_counter(format):
+    rng = random.Random(1)
+    samples = [f"SAMPLE{i}" for i in range(40)]
+    cases = samples[::3]
+    counter = GenotypeCounter(samples, cases)
+    for i in range(200):
+        genotypes = [rng.choice(VALID_GENOTYPES) for _ in samples]
+        case_summary, control_summary = counter.count(record(f"var{i}", format, genotypes, samples))
+        gts = dict(zip(samples, genotypes))
+        assert case_summary == summarize_genotypes({s: gts[s] for s in cases}, i)
+        assert control_summary == summarize_genotypes({s: gts[s] for s in samples if s not in cases}, i)
+
+
+def test_genotype_counter_unexpected_genotype():
+    samples = ["SAMPLE0", "SAMPLE1", "SAMPLE2"]
+    counter = GenotypeCounter(samples, ["SAMPLE1"])
+    with pytest.raises(Exception, match="Unexpected genotype 1/2 found for variant var1"):
+        counter.count(record("var1", "GT:AD:DP:GQ", ["0/1", "0/0", "1/2"], samples))
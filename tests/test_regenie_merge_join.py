@@ -0,0 +1,53 @@
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "dockerfiles", "cohort_higlass", "scripts"))
+
+from utils import RegenieMergeJoin, RegenieResultsDict
+
+
+REGENIE_HEADER = "CHROM GENPOS ID ALLELE0 ALLELE1 A1FREQ INFO N TEST BETA SE CHISQ LOG10P EXTRA\n"
+
+
+def write_regenie(file_name, variants):
+    ''' writes a Regenie variant output, variants are (chrom, pos, id, log10p) '''
+    with gzip.open(file_name, "wt") as f:
+        f.write(REGENIE_HEADER)
+        for chrom, pos, id, log10p in variants:
+            ref, alt = id.split("_")[-2:]
+            f.write(f"{chrom[3:]} {pos} {id} {ref} {alt} 0.1 1 100 ADD 0.5 0.1 2.5 {log10p} NA\n")
+
+
+def test_merge_join_duplicate_ids(tmp_path):
+    regenie_output = str(tmp_path / "regenie.txt.gz")
+    write_regenie(regenie_output, [
+        ("chr1", 100, "chr1_100_A_C", 0.1),
+        ("chr1", 200, "chr1_200_A_C", 0.2),
+        ("chr1", 200, "chr1_200_A_T", 0.3),
+        ("chr1", 200, "chr1_200_A_C", 0.4), # duplicate, the last one wins
+        ("chr1", 250, "chr1_250_G_T", 0.5), # not in the VCF
+        ("chr1", 300, "chr1_300_C_G", 0.6),
+        ("chr2", 50, "chr2_50_T_A", 0.7),
+        ("chr2", 50, "chr2_50_T_A", 0.8),
+    ])
+    # VCF records in VCF order, with IDs that are in the VCF more than once
+    vcf_records = [
+        ("chr1", 100, "chr1_100_A_C"),
+        ("chr1", 200, "chr1_200_A_C"),
+        ("chr1", 200, "chr1_200_A_T"),
+        ("chr1", 200, "chr1_200_A_C"),
+        ("chr1", 200, "chr1_200_A_G"),
+        ("chr1", 300, "chr1_300_C_G"),
+        ("chr2", 50, "chr2_50_T_A"),
+        ("chr2", 50, "chr2_50_T_A"),
+        ("chr2", 60, "chr2_60_T_A"),
+    ]
+
+    expected = RegenieResultsDict(regenie_output)
+    merge_join = RegenieMergeJoin(regenie_output, ["chr1", "chr2"])
+    for chrom, pos, id in vcf_records:
+        assert merge_join.get(chrom, pos, id) == expected.get(chrom, pos, id)
+
+    assert expected.get("chr1", 200, "chr1_200_A_C")["regenie_ml10p"] == "0.4"
+    assert merge_join.num_unmatched == 1
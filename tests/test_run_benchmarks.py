@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARKS = os.path.join(os.path.dirname(__file__), "..", "benchmarks")
+
+
+def test_smoke_run(tmp_path):
+    ''' small cohorts, the 1000 sample one has a sample info JSON larger than an argument can be '''
+    output = str(tmp_path / "results.json")
+    subprocess.run([
+        sys.executable, os.path.join(BENCHMARKS, "run_benchmarks.py"),
+        "-s", "50x300", "-s", "1000x300",
+        "-x", "create_variant_result_file", "-x", "create_variant_details_file",
+        "-d", str(tmp_path), "-o", output,
+    ], check=True)
+    with open(output) as f:
+        results = json.load(f)["results"]
+    assert len(results) == 4
+    for result in results:
+        assert "error" not in result, result
+        assert result["returncode"] == 0, result
+    assert os.path.getsize(tmp_path / "cohort_1000x300_seed1" / "sample_info.json") > 131072